@@ -1,19 +1,31 @@
-from flask import Flask, render_template, request, jsonify, session, send_from_directory
+from flask import Flask, render_template, request, jsonify, session, send_from_directory, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 from datetime import datetime, UTC, timedelta
 import os
 import hashlib
+import math
+import bisect
 import re
 import threading
 import time
 import logging
 from logging.handlers import RotatingFileHandler
-from sqlalchemy import text
+from sqlalchemy import text, insert, event
+from sqlalchemy.orm import joinedload, selectinload
 from sqlalchemy.exc import IntegrityError
 from flask_cors import CORS
-from functools import wraps
+from functools import wraps, lru_cache
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+try:
+    import fcntl
+except ImportError:  # Windows では複数プロセス間のロックを取らない
+    fcntl = None
 import jwt
 from flask_migrate import Migrate
 
@@ -28,6 +40,20 @@ app.config['JWT_SECRET_KEY'] = app.config['SECRET_KEY']  # JWT用のシークレ
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///gtrsb.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# SQLiteの接続プロファイル（SQLITE_PROFILE=default で既定のPRAGMAのまま）
+SQLITE_PROFILES = {
+    'production': {
+        'busy_timeout': 5000,
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 268435456,
+        'cache_size': -65536,
+        'temp_store': 'MEMORY',
+    },
+    'default': {},
+}
+app.config['SQLITE_PRAGMAS'] = SQLITE_PROFILES[os.environ.get('SQLITE_PROFILE', 'production')]
+
 # CORSの初期化
 CORS(app)
 
@@ -45,46 +71,248 @@ app.logger.info('アプリケーション起動')
 
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """新しいSQLite接続ごとにプロファイルのPRAGMAを設定"""
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', set_sqlite_pragmas)
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-# 診断結果を保持するグローバル変数
-diagnostic_status = {
-    'last_check': None,
-    'database_status': 'unknown',
-    'api_status': 'unknown',
-    'error_count': 0
-}
+# メトリクス（/metrics で Prometheus のテキスト形式として公開する）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+class MetricsRegistry:
+    """プロセス内のカウンターとヒストグラム。値はワーカープロセスごとに持つ"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    def describe(self, name, kind, help_text, buckets=DEFAULT_BUCKETS):
+        self._metrics[name] = {'kind': kind, 'help': help_text, 'buckets': buckets, 'values': {}}
+
+    def collector(self, fn):
+        """出力時に (名前, ラベル, 値) を返すゲージの収集関数を登録する"""
+        self._collectors.append(fn)
+        return fn
+
+    def inc(self, name, labels=None, amount=1):
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            values = self._metrics[name]['values']
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name, value, labels=None):
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            self._metrics[name]['values'][key] = value
+
+    def observe(self, name, value, labels=None):
+        key = tuple(sorted((labels or {}).items()))
+        metric = self._metrics[name]
+        with self._lock:
+            state = metric['values'].get(key)
+            if state is None:
+                # バケットごとの件数（累積はせず出力時に足し合わせる）, 合計, 件数
+                state = metric['values'][key] = [[0] * (len(metric['buckets']) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(metric['buckets'], value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def value(self, name, labels=None):
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            return self._metrics[name]['values'].get(key)
+
+    def render(self):
+        gauges = {}
+        for fn in self._collectors:
+            for name, labels, value in fn():
+                gauges.setdefault(name, []).append((labels, value))
+
+        lines = []
+        with self._lock:
+            for name, metric in self._metrics.items():
+                lines.append(f'# HELP {name} {metric["help"]}')
+                lines.append(f'# TYPE {name} {metric["kind"]}')
+                samples = [(dict(key), value) for key, value in metric['values'].items()]
+                samples += gauges.get(name, [])
+                for labels, value in samples:
+                    if metric['kind'] != 'histogram':
+                        lines.append(f'{name}{format_labels(labels)} {value}')
+                        continue
+                    counts, total, count = value
+                    cumulative = 0
+                    for le, bucket_count in zip(list(metric['buckets']) + ['+Inf'], counts):
+                        cumulative += bucket_count
+                        lines.append(f'{name}_bucket{format_labels(dict(labels, le=le))} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {total}')
+                    lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+metrics.describe('http_requests_total', 'counter', 'HTTPリクエスト数')
+metrics.describe('http_request_duration_seconds', 'histogram', 'HTTPリクエストの処理時間（秒）')
+metrics.describe('db_queries_total', 'counter', '実行したSQL文の数')
+metrics.describe('db_query_duration_seconds', 'histogram', 'SQL文の実行時間（秒）')
+metrics.describe('db_pool_size', 'gauge', 'コネクションプールの大きさ')
+metrics.describe('db_pool_checked_out', 'gauge', '使用中のコネクション数')
+metrics.describe('db_pool_checked_in', 'gauge', 'プール内で待機中のコネクション数')
+metrics.describe('db_pool_overflow', 'gauge', 'プールの大きさを超えて開いているコネクション数')
+metrics.describe('health_probe_up', 'gauge', '直近のヘルスチェックが成功していれば1')
+metrics.describe('health_probe_last_check_timestamp_seconds', 'gauge', '直近のヘルスチェックの時刻（UNIX時間）')
+metrics.describe('health_probe_failures_total', 'counter', 'ヘルスチェックの失敗回数')
+
+def metrics_endpoint_label():
+    """ラベルにはURLではなくルールを使い、系列の数が増えすぎないようにする"""
+    if not has_request_context():
+        return 'none'
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+# この時間（ミリ秒）以上かかったSQL文はログに残す
+app.config.setdefault('SLOW_QUERY_THRESHOLD_MS', float(os.environ.get('SLOW_QUERY_THRESHOLD_MS', 100)))
+SLOW_QUERY_LOG_MAX_LENGTH = 1000
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    # リクエスト中に実行したSQL文の数と合計時間
+    g.sql_count = 0
+    g.sql_seconds = 0.0
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        endpoint = metrics_endpoint_label()
+        metrics.inc('http_requests_total', {'method': request.method, 'endpoint': endpoint,
+                                            'status': response.status_code})
+        metrics.observe('http_request_duration_seconds', elapsed,
+                        {'method': request.method, 'endpoint': endpoint})
+        response.headers.add('Server-Timing', f'db;desc="{g.sql_count} queries";dur={g.sql_seconds * 1000:.1f}')
+        response.headers.add('Server-Timing', f'app;dur={elapsed * 1000:.1f}')
+    return response
+
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+def record_query_metrics(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_started
+    endpoint = metrics_endpoint_label()
+    metrics.inc('db_queries_total', {'endpoint': endpoint})
+    metrics.observe('db_query_duration_seconds', elapsed, {'endpoint': endpoint})
+    if has_request_context() and 'sql_count' in g:
+        g.sql_count += 1
+        g.sql_seconds += elapsed
+    if elapsed * 1000 >= app.config['SLOW_QUERY_THRESHOLD_MS']:
+        # パラメーターには個人情報が含まれうるため、SQL文だけを記録する
+        method = request.method if has_request_context() else '-'
+        sql = ' '.join(statement.split())[:SLOW_QUERY_LOG_MAX_LENGTH]
+        app.logger.warning(f'遅いクエリ {elapsed * 1000:.1f}ms [{method} {endpoint}]: {sql}')
+
+with app.app_context():
+    event.listen(db.engine, 'before_cursor_execute', start_query_timer)
+    event.listen(db.engine, 'after_cursor_execute', record_query_metrics)
+
+@metrics.collector
+def pool_metrics():
+    with app.app_context():
+        pool = db.engine.pool
+    # SQLite のメモリDBなどサイズを持たないプールでは出力しない
+    for name, method in (('db_pool_size', 'size'), ('db_pool_checked_out', 'checkedout'),
+                         ('db_pool_checked_in', 'checkedin'), ('db_pool_overflow', 'overflow')):
+        if hasattr(pool, method):
+            yield name, {}, getattr(pool, method)()
+
+def check_database():
+    """データベースに接続できるか確認する（失敗時は例外）"""
+    db.session.execute(text('SELECT 1'))
+    db.session.commit()
+
+# 定期ヘルスチェック（HEALTH_PROBE_INTERVAL 秒ごと。0 で無効）
+app.config.setdefault('HEALTH_PROBE_INTERVAL', int(os.environ.get('HEALTH_PROBE_INTERVAL', 0)))
+app.config.setdefault('HEALTH_PROBE_LOCK', os.environ.get('HEALTH_PROBE_LOCK', os.path.join('logs', 'health_probe.lock')))
 
-def run_diagnostic():
-    """システムの診断を実行"""
-    global diagnostic_status
-    while True:
+class HealthProber:
+    """ロックファイルを取れた1プロセスだけが定期的にデータベースを確認する"""
+
+    def __init__(self, interval, lock_path):
+        self.interval = interval
+        self.lock_path = lock_path
+        self._lock_file = None
+        self.running = False
+        self._lock = threading.Lock()
+        self._status = {'last_check': None, 'database_status': 'unknown', 'error_count': 0}
+
+    def _acquire_lock(self):
+        if fcntl is None:
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        # プロセスが終了するまでロックを保持する
+        self._lock_file = lock_file
+        return True
+
+    def start(self):
+        """ほかのプロセスが実行中なら何もせず False を返す"""
+        if not self._acquire_lock():
+            app.logger.info('ヘルスチェックは別のプロセスで実行中です')
+            return False
+        self.running = True
+        threading.Thread(target=self._run, name='health-probe', daemon=True).start()
+        return True
+
+    def _run(self):
+        while True:
+            self.check()
+            time.sleep(self.interval)
+
+    def check(self):
+        now = datetime.now(UTC)
         try:
             with app.app_context():
-                # データベース接続の確認
-                db.session.execute(text('SELECT 1'))
-                diagnostic_status['database_status'] = 'healthy'
-                
-                # APIの応答確認
-                with app.test_client() as client:
-                    response = client.get('/api/health')
-                    if response.status_code == 200:
-                        diagnostic_status['api_status'] = 'healthy'
-                    else:
-                        diagnostic_status['api_status'] = 'unhealthy'
-                        diagnostic_status['error_count'] += 1
-                
-                diagnostic_status['last_check'] = datetime.now(UTC)
-                app.logger.info(f'診断完了: {diagnostic_status}')
-            
+                check_database()
+            healthy = True
         except Exception as e:
-            diagnostic_status['database_status'] = 'unhealthy'
-            diagnostic_status['error_count'] += 1
-            app.logger.error(f'診断エラー: {str(e)}')
-        
-        time.sleep(300)  # 5分ごとに診断
+            healthy = False
+            app.logger.error(f'ヘルスチェックエラー: {str(e)}')
+        with self._lock:
+            self._status['last_check'] = now
+            self._status['database_status'] = 'healthy' if healthy else 'unhealthy'
+            if not healthy:
+                self._status['error_count'] += 1
+        metrics.set('health_probe_up', 1 if healthy else 0)
+        metrics.set('health_probe_last_check_timestamp_seconds', now.timestamp())
+        if not healthy:
+            metrics.inc('health_probe_failures_total')
+        return healthy
+
+    def status(self):
+        with self._lock:
+            return dict(self._status)
+
+health_prober = HealthProber(app.config['HEALTH_PROBE_INTERVAL'], app.config['HEALTH_PROBE_LOCK'])
 
 # データベースの初期化
 with app.app_context():
@@ -95,9 +323,117 @@ with app.app_context():
         app.logger.error(f'データベース初期化エラー: {str(e)}')
         raise
 
-# 診断スレッドの開始
-diagnostic_thread = threading.Thread(target=run_diagnostic, daemon=True)
-diagnostic_thread.start()
+if app.config['HEALTH_PROBE_INTERVAL'] > 0:
+    health_prober.start()
+
+# パスワードハッシュの設定（変更するとログイン時に新しい設定で再ハッシュされる）
+app.config.setdefault('PASSWORD_HASH_METHOD', os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1'))
+app.config.setdefault('PASSWORD_HASH_WORKERS', int(os.environ.get('PASSWORD_HASH_WORKERS', 2)))
+app.config.setdefault('PASSWORD_HASH_QUEUE_DEPTH', int(os.environ.get('PASSWORD_HASH_QUEUE_DEPTH', 16)))
+app.config.setdefault('LOGIN_FAILURE_WINDOW', 300)
+app.config.setdefault('LOGIN_FAILURE_LIMIT_PER_EMAIL', 5)
+# 試行の制限は主にメールアドレスごとに行う。IP ごとの上限は多数のアドレスを試す攻撃への備えで、
+# 同じ NAT やプロキシの内側の利用者が巻き込まれないよう大きめにしてある
+app.config.setdefault('LOGIN_FAILURE_LIMIT_PER_IP', 100)
+# nginx などのリバースプロキシの段数。1以上なら X-Forwarded-For からクライアントの IP を取る
+# （プロキシを通さずに公開している場合に設定すると IP を偽装できるので 0 のままにする）
+app.config.setdefault('TRUSTED_PROXY_COUNT', int(os.environ.get('TRUSTED_PROXY_COUNT', 0)))
+if app.config['TRUSTED_PROXY_COUNT'] > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXY_COUNT'],
+                            x_proto=app.config['TRUSTED_PROXY_COUNT'])
+
+class PasswordHasherBusy(Exception):
+    """ハッシュ計算の待ち行列が埋まっている"""
+
+class PasswordHasher:
+    """パスワードハッシュの計算を上限付きのスレッドプールで行う"""
+
+    def __init__(self, workers, queue_depth):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        # 実行中と待機中を合わせた件数の上限
+        self._slots = threading.BoundedSemaphore(workers + queue_depth)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    @staticmethod
+    def needs_rehash(password_hash):
+        return password_hash.split('$', 1)[0] != password_hash_prefix(app.config['PASSWORD_HASH_METHOD'])
+
+@lru_cache(maxsize=None)
+def password_hash_prefix(method):
+    """設定した方式で作られるハッシュの先頭部分を返す（scrypt なら scrypt:32768:8:1 に展開される）"""
+    return generate_password_hash('', method).split('$', 1)[0]
+
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_QUEUE_DEPTH'])
+
+class LoginThrottle:
+    """ログイン失敗回数をキーごとにスライディングウィンドウで数える"""
+
+    def __init__(self, window):
+        self.window = window
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def _recent(self, key, now):
+        failures = self._failures.get(key)
+        if failures is None:
+            return None
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        if not failures:
+            del self._failures[key]
+            return None
+        return failures
+
+    def retry_after(self, key, limit):
+        """上限に達していれば再試行可能になるまでの秒数、そうでなければ 0 を返す"""
+        now = time.monotonic()
+        with self._lock:
+            failures = self._recent(key, now)
+            if failures is None or len(failures) < limit:
+                return 0
+            return max(1, math.ceil(failures[0] + self.window - now))
+
+    def add_failure(self, key):
+        now = time.monotonic()
+        with self._lock:
+            failures = self._recent(key, now)
+            if failures is None:
+                failures = self._failures[key] = deque()
+            failures.append(now)
+
+    def reset(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+
+login_throttle = LoginThrottle(app.config['LOGIN_FAILURE_WINDOW'])
+
+def login_throttle_keys(email):
+    return [
+        (('email', str(email).lower()), app.config['LOGIN_FAILURE_LIMIT_PER_EMAIL']),
+        (('ip', request.remote_addr), app.config['LOGIN_FAILURE_LIMIT_PER_IP']),
+    ]
+
+def too_many_requests(message, retry_after):
+    response = jsonify({'error': message})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
 
 # データベースモデル
 class User(UserMixin, db.Model):
@@ -107,10 +443,10 @@ class User(UserMixin, db.Model):
     records = db.relationship('Record', backref='user', lazy=True)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
 
 class GameTitle(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -140,7 +476,14 @@ class Record(db.Model):
     total_time = db.Column(db.Float, nullable=False)
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
-    lap_times = db.relationship('LapTime', backref='record', lazy=True, cascade='all, delete-orphan')
+    lap_times = db.relationship('LapTime', backref='record', lazy=True, cascade='all, delete-orphan',
+                                order_by='LapTime.lap_number')
+
+    # 一覧はコースまたは作成者で絞り込み、合計タイム順に返すため、その順に並んだ索引を持つ
+    __table_args__ = (
+        db.Index('ix_record_track_total_time', 'track_id', 'total_time'),
+        db.Index('ix_record_created_by_total_time', 'created_by', 'total_time'),
+    )
 
     def __init__(self, game_title_id, car_model_id, track_id, total_time, created_by):
         self.game_title_id = game_title_id
@@ -154,20 +497,102 @@ class LapTime(db.Model):
     record_id = db.Column(db.Integer, db.ForeignKey('record.id'), nullable=False)
     lap_number = db.Column(db.Integer, nullable=False)
     time = db.Column(db.String(20), nullable=False)
+    # ソートや集計用にミリ秒単位の整数でも保持する
+    time_ms = db.Column(db.Integer)
+
+    # 記録ごとのラップは周回順にまとめて読み込む
+    __table_args__ = (
+        db.Index('ix_lap_time_record_lap_number', 'record_id', 'lap_number'),
+    )
+
+class TTLCache:
+    """件数上限と有効期限付きのスレッドセーフなLRUキャッシュ"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """(見つかったか, 値) を返す"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value, generation=None):
+        """generation を渡した場合、その後に delete/clear されていれば保存しない"""
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+@dataclass(frozen=True, eq=False)
+class UserSnapshot(UserMixin):
+    """リクエスト間で共有するための読み取り専用のユーザー情報"""
+    id: int
+    email: str
+
+# 認証済みリクエストごとの主キー検索を避けるためユーザー情報をキャッシュする
+app.config.setdefault('USER_CACHE_SIZE', 1024)
+app.config.setdefault('USER_CACHE_TTL', int(os.environ.get('USER_CACHE_TTL', 300)))
+user_cache = TTLCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_user_cache(mapper, connection, user):
+    user_cache.delete(user.id)
+
+def get_user_snapshot(user_id):
+    """キャッシュ経由でユーザー情報を取得。存在しなければ None"""
+    found, snapshot = user_cache.get(user_id)
+    if not found:
+        generation = user_cache.generation
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        snapshot = UserSnapshot(id=user.id, email=user.email)
+        user_cache.set(user_id, snapshot, generation)
+    return snapshot
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return get_user_snapshot(int(user_id))
 
 # ユーティリティ関数
+# MM:SS.mmm形式→ミリ秒(int)
+
+def parse_lap_time(time):
+    minutes, seconds = time.split(':')
+    return round((int(minutes) * 60 + float(seconds)) * 1000)
+
 # 合計秒数(float)で返す
 
 def calculate_total_time(lap_times):
-    total_seconds = 0.0
-    for time in lap_times:
-        minutes, seconds = map(float, time.split(':'))
-        total_seconds += minutes * 60 + seconds
-    return total_seconds
+    return sum(parse_lap_time(time) for time in lap_times) / 1000
 
 # 表示用: 秒数(float)→MM:SS.mmm形式
 
@@ -189,7 +614,7 @@ def token_required(f):
             return jsonify({'error': 'トークンが必要です'}), 401
         try:
             data = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=["HS256"])
-            current_user = User.query.get(data['user_id'])
+            current_user = get_user_snapshot(data['user_id'])
             if not current_user:
                 return jsonify({'error': 'ユーザーが存在しません'}), 401
         except jwt.ExpiredSignatureError:
@@ -231,7 +656,10 @@ def register():
         return jsonify({'error': 'このメールアドレスは既に登録されています'}), 400
     
     user = User(email=data['email'])
-    user.set_password(data['password'])
+    try:
+        user.set_password(data['password'])
+    except PasswordHasherBusy:
+        return too_many_requests('混み合っています。しばらくしてから再度お試しください', 1)
     
     try:
         db.session.add(user)
@@ -245,8 +673,28 @@ def register():
 @app.route('/api/login', methods=['POST'])
 def login():
     data = request.get_json()
+
+    # 失敗が続いているメールアドレス・IPはハッシュ計算の前に拒否する
+    throttle_keys = login_throttle_keys(data['email'])
+    retry_after = max(login_throttle.retry_after(key, limit) for key, limit in throttle_keys)
+    if retry_after:
+        return too_many_requests('ログイン試行回数が多すぎます。しばらくしてから再度お試しください', retry_after)
+
     user = User.query.filter_by(email=data['email']).first()
-    if user and user.check_password(data['password']):
+    try:
+        authenticated = user is not None and user.check_password(data['password'])
+    except PasswordHasherBusy:
+        return too_many_requests('混み合っています。しばらくしてから再度お試しください', 1)
+
+    if authenticated:
+        # ハッシュ設定が変わっていれば新しい設定で保存し直す
+        if password_hasher.needs_rehash(user.password_hash):
+            try:
+                user.set_password(data['password'])
+                db.session.commit()
+            except PasswordHasherBusy:
+                pass  # 次回のログイン時に再ハッシュする
+        login_throttle.reset(throttle_keys[0][0])
         login_user(user)
         token = jwt.encode(
             {
@@ -261,6 +709,9 @@ def login():
             'email': user.email,
             'token': token
         })
+
+    for key, _ in throttle_keys:
+        login_throttle.add_failure(key)
     return jsonify({'error': 'メールアドレスまたはパスワードが正しくありません'}), 401
 
 @app.route('/api/logout')
@@ -384,7 +835,14 @@ def get_records(current_user):
         # クエリパラメータuser_idはcreated_byにマッピングする
         filters['created_by'] = request.args.get('user_id')
     
-    records = Record.query.filter_by(**filters).order_by(Record.total_time).all()
+    # 関連をまとめて読み込み、件数によらずクエリ数を一定にする（N+1対策）
+    records = Record.query.options(
+        joinedload(Record.user),
+        joinedload(Record.game_title),
+        joinedload(Record.car_model),
+        joinedload(Record.track),
+        selectinload(Record.lap_times)
+    ).filter_by(**filters).order_by(Record.total_time).all()
     return jsonify([{
         'id': r.id,
         'user': r.user.email,
@@ -400,26 +858,64 @@ def get_records(current_user):
         'created_at': r.created_at.isoformat()
     } for r in records])
 
-@app.route('/api/records', methods=['POST'])
-@token_required
-def add_record(current_user):
-    data = request.get_json()
-    
-    # バリデーション
-    if not all(key in data for key in ['game_title_id', 'car_model_id', 'track_id', 'lap_times']):
-        return jsonify({'error': '必要な情報が不足しています'}), 400
+RECORD_BATCH_MAX_SIZE = 1000
+
+def parse_track_id(value):
+    """track_id を int にする（main.js は文字列で送る）。解釈できなければ None"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return None
+
+def validate_record(data, tracks):
+    """記録データのバリデーション。問題があれば (エラーメッセージ, ステータスコード) を返す
+
+    tracks は int の id をキーにした辞書。検証を通った data['track_id'] は int に揃える。
+    """
+    if not isinstance(data, dict) or not all(key in data for key in ['game_title_id', 'car_model_id', 'track_id', 'lap_times']):
+        return '必要な情報が不足しています', 400
     
-    track = Track.query.get(data['track_id'])
+    track_id = parse_track_id(data['track_id'])
+    if track_id is None:
+        return 'コースIDの指定が正しくありません', 400
+    track = tracks.get(track_id)
     if not track:
-        return jsonify({'error': '指定されたコースが見つかりません'}), 404
+        return '指定されたコースが見つかりません', 404
     
-    if len(data['lap_times']) != track.lap_count:
-        return jsonify({'error': f'ラップタイムの数が正しくありません（{track.lap_count}周のコースです）'}), 400
+    if not isinstance(data['lap_times'], list) or len(data['lap_times']) != track.lap_count:
+        return f'ラップタイムの数が正しくありません（{track.lap_count}周のコースです）', 400
     
     # ラップタイムのバリデーション
     for time in data['lap_times']:
-        if not re.match(r'^\d{2}:\d{2}\.\d{3}$', time):
-            return jsonify({'error': 'ラップタイムの形式が正しくありません（MM:SS.mmm）'}), 400
+        if not isinstance(time, str) or not re.match(r'^\d{2}:\d{2}\.\d{3}$', time):
+            return 'ラップタイムの形式が正しくありません（MM:SS.mmm）', 400
+    data['track_id'] = track_id
+    return None
+
+def lap_time_rows(record_id, lap_times):
+    """一括INSERT用のラップタイム行を作成"""
+    return [{
+        'record_id': record_id,
+        'lap_number': i,
+        'time': time,
+        'time_ms': parse_lap_time(time)
+    } for i, time in enumerate(lap_times, 1)]
+
+@app.route('/api/records', methods=['POST'])
+@token_required
+def add_record(current_user):
+    data = request.get_json()
+    
+    # バリデーション
+    track_id = parse_track_id(data.get('track_id')) if isinstance(data, dict) else None
+    track = db.session.get(Track, track_id) if track_id is not None else None
+    error = validate_record(data, {track.id: track} if track else {})
+    if error:
+        message, status = error
+        return jsonify({'error': message}), status
     
     # 全体タイムの計算
     total_time = calculate_total_time(data['lap_times'])
@@ -435,14 +931,8 @@ def add_record(current_user):
     db.session.add(record)
     db.session.flush()  # IDを生成
     
-    # ラップタイムの作成
-    for i, time in enumerate(data['lap_times'], 1):
-        lap_time = LapTime(
-            record_id=record.id,
-            lap_number=i,
-            time=time
-        )
-        db.session.add(lap_time)
+    # ラップタイムは executemany で一括作成
+    db.session.execute(insert(LapTime), lap_time_rows(record.id, data['lap_times']))
     
     db.session.commit()
     return jsonify({
@@ -451,13 +941,60 @@ def add_record(current_user):
         'created_at': record.created_at.isoformat()
     }), 201
 
+@app.route('/api/records/batch', methods=['POST'])
+@token_required
+def add_records_batch(current_user):
+    """複数の記録を1リクエスト・1トランザクションで一括登録"""
+    data = request.get_json()
+    records = data.get('records') if isinstance(data, dict) else None
+    if not isinstance(records, list) or not records:
+        return jsonify({'error': '記録の一覧が必要です'}), 400
+    if len(records) > RECORD_BATCH_MAX_SIZE:
+        return jsonify({'error': f'一度に登録できる記録は{RECORD_BATCH_MAX_SIZE}件までです'}), 400
+    
+    # 参照されるコースをまとめて取得し、すべての記録を書き込み前に検証する
+    track_ids = {parse_track_id(r.get('track_id')) for r in records if isinstance(r, dict)} - {None}
+    tracks = {t.id: t for t in Track.query.filter(Track.id.in_(track_ids))} if track_ids else {}
+    for index, record_data in enumerate(records):
+        error = validate_record(record_data, tracks)
+        if error:
+            message, status = error
+            return jsonify({'error': message, 'index': index}), status
+    
+    created_at = datetime.now(UTC)
+    try:
+        record_ids = db.session.scalars(
+            insert(Record).returning(Record.id, sort_by_parameter_order=True),
+            [{
+                'game_title_id': r['game_title_id'],
+                'car_model_id': r['car_model_id'],
+                'track_id': r['track_id'],
+                'total_time': calculate_total_time(r['lap_times']),
+                'created_by': current_user.id,
+                'created_at': created_at
+            } for r in records]
+        ).all()
+        db.session.execute(insert(LapTime), [
+            row
+            for record_id, r in zip(record_ids, records)
+            for row in lap_time_rows(record_id, r['lap_times'])
+        ])
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"記録一括登録エラー: {str(e)}")
+        return jsonify({'error': '記録の一括登録に失敗しました'}), 500
+    
+    return jsonify({
+        'ids': record_ids,
+        'count': len(record_ids)
+    }), 201
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """システムの健全性を確認"""
     try:
-        # データベース接続の確認
-        db.session.execute(text('SELECT 1'))
-        db.session.commit()
+        check_database()
         
         return jsonify({
             'status': 'healthy',
@@ -479,13 +1016,22 @@ def get_diagnostic():
     if 'user_id' not in session:
         return jsonify({'error': 'ログインが必要です'}), 401
     
+    # 定期チェックがこのプロセスで動いていなければその場で確認する
+    if not health_prober.running:
+        health_prober.check()
+    status = health_prober.status()
     return jsonify({
-        'last_check': diagnostic_status['last_check'].isoformat() if diagnostic_status['last_check'] else None,
-        'database_status': diagnostic_status['database_status'],
-        'api_status': diagnostic_status['api_status'],
-        'error_count': diagnostic_status['error_count']
+        'last_check': status['last_check'].isoformat() if status['last_check'] else None,
+        'database_status': status['database_status'],
+        'api_status': 'healthy',
+        'error_count': status['error_count']
     }), 200
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus 形式のメトリクス"""
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
@@ -0,0 +1,209 @@
+"""性能テスト用の合成データを作る
+
+app.py のスキーマで独立した SQLite ファイルを作り、引数とスキーマのハッシュをファイル名にして
+キャッシュする。2回目以降はファイルのパスを返すだけで終わる。同じ引数とシードからは常に同じデータができる。
+ユーザーの記録数と車種・コースの人気には偏り（Zipf 分布）を持たせ、記録はコースの周回数分のラップを持つ。
+
+    python -m benchmarks.datagen --laps 1000000
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+# 生成したユーザーは全員このパスワードでログインできる
+BENCH_PASSWORD = 'bench-password'
+SEASON_START = datetime(2026, 1, 1)
+SEASON_DAYS = 180
+INSERT_CHUNK_ROWS = 10000
+TRACK_LAP_COUNTS = (1, 2, 3, 5)
+# 生成手順を変えたら上げる（キャッシュ済みのフィクスチャを作り直させる）
+FIXTURE_VERSION = 1
+FIXTURE_DIR = os.environ.get(
+    'BENCH_FIXTURE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures'))
+# フィクスチャはその場限りのファイルなので、耐障害性より書き込み速度を優先する
+FIXTURE_PRAGMAS = {
+    'journal_mode': 'OFF',
+    'synchronous': 'OFF',
+    'cache_size': -262144,
+    'temp_store': 'MEMORY',
+}
+
+RECORD_INSERT = ('INSERT INTO record (id, game_title_id, car_model_id, track_id, total_time, created_by, created_at) '
+                 'VALUES (?, ?, ?, ?, ?, ?, ?)')
+LAP_TIME_INSERT = 'INSERT INTO lap_time (record_id, lap_number, time, time_ms) VALUES (?, ?, ?, ?)'
+
+def zipf_cum_weights(n, s):
+    """順位 i の重みが 1 / i^s となる累積重み"""
+    total = 0.0
+    cum_weights = []
+    for rank in range(1, n + 1):
+        total += 1 / rank ** s
+        cum_weights.append(total)
+    return cum_weights
+
+def default_users(laps):
+    """ユーザー数の既定値。1人あたり2000周程度に収まるよう規模に合わせて増やす"""
+    return max(50, laps // 2000)
+
+def format_lap_time(time_ms):
+    """ミリ秒を MM:SS.mmm 形式に変換（API の入力形式と同じ）"""
+    minutes, rest = divmod(time_ms, 60000)
+    seconds, millis = divmod(rest, 1000)
+    return f'{minutes:02d}:{seconds:02d}.{millis:03d}'
+
+def write_dataset(conn, users, combos, laps, seed, game_titles):
+    """SQLAlchemy の接続にユーザー・カタログ・記録とラップタイムを書き込む。記録の件数を返す"""
+    from werkzeug.security import generate_password_hash
+    from app import app, db, User, GameTitle, CarModel, Track
+
+    rng = random.Random(seed)
+
+    # ハッシュ計算は重いので全員で同じハッシュを使う
+    password_hash = generate_password_hash(BENCH_PASSWORD, app.config['PASSWORD_HASH_METHOD'])
+    conn.execute(db.insert(User), [{'email': f'bench{i:05d}@kamiyama.ac.jp', 'password_hash': password_hash}
+                                   for i in range(users)])
+    user_ids = [id for id, in conn.execute(db.select(User.id).order_by(User.id))]
+    rng.shuffle(user_ids)
+
+    # 組み合わせの数が combos 以上になるように車種・コースを作る
+    car_count = max(1, math.ceil(math.sqrt(combos)))
+    track_count = max(1, math.ceil(combos / car_count))
+    game_title_ids = [conn.execute(db.insert(GameTitle).values(
+        name=f'Bench Game {g + 1}', created_by=user_ids[0])).inserted_primary_key[0] for g in range(game_titles)]
+    car_ids = [conn.execute(db.insert(CarModel).values(
+        name=f'Bench Car {i + 1}', created_by=user_ids[0])).inserted_primary_key[0] for i in range(car_count)]
+    tracks = []
+    for i in range(track_count):
+        lap_count = rng.choice(TRACK_LAP_COUNTS)
+        track_id, = conn.execute(db.insert(Track).values(
+            name=f'Bench Track {i + 1}', lap_count=lap_count, created_by=user_ids[0])).inserted_primary_key
+        tracks.append((track_id, lap_count))
+    all_combos = [(rng.choice(game_title_ids), car_id, track) for car_id in car_ids for track in tracks]
+    rng.shuffle(all_combos)
+    all_combos = all_combos[:combos]
+
+    base_ms = [rng.randint(60000, 150000) for _ in all_combos]
+    skill = [max(0.0, rng.gauss(0.04, 0.02)) for _ in user_ids]
+    user_cum = zipf_cum_weights(len(user_ids), 1.1)
+    combo_cum = zipf_cum_weights(len(all_combos), 1.0)
+    # 周回数の平均から記録の件数を見積もり、日時を id の順に並べる
+    expected_records = max(1, round(laps / (sum(TRACK_LAP_COUNTS) / len(TRACK_LAP_COUNTS))))
+    step_seconds = SEASON_DAYS * 86400 / expected_records
+
+    record_id = 0
+    lap_count_total = 0
+    while lap_count_total < laps:
+        user_picks = rng.choices(range(len(user_ids)), cum_weights=user_cum, k=INSERT_CHUNK_ROWS)
+        combo_picks = rng.choices(range(len(all_combos)), cum_weights=combo_cum, k=INSERT_CHUNK_ROWS)
+        records, lap_rows = [], []
+        for u, c in zip(user_picks, combo_picks):
+            if lap_count_total >= laps:
+                break
+            game_title_id, car_id, (track_id, lap_count) = all_combos[c]
+            record_id += 1
+            lap_ms = []
+            for lap_number in range(1, lap_count + 1):
+                # 腕前の差に加え、ミスで大きく遅れる周回が右に裾を引く
+                time_ms = int(base_ms[c] * (1 + skill[u] + rng.lognormvariate(-4.0, 0.6)))
+                lap_ms.append(time_ms)
+                lap_rows.append((record_id, lap_number, format_lap_time(time_ms), time_ms))
+            lap_count_total += lap_count
+            created_at = SEASON_START + timedelta(seconds=step_seconds * record_id)
+            records.append((record_id, game_title_id, car_id, track_id, sum(lap_ms) / 1000, user_ids[u],
+                            created_at.isoformat(' ', 'microseconds')))
+        # 件数が多いので ORM を通さず DB-API の executemany で入れる
+        conn.exec_driver_sql(RECORD_INSERT, records)
+        conn.exec_driver_sql(LAP_TIME_INSERT, lap_rows)
+    return record_id, lap_count_total
+
+def schema_fingerprint(metadata):
+    """テーブルとインデックスの DDL。モデルを変えるとキャッシュのキーも変わる"""
+    from sqlalchemy.dialects import sqlite
+    from sqlalchemy.schema import CreateIndex, CreateTable
+    dialect = sqlite.dialect()
+    ddl = []
+    for table in metadata.sorted_tables:
+        ddl.append(str(CreateTable(table).compile(dialect=dialect)).strip())
+        ddl += sorted(str(CreateIndex(index).compile(dialect=dialect)) for index in table.indexes)
+    return ddl
+
+def fixture_params(laps=10000, users=None, combos=20, seed=1, game_titles=2):
+    return {
+        'laps': laps,
+        'users': users or default_users(laps),
+        'combos': combos,
+        'seed': seed,
+        'game_titles': game_titles
+    }
+
+def fixture_path(params, cache_dir=None):
+    """引数・生成手順・スキーマのハッシュから決まるフィクスチャのパス"""
+    from app import db
+    key = hashlib.sha256(json.dumps({
+        'version': FIXTURE_VERSION,
+        'params': params,
+        'schema': schema_fingerprint(db.metadata)
+    }, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir or FIXTURE_DIR, f"laps{params['laps']}-seed{params['seed']}-{key}.db")
+
+def build_fixture(laps=10000, users=None, combos=20, seed=1, game_titles=2, cache_dir=None, rebuild=False):
+    """app.py のスキーマで合成データ入りの SQLite ファイルを作り、そのパスを返す
+
+    キャッシュにあればそれを返す。作成中のファイルは別名で書き、完成してから置き換えるので、
+    中断しても壊れたフィクスチャが残ることはない。
+    """
+    from sqlalchemy import create_engine, event
+    from app import db
+
+    params = fixture_params(laps, users, combos, seed, game_titles)
+    path = fixture_path(params, cache_dir)
+    if os.path.exists(path) and not rebuild:
+        return path
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f'{path}.{os.getpid()}.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+    engine = create_engine(f'sqlite:///{partial}')
+
+    @event.listens_for(engine, 'connect')
+    def set_fixture_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in FIXTURE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    try:
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            write_dataset(conn, params['users'], params['combos'], params['laps'], params['seed'],
+                          params['game_titles'])
+        engine.dispose()
+        os.replace(partial, path)
+    finally:
+        engine.dispose()
+        if os.path.exists(partial):
+            os.remove(partial)
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description='性能テスト用の合成データを作る')
+    parser.add_argument('--users', type=int, help='ユーザー数（省略時は周回数に応じて決める）')
+    parser.add_argument('--combos', type=int, default=20)
+    parser.add_argument('--laps', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--cache-dir', help=f'フィクスチャの保存先（既定: {FIXTURE_DIR}）')
+    parser.add_argument('--rebuild', action='store_true', help='キャッシュがあっても作り直す')
+    args = parser.parse_args()
+    started = time.perf_counter()
+    path = build_fixture(args.laps, args.users, args.combos, args.seed,
+                         cache_dir=args.cache_dir, rebuild=args.rebuild)
+    print(f'{path} ({time.perf_counter() - started:.1f}秒)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""add record and lap_time indexes
+
+Revision ID: a7e3c9d1b4f6
+Revises: 5dd44d77b7ca
+Create Date: 2026-10-18 18:22:40.158372
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7e3c9d1b4f6'
+down_revision = '5dd44d77b7ca'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 記録の一覧（コース別・作成者別に合計タイム順）と、記録ごとのラップの読み込みに使う
+    with op.batch_alter_table('record', schema=None) as batch_op:
+        batch_op.create_index('ix_record_track_total_time', ['track_id', 'total_time'], unique=False)
+        batch_op.create_index('ix_record_created_by_total_time', ['created_by', 'total_time'], unique=False)
+
+    with op.batch_alter_table('lap_time', schema=None) as batch_op:
+        batch_op.create_index('ix_lap_time_record_lap_number', ['record_id', 'lap_number'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('lap_time', schema=None) as batch_op:
+        batch_op.drop_index('ix_lap_time_record_lap_number')
+
+    with op.batch_alter_table('record', schema=None) as batch_op:
+        batch_op.drop_index('ix_record_created_by_total_time')
+        batch_op.drop_index('ix_record_track_total_time')
@@ -4,8 +4,10 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import unittest
 import json
-from app import app, db, User, GameTitle, CarModel, Track, Record, LapTime
+from app import (app, db, User, GameTitle, CarModel, Track, Record, LapTime,
+                 password_hasher, login_throttle, PasswordHasherBusy)
 from datetime import datetime
+from sqlalchemy import event
 
 class TestGTRSB(unittest.TestCase):
     def setUp(self):
@@ -229,12 +231,119 @@ class TestGTRSB(unittest.TestCase):
         data = json.loads(response.data)
         self.assertIn('error', data)
 
+    def batch_payload(self, lap_times_list):
+        game_id = json.loads(self.auth_get('/api/game-titles').data)[0]['id']
+        car_id = json.loads(self.auth_get('/api/car-models').data)[0]['id']
+        track = json.loads(self.auth_get('/api/tracks').data)[0]
+        return {'records': [{
+            'game_title_id': game_id,
+            'car_model_id': car_id,
+            'track_id': track['id'],
+            'lap_times': lap_times
+        } for lap_times in lap_times_list]}
+
+    def test_add_records_batch(self):
+        """複数記録の一括登録テスト"""
+        payload = self.batch_payload([['01:20.000', '01:21.500']] * 50)
+        response = self.auth_post('/api/records/batch', payload)
+        self.assertEqual(response.status_code, 201)
+        data = json.loads(response.data)
+        self.assertEqual(data['count'], 50)
+        self.assertEqual(Record.query.count(), 52)
+        record = db.session.get(Record, data['ids'][-1])
+        self.assertEqual(record.total_time, 161.5)
+        self.assertEqual([(lt.lap_number, lt.time_ms) for lt in record.lap_times], [(1, 80000), (2, 81500)])
+
+    def test_add_records_batch_validates_all_before_writing(self):
+        """1件でも不正な記録があれば何も書き込まないことをテスト"""
+        payload = self.batch_payload([['01:20.000', '01:21.500'], ['1:20', '01:21.500']])
+        response = self.auth_post('/api/records/batch', payload)
+        self.assertEqual(response.status_code, 400)
+        data = json.loads(response.data)
+        self.assertEqual(data['index'], 1)
+        self.assertEqual(Record.query.count(), 2)
+
+    def test_add_record_accepts_string_track_id(self):
+        """main.js はフォームの値をそのまま文字列で送る"""
+        payload = self.batch_payload([['01:20.000', '01:21.500']])['records'][0]
+        payload['track_id'] = str(payload['track_id'])
+        response = self.auth_post('/api/records', payload)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(db.session.get(Record, json.loads(response.data)['id']).track_id, int(payload['track_id']))
+        response = self.auth_post('/api/records/batch', {'records': [payload]})
+        self.assertEqual(response.status_code, 201)
+
+    def test_add_record_invalid_track_id(self):
+        payload = self.batch_payload([['01:20.000', '01:21.500']] * 2)
+        payload['records'][1]['track_id'] = [payload['records'][1]['track_id']]
+        response = self.auth_post('/api/records/batch', payload)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.data)['index'], 1)
+        response = self.auth_post('/api/records', payload['records'][1])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Record.query.count(), 2)
+
     def test_get_records(self):
         response = self.app.get('/api/records', headers={'Authorization': f'Bearer {self.token}'})
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.data)
         self.assertEqual(len(data), 2)
 
+    def count_queries(self, url):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.auth_get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(response.status_code, 200)
+        return len(statements), json.loads(response.data)
+
+    def test_get_records_query_count(self):
+        """記録の件数によらずクエリ数が一定であることをテスト（N+1対策）"""
+        query_count, data = self.count_queries('/api/records')
+        self.assertEqual(len(data), 2)
+
+        user = User.query.filter_by(email='test@example.com').first()
+        record = Record.query.first()
+        for i in range(20):
+            new_record = Record(
+                game_title_id=record.game_title_id,
+                car_model_id=record.car_model_id,
+                track_id=record.track_id,
+                total_time=200.0 + i,
+                created_by=user.id
+            )
+            new_record.lap_times = [
+                LapTime(lap_number=1, time='01:40.000', time_ms=100000),
+                LapTime(lap_number=2, time='01:40.000', time_ms=100000)
+            ]
+            db.session.add(new_record)
+        db.session.commit()
+
+        query_count_large, data = self.count_queries('/api/records')
+        self.assertEqual(len(data), 22)
+        self.assertEqual(query_count_large, query_count)
+        self.assertLessEqual(query_count, 3)
+        self.assertEqual([lt['lap_number'] for lt in data[-1]['lap_times']], [1, 2])
+
+    def test_token_required_uses_user_cache(self):
+        """2回目以降の認証ではユーザーの主キー検索を行わないことをテスト"""
+        from app import user_cache
+        user_cache.clear()
+        first_count, _ = self.count_queries('/api/tracks')
+        second_count, _ = self.count_queries('/api/tracks')
+        self.assertEqual(second_count, first_count - 1)
+
+        # ユーザーが更新されたらキャッシュを破棄する
+        user = User.query.filter_by(email='test@example.com').first()
+        user.email = 'changed@example.com'
+        db.session.commit()
+        third_count, _ = self.count_queries('/api/tracks')
+        self.assertEqual(third_count, first_count)
+
     def test_calculate_total_time(self):
         from app import calculate_total_time
         lap_times = ['01:30.000', '01:31.000']
@@ -339,5 +448,72 @@ class TestGTRSB(unittest.TestCase):
                  },
                  headers={'Authorization': f'Bearer {self.token}'})
 
+class TestPasswordHashing(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        login_throttle._failures.clear()
+        self.original_method = app.config['PASSWORD_HASH_METHOD']
+        self.app.post('/api/register', json={'email': 'hash@example.com', 'password': 'password'})
+
+    def tearDown(self):
+        app.config['PASSWORD_HASH_METHOD'] = self.original_method
+        login_throttle._failures.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, password, email='hash@example.com'):
+        return self.app.post('/api/login', json={'email': email, 'password': password})
+
+    def test_login_rehashes_with_new_method(self):
+        app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        response = self.login('password')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('token', response.json)
+        user = User.query.filter_by(email='hash@example.com').first()
+        db.session.refresh(user)
+        self.assertTrue(user.password_hash.startswith('pbkdf2:sha256:1000$'))
+
+    def test_short_method_name_does_not_rehash(self):
+        user = User.query.filter_by(email='hash@example.com').first()
+        password_hash = user.password_hash
+        # scrypt は scrypt:32768:8:1 に展開して保存されるので、同じ方式として扱う
+        app.config['PASSWORD_HASH_METHOD'] = 'scrypt'
+        self.assertEqual(self.login('password').status_code, 200)
+        db.session.refresh(user)
+        self.assertEqual(user.password_hash, password_hash)
+
+    def test_repeated_failures_are_throttled(self):
+        for _ in range(app.config['LOGIN_FAILURE_LIMIT_PER_EMAIL']):
+            self.assertEqual(self.login('wrongpassword').status_code, 401)
+        response = self.login('password')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+
+    def test_failures_of_other_emails_from_same_address_do_not_lock_out(self):
+        # プロキシの内側では全員が同じ IP になるので、他の人の失敗でログインできなくならない
+        for i in range(4):
+            for _ in range(app.config['LOGIN_FAILURE_LIMIT_PER_EMAIL']):
+                self.login('wrongpassword', email=f'other{i}@example.com')
+        self.assertEqual(self.login('wrongpassword', email='another@example.com').status_code, 401)
+        self.assertEqual(self.login('password').status_code, 200)
+
+    def test_full_queue_rejects_with_429(self):
+        acquired = 0
+        while password_hasher._slots.acquire(blocking=False):
+            acquired += 1
+        try:
+            response = self.login('password')
+            with self.assertRaises(PasswordHasherBusy):
+                password_hasher.hash('password')
+        finally:
+            for _ in range(acquired):
+                password_hasher._slots.release()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.login('password').status_code, 200)
+
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
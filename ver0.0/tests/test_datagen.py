@@ -0,0 +1,54 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import unittest
+import shutil
+import sqlite3
+import tempfile
+from benchmarks.datagen import build_fixture
+
+class TestFixtureGenerator(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def build(self, cache, **params):
+        return build_fixture(laps=3000, combos=6, cache_dir=os.path.join(self.tmpdir, cache), **params)
+
+    def test_fixture_is_deterministic_and_cached(self):
+        first, second = self.build('a', seed=5), self.build('b', seed=5)
+        mtime = os.path.getmtime(first)
+        # 同じ引数なら同じ名前で、キャッシュにあれば作り直さない
+        self.assertEqual(os.path.basename(first), os.path.basename(second))
+        self.assertEqual(self.build('a', seed=5), first)
+        self.assertEqual(os.path.getmtime(first), mtime)
+        self.assertNotEqual(self.build('a', seed=6), first)
+
+        def dump(path):
+            with sqlite3.connect(path) as conn:
+                return (conn.execute('SELECT * FROM record ORDER BY id').fetchall(),
+                        conn.execute('SELECT * FROM lap_time ORDER BY id').fetchall())
+        self.assertEqual(dump(first), dump(second))
+
+    def test_records_have_one_lap_per_track_lap(self):
+        with sqlite3.connect(self.build('a')) as conn:
+            self.assertGreaterEqual(conn.execute('SELECT COUNT(*) FROM lap_time').fetchone()[0], 3000)
+            mismatched = conn.execute('''
+                SELECT COUNT(*) FROM record
+                JOIN track ON track.id = record.track_id
+                WHERE track.lap_count != (SELECT COUNT(*) FROM lap_time WHERE lap_time.record_id = record.id)
+            ''').fetchone()[0]
+            self.assertEqual(mismatched, 0)
+            # 合計タイムはラップタイムの和と一致する
+            total, laps = conn.execute('''
+                SELECT record.total_time, SUM(lap_time.time_ms) FROM record
+                JOIN lap_time ON lap_time.record_id = record.id
+                GROUP BY record.id LIMIT 1
+            ''').fetchone()
+            self.assertAlmostEqual(total, laps / 1000)
+
+if __name__ == '__main__':
+    unittest.main()
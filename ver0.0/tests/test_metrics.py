@@ -0,0 +1,156 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import unittest
+import re
+import shutil
+import tempfile
+from unittest import mock
+from sqlalchemy import event
+from app import app, db, metrics, MetricsRegistry, HealthProber, format_labels, fcntl
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        with app.app_context():
+            db.create_all()
+
+    def sample(self, text, name, **labels):
+        """出力からラベルが一致する行の値を取り出す"""
+        for line in text.splitlines():
+            match = re.match(rf'^{re.escape(name)}(?:{{(.*)}})? (\S+)$', line)
+            if match and all(f'{k}="{v}"' in (match.group(1) or '') for k, v in labels.items()):
+                return float(match.group(2))
+        return None
+
+    def test_metrics_exposes_request_and_query_counts(self):
+        before = self.client.get('/metrics').get_data(as_text=True)
+        self.client.get('/api/health')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+        text = response.get_data(as_text=True)
+
+        labels = {'method': 'GET', 'endpoint': '/api/health', 'status': '200'}
+        self.assertEqual(self.sample(text, 'http_requests_total', **labels),
+                         (self.sample(before, 'http_requests_total', **labels) or 0) + 1)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', text)
+        self.assertIsNotNone(self.sample(text, 'http_request_duration_seconds_bucket',
+                                         endpoint='/api/health', le='+Inf'))
+        self.assertGreater(self.sample(text, 'db_queries_total', endpoint='/api/health'), 0)
+
+    def test_unmatched_urls_share_one_label(self):
+        self.client.get('/no/such/page/1')
+        self.client.get('/no/such/page/2')
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertNotIn('/no/such/page', text)
+        self.assertIsNotNone(self.sample(text, 'http_requests_total', endpoint='unmatched', status='404'))
+
+    def test_histogram_buckets_are_cumulative(self):
+        registry = MetricsRegistry()
+        registry.describe('latency_seconds', 'histogram', 'テスト', buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            registry.observe('latency_seconds', value)
+        text = registry.render()
+        self.assertIn('latency_seconds_bucket{le="0.1"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 3', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 4', text)
+        self.assertIn('latency_seconds_count 4', text)
+
+    def test_label_values_are_escaped(self):
+        self.assertEqual(format_labels({'path': 'a"b\\c\n'}), '{path="a\\"b\\\\c\\n"}')
+
+class TestQueryTiming(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        with app.app_context():
+            db.create_all()
+        self.threshold = app.config['SLOW_QUERY_THRESHOLD_MS']
+
+    def tearDown(self):
+        app.config['SLOW_QUERY_THRESHOLD_MS'] = self.threshold
+
+    def test_server_timing_reports_query_count(self):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.client.get('/api/health')
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+        timings = response.headers.getlist('Server-Timing')
+        self.assertEqual(len(timings), 2)
+        match = re.match(r'^db;desc="(\d+) queries";dur=[\d.]+$', timings[0])
+        self.assertIsNotNone(match, timings[0])
+        self.assertEqual(int(match.group(1)), len(statements))
+        self.assertRegex(timings[1], r'^app;dur=[\d.]+$')
+
+    def test_slow_queries_are_logged_with_route(self):
+        app.config['SLOW_QUERY_THRESHOLD_MS'] = 0
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            self.client.get('/api/health')
+        self.assertTrue(any('遅いクエリ' in line and '[GET /api/health]' in line and 'SELECT 1' in line
+                            for line in logs.output))
+
+    def test_fast_queries_are_not_logged(self):
+        app.config['SLOW_QUERY_THRESHOLD_MS'] = 60000
+        with mock.patch.object(app.logger, 'warning') as warning:
+            self.client.get('/api/health')
+        warning.assert_not_called()
+
+class TestHealthProber(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.lock_path = os.path.join(self.tmpdir, 'health_probe.lock')
+        self.probers = []
+
+    def tearDown(self):
+        for prober in self.probers:
+            if prober._lock_file:
+                prober._lock_file.close()
+        shutil.rmtree(self.tmpdir)
+
+    def create_prober(self):
+        prober = HealthProber(3600, self.lock_path)
+        self.probers.append(prober)
+        return prober
+
+    @unittest.skipIf(fcntl is None, 'ファイルロックが使えない環境です')
+    def test_only_one_prober_per_lock_file(self):
+        first, second = self.create_prober(), self.create_prober()
+        with mock.patch('threading.Thread.start'):
+            self.assertTrue(first.start())
+            self.assertFalse(second.start())
+        self.assertTrue(first.running)
+        self.assertFalse(second.running)
+
+    def test_check_records_status_and_metrics(self):
+        prober = self.create_prober()
+        self.assertTrue(prober.check())
+        self.assertEqual(prober.status()['database_status'], 'healthy')
+        self.assertEqual(metrics.value('health_probe_up'), 1)
+
+        failures = metrics.value('health_probe_failures_total') or 0
+        with mock.patch('app.check_database', side_effect=RuntimeError('down')):
+            self.assertFalse(prober.check())
+        self.assertEqual(prober.status()['database_status'], 'unhealthy')
+        self.assertEqual(prober.status()['error_count'], 1)
+        self.assertEqual(metrics.value('health_probe_up'), 0)
+        self.assertEqual(metrics.value('health_probe_failures_total'), failures + 1)
+
+    def test_diagnostic_checks_inline_without_prober(self):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = 1
+        response = client.get('/api/diagnostic')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['database_status'], 'healthy')
+        self.assertIsNotNone(response.json['last_check'])
+
+if __name__ == '__main__':
+    unittest.main()
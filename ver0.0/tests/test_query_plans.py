@@ -0,0 +1,108 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import unittest
+import re
+import sqlite3
+from sqlalchemy import event
+from app import app, db
+from benchmarks.datagen import build_fixture
+
+# 検証に使う合成データの規模（QUERY_PLAN_FIXTURE_LAPS=10000000 などで大きくできる）
+FIXTURE_LAPS = int(os.environ.get('QUERY_PLAN_FIXTURE_LAPS', 100000))
+# 件数が増え続けるテーブル。これらを全件走査するプランは不合格とする
+GROWING_TABLES = ('record', 'lap_time')
+
+class TestQueryPlans(unittest.TestCase):
+    """主要なAPIが発行するSELECTの実行計画を大きなフィクスチャ上で確かめる
+
+    テスト用のデータベースで実際にAPIを呼んでSQLを記録し、同じスキーマのフィクスチャに対して
+    EXPLAIN QUERY PLAN を実行する。インデックスが使われなくなると全件走査（SCAN）になり失敗する。
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fixture = sqlite3.connect(build_fixture(laps=FIXTURE_LAPS))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fixture.close()
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client.post('/api/register', json={'email': 'plan@example.com', 'password': 'password'})
+        login = self.client.post('/api/login', json={'email': 'plan@example.com', 'password': 'password'}).json
+        self.token, self.user_id = login['token'], login['id']
+        self.game_title_id = self.auth_post('/api/game-titles', {'name': 'Plan Game'}).json['game_title_id']
+        self.car_model_id = self.auth_post('/api/car-models', {'name': 'Plan Car'}).json['id']
+        self.track_id = self.auth_post('/api/tracks', {'name': 'Plan Track', 'lap_count': 2}).json['id']
+        self.auth_post('/api/records', {
+            'game_title_id': self.game_title_id,
+            'car_model_id': self.car_model_id,
+            'track_id': self.track_id,
+            'lap_times': ['01:30.000', '01:29.500']
+        })
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def auth_post(self, url, json_data):
+        return self.client.post(url, json=json_data, headers={'Authorization': f'Bearer {self.token}'})
+
+    def capture_selects(self, method, url, **kwargs):
+        """リクエスト中に発行されたSELECTと、そのパラメータを返す"""
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+                statements.append((statement, parameters))
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.client.open(url, method=method, **kwargs)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertLess(response.status_code, 400, response.get_data(as_text=True))
+        return statements
+
+    def assert_no_full_scan(self, method, url, touches, **kwargs):
+        """touches のテーブルを読むクエリがあり、どのプランも増え続けるテーブルを全件走査しないこと"""
+        statements = self.capture_selects(method, url, **kwargs)
+        self.assertTrue(any(re.search(rf'\b{touches}\b', statement) for statement, _ in statements),
+                        f'{url} で {touches} を読むクエリが発行されていません')
+        full_scan = re.compile(rf'^SCAN ({"|".join(GROWING_TABLES)})(?: AS \w+)?$')
+        # 索引を端から読んでも、並べ替え直すなら全件を読むのと変わらない
+        index_scan = re.compile(rf'^SCAN ({"|".join(GROWING_TABLES)})(?: AS \w+)? USING (COVERING )?INDEX')
+        for statement, parameters in statements:
+            plan = [row[3] for row in self.fixture.execute(f'EXPLAIN QUERY PLAN {statement}', parameters)]
+            scans = [line for line in plan if full_scan.match(line)
+                     or ('USE TEMP B-TREE FOR ORDER BY' in plan and index_scan.match(line))]
+            self.assertFalse(scans, f'{url} のクエリが全件走査になっています:\n{statement}\n' + '\n'.join(plan))
+
+    def auth_headers(self):
+        return {'headers': {'Authorization': f'Bearer {self.token}'}}
+
+    def test_login_looks_up_email_by_index(self):
+        statements = self.capture_selects('POST', '/api/login',
+                                          json={'email': 'plan@example.com', 'password': 'password'})
+        lookup = next(s for s in statements if re.search(r'WHERE "?user"?\.email = \?', s[0]))
+        plan = [row[3] for row in self.fixture.execute(f'EXPLAIN QUERY PLAN {lookup[0]}', lookup[1])]
+        self.assertTrue(any(line.startswith('SEARCH user USING') for line in plan), plan)
+
+    def test_records_by_track(self):
+        self.assert_no_full_scan('GET', f'/api/records?track_id={self.track_id}', 'record', **self.auth_headers())
+
+    def test_records_by_combo(self):
+        url = (f'/api/records?game_title_id={self.game_title_id}&car_model_id={self.car_model_id}'
+               f'&track_id={self.track_id}')
+        self.assert_no_full_scan('GET', url, 'record', **self.auth_headers())
+
+    def test_records_by_user(self):
+        self.assert_no_full_scan('GET', f'/api/records?user_id={self.user_id}', 'record', **self.auth_headers())
+
+if __name__ == '__main__':
+    unittest.main()
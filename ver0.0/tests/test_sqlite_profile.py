@@ -0,0 +1,86 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import unittest
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+from app import app, set_sqlite_pragmas, SQLITE_PROFILES
+
+class TestSQLiteProfile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.engines = []
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def create_engine(self, name):
+        engine = create_engine(f"sqlite:///{os.path.join(self.tmpdir, name)}")
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+        self.engines.append(engine)
+        with engine.begin() as conn:
+            conn.execute(text('CREATE TABLE lap (id INTEGER PRIMARY KEY, time_ms INTEGER)'))
+            conn.execute(text('INSERT INTO lap (time_ms) VALUES (90000)'))
+        return engine
+
+    def read_during_exclusive_write(self, engine):
+        """書き込みトランザクション中に別スレッドから読み込み、(件数 または 例外, 所要秒数) を返す"""
+        writer = engine.raw_connection()
+        cursor = writer.cursor()
+        cursor.execute('BEGIN EXCLUSIVE')
+        cursor.execute('INSERT INTO lap (time_ms) VALUES (91000)')
+        result = {}
+
+        def read():
+            start = time.monotonic()
+            try:
+                with engine.connect() as conn:
+                    result['value'] = conn.execute(text('SELECT COUNT(*) FROM lap')).scalar()
+            except OperationalError as e:
+                result['value'] = e
+            result['elapsed'] = time.monotonic() - start
+
+        try:
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join(timeout=10)
+        finally:
+            cursor.execute('COMMIT')
+            writer.close()
+        return result['value'], result['elapsed']
+
+    def test_production_pragmas_applied(self):
+        engine = self.create_engine('pragmas.db')
+        with engine.connect() as conn:
+            self.assertEqual(conn.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(conn.exec_driver_sql('PRAGMA synchronous').scalar(), 1)
+            self.assertEqual(conn.exec_driver_sql('PRAGMA busy_timeout').scalar(), 5000)
+            self.assertEqual(conn.exec_driver_sql('PRAGMA temp_store').scalar(), 2)
+            self.assertEqual(conn.exec_driver_sql('PRAGMA cache_size').scalar(), -65536)
+
+    def test_reads_proceed_while_write_in_flight(self):
+        """WALでは書き込み中でも読み込みが待たされずにコミット前の内容を返す"""
+        engine = self.create_engine('wal.db')
+        value, elapsed = self.read_during_exclusive_write(engine)
+        self.assertEqual(value, 1)
+        self.assertLess(elapsed, 1.0)
+        with engine.connect() as conn:
+            self.assertEqual(conn.execute(text('SELECT COUNT(*) FROM lap')).scalar(), 2)
+
+    def test_default_profile_blocks_reads_during_write(self):
+        """比較用: ロールバックジャーナルでは書き込み中の読み込みがロック待ちになる"""
+        with mock.patch.dict(app.config, {'SQLITE_PRAGMAS': dict(SQLITE_PROFILES['default'], busy_timeout=100)}):
+            engine = self.create_engine('rollback.db')
+            value, _ = self.read_during_exclusive_write(engine)
+        self.assertIsInstance(value, OperationalError)
+
+if __name__ == '__main__':
+    unittest.main()
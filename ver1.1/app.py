@@ -1,20 +1,235 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, make_response, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, login_user, logout_user, login_required, UserMixin, current_user
+from flask_migrate import Migrate, stamp, upgrade
+import click
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 from datetime import datetime
 import re
+import json
+import base64
+import binascii
+import math
+import gzip
+import csv
+import io
+from itertools import groupby
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from functools import wraps, lru_cache
+from dataclasses import dataclass
+
+try:
+    import brotli
+except ImportError:  # brotli が無い環境では gzip だけを使う
+    brotli = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_secret_key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///gtr.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///gtr.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# SQLiteの接続プロファイル（SQLITE_PROFILE=default で既定のPRAGMAのまま）
+SQLITE_PROFILES = {
+    'production': {
+        'busy_timeout': 5000,
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 268435456,
+        'cache_size': -65536,
+        'temp_store': 'MEMORY',
+    },
+    'default': {},
+}
+app.config['SQLITE_PRAGMAS'] = SQLITE_PROFILES[os.environ.get('SQLITE_PROFILE', 'production')]
+
 db = SQLAlchemy(app)
+migrate = Migrate(app, db, directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations'))
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """新しいSQLite接続ごとにプロファイルのPRAGMAを設定"""
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', set_sqlite_pragmas)
+
 login_manager = LoginManager(app)
 login_manager.login_view = 'index'
 
+class TTLCache:
+    """件数上限と有効期限付きのスレッドセーフなLRUキャッシュ"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """(見つかったか, 値) を返す"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value, generation=None):
+        """generation を渡した場合、その後に clear されていれば保存しない"""
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+# ゲームタイトル・車種・コースの一覧はほとんど変わらないためプロセス内にキャッシュする
+# （他のワーカーでの追加は TTL 経過後に反映される）
+app.config.setdefault('CATALOG_CACHE_SIZE', 256)
+app.config.setdefault('CATALOG_CACHE_TTL', int(os.environ.get('CATALOG_CACHE_TTL', 60)))
+catalog_cache = TTLCache(app.config['CATALOG_CACHE_SIZE'], app.config['CATALOG_CACHE_TTL'])
+
+# パスワードハッシュの設定（変更するとログイン時に新しい設定で再ハッシュされる）
+app.config.setdefault('PASSWORD_HASH_METHOD', os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1'))
+app.config.setdefault('PASSWORD_HASH_WORKERS', int(os.environ.get('PASSWORD_HASH_WORKERS', 2)))
+app.config.setdefault('PASSWORD_HASH_QUEUE_DEPTH', int(os.environ.get('PASSWORD_HASH_QUEUE_DEPTH', 16)))
+app.config.setdefault('LOGIN_FAILURE_WINDOW', 300)
+app.config.setdefault('LOGIN_FAILURE_LIMIT_PER_EMAIL', 5)
+# 試行の制限は主にメールアドレスごとに行う。IP ごとの上限は多数のアドレスを試す攻撃への備えで、
+# 同じ NAT やプロキシの内側の利用者が巻き込まれないよう大きめにしてある
+app.config.setdefault('LOGIN_FAILURE_LIMIT_PER_IP', 100)
+# nginx などのリバースプロキシの段数。1以上なら X-Forwarded-For からクライアントの IP を取る
+# （プロキシを通さずに公開している場合に設定すると IP を偽装できるので 0 のままにする）
+app.config.setdefault('TRUSTED_PROXY_COUNT', int(os.environ.get('TRUSTED_PROXY_COUNT', 0)))
+if app.config['TRUSTED_PROXY_COUNT'] > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXY_COUNT'],
+                            x_proto=app.config['TRUSTED_PROXY_COUNT'])
+
+class PasswordHasherBusy(Exception):
+    """ハッシュ計算の待ち行列が埋まっている"""
+
+class PasswordHasher:
+    """パスワードハッシュの計算を上限付きのスレッドプールで行う"""
+
+    def __init__(self, workers, queue_depth):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        # 実行中と待機中を合わせた件数の上限
+        self._slots = threading.BoundedSemaphore(workers + queue_depth)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    @staticmethod
+    def needs_rehash(password_hash):
+        return password_hash.split('$', 1)[0] != password_hash_prefix(app.config['PASSWORD_HASH_METHOD'])
+
+@lru_cache(maxsize=None)
+def password_hash_prefix(method):
+    """設定した方式で作られるハッシュの先頭部分を返す（scrypt なら scrypt:32768:8:1 に展開される）"""
+    return generate_password_hash('', method).split('$', 1)[0]
+
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_QUEUE_DEPTH'])
+
+class LoginThrottle:
+    """ログイン失敗回数をキーごとにスライディングウィンドウで数える"""
+
+    def __init__(self, window):
+        self.window = window
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def _recent(self, key, now):
+        failures = self._failures.get(key)
+        if failures is None:
+            return None
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        if not failures:
+            del self._failures[key]
+            return None
+        return failures
+
+    def retry_after(self, key, limit):
+        """上限に達していれば再試行可能になるまでの秒数、そうでなければ 0 を返す"""
+        now = time.monotonic()
+        with self._lock:
+            failures = self._recent(key, now)
+            if failures is None or len(failures) < limit:
+                return 0
+            return max(1, math.ceil(failures[0] + self.window - now))
+
+    def add_failure(self, key):
+        now = time.monotonic()
+        with self._lock:
+            failures = self._recent(key, now)
+            if failures is None:
+                failures = self._failures[key] = deque()
+            failures.append(now)
+
+    def reset(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+
+login_throttle = LoginThrottle(app.config['LOGIN_FAILURE_WINDOW'])
+
+def login_throttle_keys(email):
+    return [
+        (('email', str(email).lower()), app.config['LOGIN_FAILURE_LIMIT_PER_EMAIL']),
+        (('ip', request.remote_addr), app.config['LOGIN_FAILURE_LIMIT_PER_IP']),
+    ]
+
+def too_many_requests(message, retry_after):
+    response = jsonify({'error': message})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True)
@@ -25,10 +240,10 @@ class User(UserMixin, db.Model):
     lap_times = db.relationship('LapTime', backref='user', lazy=True)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
 
 class GameTitle(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -39,14 +254,14 @@ class GameTitle(db.Model):
 class Car(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True, nullable=False)
-    game_title_id = db.Column(db.Integer, db.ForeignKey('game_title.id'), nullable=False)
+    game_title_id = db.Column(db.Integer, db.ForeignKey('game_title.id'), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     lap_times = db.relationship('LapTime', backref='car', lazy=True)
 
 class Course(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True, nullable=False)
-    game_title_id = db.Column(db.Integer, db.ForeignKey('game_title.id'), nullable=False)
+    game_title_id = db.Column(db.Integer, db.ForeignKey('game_title.id'), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     lap_times = db.relationship('LapTime', backref='course', lazy=True)
 
@@ -57,12 +272,241 @@ class LapTime(db.Model):
     car_id = db.Column(db.Integer, db.ForeignKey('car.id'), nullable=False)
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
     time = db.Column(db.String(20), nullable=False)
+    # ソートや集計用にミリ秒単位の整数でも保持する
+    time_ms = db.Column(db.Integer)
     memo = db.Column(db.Text)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
+    # 一覧は新しい順（created_at, id の降順）が既定のため、絞り込み条件ごとに created_at で終わる索引を持つ。
+    # タイム順は組み合わせ内と全体の2通り。id は SQLite の索引に暗黙に含まれるので、
+    # (ソートキー, id) のカーソルもそのまま索引で辿れる
+    __table_args__ = (
+        db.Index('ix_lap_time_course_car_time_ms', 'course_id', 'car_id', 'time_ms'),
+        db.Index('ix_lap_time_course_car_created_at', 'course_id', 'car_id', 'created_at'),
+        db.Index('ix_lap_time_user_created_at', 'user_id', 'created_at'),
+        db.Index('ix_lap_time_game_title_created_at', 'game_title_id', 'created_at'),
+        db.Index('ix_lap_time_created_at', 'created_at'),
+        db.Index('ix_lap_time_time_ms', 'time_ms'),
+    )
+
+class PersonalBest(db.Model):
+    """ユーザーごとの (コース, 車種) 別ベストラップ。LapTime の追加・削除と同じトランザクションで更新する"""
+    __tablename__ = 'personal_best'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), primary_key=True)
+    car_id = db.Column(db.Integer, db.ForeignKey('car.id'), primary_key=True)
+    lap_time_id = db.Column(db.Integer, db.ForeignKey('lap_time.id'), nullable=False)
+    time_ms = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_personal_best_course_car_time_ms', 'course_id', 'car_id', 'time_ms'),
+    )
+
+def record_personal_best(lap_time):
+    """追加されたラップが自己ベストなら PersonalBest を更新する（flush 済みの LapTime を渡す）"""
+    record_personal_bests([lap_time])
+
+def record_personal_bests(lap_times):
+    """record_personal_best の複数件版。1つの文を executemany でまとめて実行する"""
+    params = [{
+        'user_id': lap_time.user_id,
+        'course_id': lap_time.course_id,
+        'car_id': lap_time.car_id,
+        'lap_time_id': lap_time.id,
+        'time_ms': lap_time.time_ms
+    } for lap_time in lap_times if lap_time.time_ms is not None]
+    if not params:
+        return
+    stmt = sqlite_insert(PersonalBest)
+    # 既存の記録より速い場合のみ置き換える
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'course_id', 'car_id'],
+        set_={'lap_time_id': stmt.excluded.lap_time_id, 'time_ms': stmt.excluded.time_ms},
+        where=stmt.excluded.time_ms < PersonalBest.time_ms
+    )
+    db.session.execute(stmt, params)
+
+def remove_personal_best(lap_time):
+    """削除されるラップが自己ベストなら、次に速いラップへ PersonalBest を差し替える"""
+    personal_best = db.session.get(PersonalBest, (lap_time.user_id, lap_time.course_id, lap_time.car_id))
+    if personal_best is None or personal_best.lap_time_id != lap_time.id:
+        return
+    next_best = LapTime.query.filter(
+        LapTime.user_id == lap_time.user_id,
+        LapTime.course_id == lap_time.course_id,
+        LapTime.car_id == lap_time.car_id,
+        LapTime.time_ms.isnot(None),
+        LapTime.id != lap_time.id
+    ).order_by(LapTime.time_ms, LapTime.id).first()
+    if next_best is None:
+        db.session.delete(personal_best)
+    else:
+        personal_best.lap_time_id = next_best.id
+        personal_best.time_ms = next_best.time_ms
+
+class LapTimeChange(db.Model):
+    """ラップタイムの追加・削除の履歴。seq は単調増加で再利用されない"""
+    __tablename__ = 'lap_time_change'
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = db.Column(db.Integer, primary_key=True)
+    lap_time_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(6), nullable=False)  # 'insert' または 'delete'
+
+def log_lap_time_change(lap_time_id, op):
+    """変更履歴を追記する（書き込みと同じトランザクション内で呼ぶ）"""
+    db.session.add(LapTimeChange(lap_time_id=lap_time_id, op=op))
+
+class TableVersion(db.Model):
+    """テーブルごとの更新回数。読み込みAPIの ETag に使う"""
+    __tablename__ = 'table_version'
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+def bump_table_version(name):
+    """テーブルの版数を進める（書き込みと同じトランザクション内で呼ぶ）"""
+    stmt = sqlite_insert(TableVersion).values(name=name, version=1)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['name'],
+        set_={'version': TableVersion.version + 1}
+    )
+    db.session.execute(stmt)
+
+def table_versions_query(tables):
+    """指定テーブルの (名前, 版数) を読むクエリ"""
+    return db.select(TableVersion.name, TableVersion.version).where(TableVersion.name.in_(tables))
+
+def table_versions_etag(tables, versions):
+    """テーブルの版数から ETag を作る（まだ書き込みの無いテーブルは 0）"""
+    return '-'.join(f'{name}.{versions.get(name, 0)}' for name in tables)
+
+def set_conditional_headers(response, etag):
+    response.set_etag(etag, weak=True)
+    # ブラウザには保存させつつ毎回再検証させる
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def conditional_response(*tables):
+    """指定テーブルの版数から ETag を作り、If-None-Match が一致すれば 304 を返すデコレーター"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            etag = table_versions_etag(tables, dict(db.session.execute(table_versions_query(tables)).all()))
+            if request.if_none_match.contains_weak(etag):
+                response = app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            return set_conditional_headers(response, etag)
+        return decorated
+    return decorator
+
+def catalog_response(table, endpoint, game_title_id, load):
+    """カタログ一覧をキャッシュから返す。ETag は一覧と一緒にキャッシュした版数から作る
+
+    キャッシュに当たれば SQLite を読まない。一覧と ETag は同じ時点のものなので、
+    他のワーカーで追加があっても古い一覧が新しい ETag で返ることはない（TTL 経過後に反映される）。
+    """
+    key = (endpoint, game_title_id)
+    found, value = catalog_cache.get(key)
+    if not found:
+        # 読み込み中に追加があった場合は古い一覧をキャッシュしない
+        generation = catalog_cache.generation
+        # 版数を先に読む。間に追加があっても ETag が一覧より古くなるだけで、次の再検証で取り直される
+        etag = table_versions_etag((table,), dict(db.session.execute(table_versions_query((table,))).all()))
+        value = (etag, load())
+        catalog_cache.set(key, value, generation)
+    etag, body = value
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(body)
+    return set_conditional_headers(response, etag)
+
+# レスポンス圧縮の設定（COMPRESS_MIN_SIZE バイト未満は圧縮しない）
+app.config.setdefault('COMPRESS_MIN_SIZE', 1024)
+app.config.setdefault('COMPRESS_GZIP_LEVEL', 6)
+app.config.setdefault('COMPRESS_BROTLI_QUALITY', 5)
+COMPRESSIBLE_MIMETYPES = ('application/json',)
+
+@app.after_request
+def compress_response(response):
+    """Accept-Encoding に応じて JSON レスポンスを brotli / gzip で圧縮する"""
+    return compress_json(response, request.accept_encodings)
+
+def compress_json(response, accept_encodings):
+    """compress_response の本体。リクエストの外（ASGI の読み込み経路）からも使う"""
+    if (response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or response.status_code != 200
+            or response.is_streamed
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.content_length is not None and response.content_length < app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    encoding = accept_encodings.best_match(encodings)
+    if encoding is None:
+        return response
+
+    data = response.get_data()
+    if encoding == 'br':
+        data = brotli.compress(data, quality=app.config['COMPRESS_BROTLI_QUALITY'])
+    else:
+        data = gzip.compress(data, compresslevel=app.config['COMPRESS_GZIP_LEVEL'])
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+LAP_TIME_PATTERN = re.compile(r'^(\d{1,2}):(\d{2})\.(\d{3})$')
+
+def parse_lap_time(time_str):
+    """MM:SS.mmm 形式のラップタイムをミリ秒に変換。不正な形式の場合は ValueError"""
+    match = LAP_TIME_PATTERN.match(time_str) if isinstance(time_str, str) else None
+    if not match:
+        raise ValueError('invalid lap time')
+    minutes, seconds, millis = (int(g) for g in match.groups())
+    if seconds >= 60:
+        raise ValueError('invalid lap time')
+    return (minutes * 60 + seconds) * 1000 + millis
+
+def format_lap_time(time_ms):
+    """ミリ秒を M:SS.mmm 形式に変換"""
+    minutes, rest = divmod(time_ms, 60000)
+    seconds, millis = divmod(rest, 1000)
+    return f'{minutes}:{seconds:02d}.{millis:03d}'
+
+@dataclass(frozen=True, eq=False)
+class UserSnapshot(UserMixin):
+    """リクエスト間で共有するための読み取り専用のユーザー情報"""
+    id: int
+    username: str
+    created_at: datetime
+
+# ログイン中のユーザーは毎リクエスト参照されるため主キー検索の結果をキャッシュする
+app.config.setdefault('USER_CACHE_SIZE', 1024)
+app.config.setdefault('USER_CACHE_TTL', int(os.environ.get('USER_CACHE_TTL', 300)))
+user_cache = TTLCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_user_cache(mapper, connection, user):
+    user_cache.delete(user.id)
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    found, snapshot = user_cache.get(user_id)
+    if not found:
+        generation = user_cache.generation
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        snapshot = UserSnapshot(id=user.id, username=user.username, created_at=user.created_at)
+        user_cache.set(user_id, snapshot, generation)
+    return snapshot
 
 @app.route('/')
 def index():
@@ -113,7 +557,10 @@ def register():
         username=username,
         email=email
     )
-    user.set_password(password)
+    try:
+        user.set_password(password)
+    except PasswordHasherBusy:
+        return too_many_requests('混み合っています。しばらくしてから再度お試しください', 1)
     db.session.add(user)
     db.session.commit()
 
@@ -128,11 +575,32 @@ def login():
     if not all([email, password]):
         return jsonify({'error': 'メールアドレスとパスワードを入力してください'}), 400
 
+    # 失敗が続いているメールアドレス・IPはハッシュ計算の前に拒否する
+    throttle_keys = login_throttle_keys(email)
+    retry_after = max(login_throttle.retry_after(key, limit) for key, limit in throttle_keys)
+    if retry_after:
+        return too_many_requests('ログイン試行回数が多すぎます。しばらくしてから再度お試しください', retry_after)
+
     user = User.query.filter_by(email=email).first()
-    if user and user.check_password(password):
+    try:
+        authenticated = user is not None and user.check_password(password)
+    except PasswordHasherBusy:
+        return too_many_requests('混み合っています。しばらくしてから再度お試しください', 1)
+
+    if authenticated:
+        # ハッシュ設定が変わっていれば新しい設定で保存し直す
+        if password_hasher.needs_rehash(user.password_hash):
+            try:
+                user.set_password(password)
+                db.session.commit()
+            except PasswordHasherBusy:
+                pass  # 次回のログイン時に再ハッシュする
+        login_throttle.reset(throttle_keys[0][0])
         login_user(user)
         return jsonify({'message': 'ログインに成功しました'}), 200
 
+    for key, _ in throttle_keys:
+        login_throttle.add_failure(key)
     return jsonify({'error': 'メールアドレスまたはパスワードが正しくありません'}), 401
 
 @app.route('/api/logout')
@@ -149,14 +617,366 @@ def get_user():
         'created_at': current_user.created_at.isoformat()
     })
 
+LAP_TIMES_DEFAULT_LIMIT = 50
+LAP_TIMES_MAX_LIMIT = 500
+# ソートキーごとのキーセット列（いずれも id を第2キーにする）
+LAP_TIMES_SORT_KEYS = {
+    'created_at': LapTime.created_at,
+    '-created_at': LapTime.created_at,
+    'time': LapTime.time_ms,
+    '-time': LapTime.time_ms,
+}
+
+def encode_cursor(sort, key, lap_id):
+    """キーセットページング用のカーソルを不透明な文字列にエンコード"""
+    if isinstance(key, datetime):
+        key = key.isoformat()
+    payload = json.dumps({'s': sort, 'k': [key, lap_id]}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, sort):
+    """カーソルをデコードして (ソートキーの値, id) を返す。不正な場合は ValueError"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        key, lap_id = payload['k']
+        if payload['s'] != sort:
+            raise ValueError('sort mismatch')
+        if sort.lstrip('-') == 'created_at':
+            key = datetime.fromisoformat(key)
+        else:
+            key = int(key)
+        return key, int(lap_id)
+    except (binascii.Error, UnicodeDecodeError, KeyError, TypeError, ValueError) as e:
+        raise ValueError('invalid cursor') from e
+
+LAP_TIME_FILTER_KEYS = ('game_title_id', 'car_id', 'course_id', 'user_id')
+
+def lap_time_filter_values(args):
+    """クエリパラメータからラップタイムの絞り込み値を取り出す"""
+    values = {}
+    for key in LAP_TIME_FILTER_KEYS:
+        value = args.get(key)
+        if value in (None, ''):
+            continue
+        if not value.isdigit():
+            raise ValueError(key)
+        values[key] = int(value)
+    return values
+
+def lap_time_filters(args):
+    """クエリパラメータからラップタイムの絞り込み条件を組み立てる"""
+    return [getattr(LapTime, key) == value for key, value in lap_time_filter_values(args).items()]
+
+# ラップタイム更新のライブ配信（SSE）の設定
+app.config.setdefault('LAP_STREAM_CLIENT_BUFFER', 100)
+app.config.setdefault('LAP_STREAM_REPLAY_SIZE', 500)
+app.config.setdefault('LAP_STREAM_KEEPALIVE', 15)
+
+class LapStreamSubscription:
+    """1クライアント分の未送信イベント（上限付き）"""
+
+    def __init__(self, broker, filters, maxsize):
+        self.broker = broker
+        self.filters = filters
+        self.maxsize = maxsize
+        self.events = deque()
+
+    def matches(self, data):
+        return all(data.get(key) == value for key, value in self.filters.items())
+
+    def push(self, item):
+        if len(self.events) >= self.maxsize:
+            # 追いつけないクライアントは溜まった分を捨て、一覧の再取得を促す
+            self.events.clear()
+            self.events.append((item[0], 'reset', {}))
+        elif self.events and self.events[-1][1] == 'reset':
+            # 再取得を待っている間のイベントは再取得結果に含まれる
+            self.events[-1] = (item[0], 'reset', {})
+        else:
+            self.events.append(item)
+
+    def get(self, timeout):
+        """次のイベントを返す。timeout 秒以内に届かなければ None"""
+        with self.broker.condition:
+            if not self.broker.condition.wait_for(lambda: self.events, timeout):
+                return None
+            return self.events.popleft()
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+class LapEventBroker:
+    """ラップタイムの追加・削除をプロセス内の購読者へ配信する"""
+
+    def __init__(self, replay_size):
+        self.condition = threading.Condition()
+        self._subscribers = set()
+        self._history = deque(maxlen=replay_size)
+        # イベントIDは「起動ごとの識別子-連番」。再起動をまたいだ Last-Event-ID を見分ける
+        self._epoch = format(time.time_ns(), 'x')
+        self._seq = 0
+
+    def _event_id(self, seq):
+        return f'{self._epoch}-{seq}'
+
+    def _parse_event_id(self, event_id):
+        """自分が発行したIDなら連番を、そうでなければ None を返す"""
+        epoch, _, seq = (event_id or '').partition('-')
+        if epoch != self._epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def publish(self, event, data):
+        with self.condition:
+            self._seq += 1
+            item = (self._event_id(self._seq), event, data)
+            self._history.append((self._seq, item))
+            for subscription in self._subscribers:
+                if subscription.matches(data):
+                    subscription.push(item)
+            self.condition.notify_all()
+            return item[0]
+
+    def subscribe(self, filters, maxsize, last_event_id=None, factory=LapStreamSubscription):
+        with self.condition:
+            subscription = factory(self, filters, maxsize)
+            if last_event_id:
+                seq = self._parse_event_id(last_event_id)
+                oldest = self._history[0][0] if self._history else self._seq + 1
+                if seq is None or seq > self._seq or seq < oldest - 1:
+                    # 再起動や履歴切れで欠けがあるので一覧の再取得を促す
+                    subscription.push((self._event_id(self._seq), 'reset', {}))
+                else:
+                    for history_seq, item in self._history:
+                        if history_seq > seq and subscription.matches(item[2]):
+                            subscription.push(item)
+            self._subscribers.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self.condition:
+            self._subscribers.discard(subscription)
+
+    def subscriber_count(self):
+        with self.condition:
+            return len(self._subscribers)
+
+lap_events = LapEventBroker(app.config['LAP_STREAM_REPLAY_SIZE'])
+
+def lap_event_data(lap_time, username):
+    """配信用のラップタイム（一覧APIと同じ形）"""
+    return {
+        'id': lap_time.id,
+        'time': lap_time.time,
+        'time_ms': lap_time.time_ms,
+        'memo': lap_time.memo,
+        'created_at': lap_time.created_at.isoformat(),
+        'game_title_id': lap_time.game_title_id,
+        'car_id': lap_time.car_id,
+        'course_id': lap_time.course_id,
+        'user_id': lap_time.user_id,
+        'username': username
+    }
+
+LAP_STREAM_RETRY = 'retry: 3000\n\n'
+# プロキシに接続を切られないよう定期的に送るコメント行
+LAP_STREAM_KEEPALIVE_COMMENT = ': keepalive\n\n'
+
+def format_lap_event(item):
+    """(イベントID, イベント名, データ) を SSE のメッセージにする"""
+    event_id, event, data = item
+    return f'id: {event_id}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+def lap_stream_events(subscription, keepalive):
+    """購読したイベントを SSE の形式で送り出す"""
+    try:
+        yield LAP_STREAM_RETRY
+        while True:
+            item = subscription.get(keepalive)
+            yield LAP_STREAM_KEEPALIVE_COMMENT if item is None else format_lap_event(item)
+    finally:
+        subscription.close()
+
+def dictionary_encode(values):
+    """値の並びを（重複を除いた値の一覧, 一覧内の位置の並び）に変換する"""
+    index = {}
+    codes = [index.setdefault(value, len(index)) for value in values]
+    return list(index), codes
+
+def columnar_lap_times(laps):
+    """ラップタイムを列ごとの配列にまとめ、ユーザーとカタログのIDは辞書で符号化する"""
+    game_title_ids, game_title_codes = dictionary_encode(lap.game_title_id for lap in laps)
+    car_ids, car_codes = dictionary_encode(lap.car_id for lap in laps)
+    course_ids, course_codes = dictionary_encode(lap.course_id for lap in laps)
+    users, user_codes = dictionary_encode((lap.user_id, lap.username) for lap in laps)
+    return {
+        'lap_times': {
+            'id': [lap.id for lap in laps],
+            'time_ms': [lap.time_ms for lap in laps],
+            'memo': [lap.memo for lap in laps],
+            'created_at': [lap.created_at.isoformat() for lap in laps],
+            'game_title': game_title_codes,
+            'car': car_codes,
+            'course': course_codes,
+            'user': user_codes
+        },
+        'dictionaries': {
+            'game_title_id': game_title_ids,
+            'car_id': car_ids,
+            'course_id': course_ids,
+            'user_id': [user_id for user_id, _ in users],
+            'username': [username for _, username in users]
+        }
+    }
+
+def lap_times_query(args):
+    """一覧APIのクエリパラメータから (SELECT文, sort, limit, format) を組み立てる
+
+    パラメータが不正な場合はエラーメッセージ付きの ValueError。
+    """
+    try:
+        filters = lap_time_filters(args)
+    except ValueError as e:
+        raise ValueError(f'{e}の指定が正しくありません') from e
+
+    sort = args.get('sort', '-created_at')
+    if sort not in LAP_TIMES_SORT_KEYS:
+        raise ValueError('sortの指定が正しくありません')
+    sort_column = LAP_TIMES_SORT_KEYS[sort]
+    if sort_column is LapTime.time_ms:
+        # 移行時に解釈できなかった古いタイムは time_ms が NULL。タイム順には並べられないので除く
+        filters.append(LapTime.time_ms.isnot(None))
+
+    response_format = args.get('format', 'objects')
+    if response_format not in ('objects', 'columnar'):
+        raise ValueError('formatの指定が正しくありません')
+
+    limit = args.get('limit', LAP_TIMES_DEFAULT_LIMIT, type=int)
+    if limit < 1:
+        raise ValueError('limitは1以上を指定してください')
+    limit = min(limit, LAP_TIMES_MAX_LIMIT)
+
+    cursor = args.get('cursor')
+    if cursor:
+        try:
+            cursor_key, cursor_id = decode_cursor(cursor, sort)
+        except ValueError as e:
+            raise ValueError('cursorが不正です') from e
+        # (ソートキー, id) の行値比較で前回の続きから取得する。
+        # OR で書くと SQLite は索引の範囲検索にできず、先頭から読み飛ばすことになる
+        if sort.startswith('-'):
+            filters.append(db.tuple_(sort_column, LapTime.id) < (cursor_key, cursor_id))
+        else:
+            filters.append(db.tuple_(sort_column, LapTime.id) > (cursor_key, cursor_id))
+
+    if sort.startswith('-'):
+        order = (sort_column.desc(), LapTime.id.desc())
+    else:
+        order = (sort_column.asc(), LapTime.id.asc())
+
+    # 次ページの有無を判定するため1件多く取得する
+    query = db.select(
+        LapTime.id,
+        LapTime.time,
+        LapTime.time_ms,
+        LapTime.memo,
+        LapTime.created_at,
+        LapTime.game_title_id,
+        LapTime.car_id,
+        LapTime.course_id,
+        LapTime.user_id,
+        User.username
+    ).join(User, LapTime.user_id == User.id).where(*filters).order_by(*order).limit(limit + 1)
+    return query, sort, limit, response_format
+
+def lap_times_body(laps, sort, limit, response_format):
+    """lap_times_query の結果（limit + 1 件まで）から一覧APIのレスポンスを作る"""
+    next_cursor = None
+    if len(laps) > limit:
+        laps = laps[:limit]
+        last = laps[-1]
+        next_cursor = encode_cursor(sort, last.time_ms if LAP_TIMES_SORT_KEYS[sort] is LapTime.time_ms
+                                    else last.created_at, last.id)
+
+    if response_format == 'columnar':
+        body = columnar_lap_times(laps)
+        body['next_cursor'] = next_cursor
+        return body
+
+    return {
+        'lap_times': [{
+            'id': lap.id,
+            'time': lap.time,
+            'time_ms': lap.time_ms,
+            'memo': lap.memo,
+            'created_at': lap.created_at.isoformat(),
+            'game_title_id': lap.game_title_id,
+            'car_id': lap.car_id,
+            'course_id': lap.course_id,
+            'user_id': lap.user_id,
+            'username': lap.username
+        } for lap in laps],
+        'next_cursor': next_cursor
+    }
+
 @app.route('/api/lap-times', methods=['GET'])
 @login_required
+@conditional_response('lap_time')
 def get_lap_times():
     try:
-        # すべてのラップタイムを取得（ユーザーIDでフィルタリングしない）
-        laps = LapTime.query.join(User).add_columns(
+        query, sort, limit, response_format = lap_times_query(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        laps = db.session.execute(query).all()
+        return jsonify(lap_times_body(laps, sort, limit, response_format))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+LAP_CHANGES_DEFAULT_LIMIT = 1000
+LAP_CHANGES_MAX_LIMIT = 5000
+LAP_CHANGES_COLUMNS = ('id', 'time', 'time_ms', 'memo', 'created_at', 'game_title_id',
+                       'car_id', 'course_id', 'user_id', 'username')
+
+@app.route('/api/lap-times/changes', methods=['GET'])
+@login_required
+@conditional_response('lap_time')
+def get_lap_time_changes():
+    since = request.args.get('since', '0')
+    if not since.isdigit():
+        return jsonify({'error': 'sinceの指定が正しくありません'}), 400
+    since = int(since)
+
+    limit = request.args.get('limit', LAP_CHANGES_DEFAULT_LIMIT, type=int)
+    if limit < 1:
+        return jsonify({'error': 'limitは1以上を指定してください'}), 400
+    limit = min(limit, LAP_CHANGES_MAX_LIMIT)
+
+    latest = db.session.query(db.func.max(LapTimeChange.seq)).scalar() or 0
+    if since > latest:
+        # 別のデータベースの seq を持っているので全件から取り直してもらう
+        return jsonify({'error': 'sinceが最新の変更より新しいため、全件を取得し直してください', 'latest': latest}), 410
+
+    changes = db.session.query(
+        LapTimeChange.seq, LapTimeChange.lap_time_id, LapTimeChange.op
+    ).filter(LapTimeChange.seq > since).order_by(LapTimeChange.seq).limit(limit + 1).all()
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+
+    # 同じラップタイムへの変更は最後のものだけ返す
+    last_op = {}
+    for change in changes:
+        last_op[change.lap_time_id] = change.op
+    inserted_ids = [lap_id for lap_id, op in last_op.items() if op == 'insert']
+
+    rows = []
+    if inserted_ids:
+        laps = db.session.query(
             LapTime.id,
             LapTime.time,
+            LapTime.time_ms,
             LapTime.memo,
             LapTime.created_at,
             LapTime.game_title_id,
@@ -164,21 +984,96 @@ def get_lap_times():
             LapTime.course_id,
             LapTime.user_id,
             User.username
-        ).order_by(LapTime.created_at.desc()).all()
+        ).join(User, LapTime.user_id == User.id).filter(LapTime.id.in_(inserted_ids)).order_by(LapTime.id).all()
+        rows = [[lap.id, lap.time, lap.time_ms, lap.memo, lap.created_at.isoformat(), lap.game_title_id,
+                 lap.car_id, lap.course_id, lap.user_id, lap.username] for lap in laps]
 
-        return jsonify([{
-            'id': lap.id,
-            'time': lap.time,
-            'memo': lap.memo,
-            'created_at': lap.created_at.isoformat(),
-            'game_title_id': lap.game_title_id,
-            'car_id': lap.car_id,
-            'course_id': lap.course_id,
-            'user_id': lap.user_id,
-            'username': lap.username
-        } for lap in laps])
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    return jsonify({
+        'since': changes[-1].seq if changes else since,
+        'has_more': has_more,
+        'columns': LAP_CHANGES_COLUMNS,
+        'upserts': rows,
+        'deleted': [lap_id for lap_id, op in last_op.items() if op == 'delete']
+    })
+
+@app.route('/api/lap-times/stream', methods=['GET'])
+@login_required
+def stream_lap_times():
+    try:
+        filters = lap_time_filter_values(request.args)
+    except ValueError as e:
+        return jsonify({'error': f'{e}の指定が正しくありません'}), 400
+
+    # EventSource の再接続時はヘッダー、ページ再読み込み時はクエリで続きの位置を受け取る
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    subscription = lap_events.subscribe(filters, app.config['LAP_STREAM_CLIENT_BUFFER'], last_event_id)
+    response = Response(lap_stream_events(subscription, app.config['LAP_STREAM_KEEPALIVE']),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+EXPORT_CHUNK_ROWS = 1000
+EXPORT_COLUMNS = ('id', 'time', 'time_ms', 'memo', 'created_at', 'game_title_id', 'game_title',
+                  'car_id', 'car', 'course_id', 'course', 'user_id', 'username')
+EXPORT_MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+def export_lap_chunks(filters):
+    """絞り込んだラップタイムをサーバー側カーソルから EXPORT_CHUNK_ROWS 件ずつ読み出す"""
+    query = db.select(
+        LapTime.id,
+        LapTime.time,
+        LapTime.time_ms,
+        LapTime.memo,
+        LapTime.created_at,
+        LapTime.game_title_id,
+        GameTitle.name,
+        LapTime.car_id,
+        Car.name,
+        LapTime.course_id,
+        Course.name,
+        LapTime.user_id,
+        User.username
+    ).join(GameTitle, LapTime.game_title_id == GameTitle.id) \
+     .join(Car, LapTime.car_id == Car.id) \
+     .join(Course, LapTime.course_id == Course.id) \
+     .join(User, LapTime.user_id == User.id) \
+     .where(*filters).order_by(LapTime.id) \
+     .execution_options(yield_per=EXPORT_CHUNK_ROWS)
+    for rows in db.session.execute(query).partitions():
+        yield [(*row[:4], row[4].isoformat(), *row[5:]) for row in rows]
+
+def csv_export(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    # ヘッダーはクエリの結果を待たずに送り出す
+    yield buffer.getvalue()
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+def ndjson_export(chunks):
+    for rows in chunks:
+        yield ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + '\n' for row in rows)
+
+@app.route('/api/export/laps.<any(csv, ndjson):export_format>', methods=['GET'])
+@login_required
+@conditional_response('lap_time')
+def export_laps(export_format):
+    try:
+        filters = lap_time_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': f'{e}の指定が正しくありません'}), 400
+
+    chunks = export_lap_chunks(filters)
+    body = csv_export(chunks) if export_format == 'csv' else ndjson_export(chunks)
+    # 行を読み終えるまでセッションを保つためリクエストコンテキストごと引き継ぐ
+    response = Response(stream_with_context(body), mimetype=EXPORT_MIMETYPES[export_format])
+    response.headers['Content-Disposition'] = f'attachment; filename=laps.{export_format}'
+    return response
 
 @app.route('/api/lap-times', methods=['POST'])
 @login_required
@@ -188,16 +1083,27 @@ def add_lap_time():
         if not all(k in data for k in ['game_title_id', 'car_id', 'course_id', 'time']):
             return jsonify({'error': 'すべての項目を入力してください'}), 400
 
+        try:
+            time_ms = parse_lap_time(data['time'])
+        except ValueError:
+            return jsonify({'error': 'ラップタイムの形式が正しくありません（分:秒.ミリ秒）'}), 400
+
         lap_time = LapTime(
             user_id=current_user.id,
             game_title_id=data['game_title_id'],
             car_id=data['car_id'],
             course_id=data['course_id'],
             time=data['time'],
+            time_ms=time_ms,
             memo=data.get('memo', '')
         )
         db.session.add(lap_time)
+        db.session.flush()
+        record_personal_best(lap_time)
+        log_lap_time_change(lap_time.id, 'insert')
+        bump_table_version('lap_time')
         db.session.commit()
+        lap_events.publish('lap_added', lap_event_data(lap_time, current_user.username))
 
         return jsonify({
             'id': lap_time.id,
@@ -205,6 +1111,7 @@ def add_lap_time():
             'car': lap_time.car.name,
             'course': lap_time.course.name,
             'time': lap_time.time,
+            'time_ms': lap_time.time_ms,
             'memo': lap_time.memo,
             'created_at': lap_time.created_at.strftime('%Y-%m-%d %H:%M:%S')
         })
@@ -220,15 +1127,298 @@ def delete_lap_time(lap_time_id):
     if lap_time.user_id != current_user.id:
         return jsonify({'error': 'このラップタイムを削除する権限がありません'}), 403
 
+    deleted = {key: getattr(lap_time, key) for key in LAP_TIME_FILTER_KEYS}
+    deleted['id'] = lap_time.id
+    remove_personal_best(lap_time)
     db.session.delete(lap_time)
+    log_lap_time_change(lap_time.id, 'delete')
+    bump_table_version('lap_time')
     db.session.commit()
+    lap_events.publish('lap_deleted', deleted)
     return jsonify({'message': 'ラップタイムを削除しました'}), 200
 
+@app.route('/api/personal-bests', methods=['GET'])
+@login_required
+@conditional_response('lap_time')
+def get_personal_bests():
+    course_id = request.args.get('course_id', type=int)
+    car_id = request.args.get('car_id', type=int)
+    if not course_id or not car_id:
+        return jsonify({'error': 'コースIDと車種IDが必要です'}), 400
+
+    # 自己ベスト表のみを参照するため、組み合わせ内のユーザー数に比例したコストで済む
+    personal_bests = db.session.query(
+        PersonalBest.user_id,
+        PersonalBest.lap_time_id,
+        PersonalBest.time_ms,
+        User.username,
+        LapTime.created_at
+    ).join(User, PersonalBest.user_id == User.id).join(
+        LapTime, PersonalBest.lap_time_id == LapTime.id
+    ).filter(
+        PersonalBest.course_id == course_id,
+        PersonalBest.car_id == car_id
+    ).order_by(PersonalBest.time_ms, PersonalBest.lap_time_id).all()
+
+    return jsonify([{
+        'user_id': pb.user_id,
+        'username': pb.username,
+        'lap_time_id': pb.lap_time_id,
+        'time': format_lap_time(pb.time_ms),
+        'time_ms': pb.time_ms,
+        'created_at': pb.created_at.isoformat()
+    } for pb in personal_bests])
+
+LEADERBOARD_DEFAULT_LIMIT = 100
+LEADERBOARD_MAX_LIMIT = 1000
+LEADERBOARD_DEFAULT_AROUND = 5
+
+def leaderboard_query(args, user_id):
+    """リーダーボードのクエリパラメータから (SELECT文, course_id, car_id, around) を組み立てる
+
+    パラメータが不正な場合はエラーメッセージ付きの ValueError。
+    """
+    course_id = args.get('course_id', type=int)
+    car_id = args.get('car_id', type=int)
+    if not course_id or not car_id:
+        raise ValueError('コースIDと車種IDが必要です')
+
+    around = args.get('around')
+    if around not in (None, 'me'):
+        raise ValueError('aroundの指定が正しくありません')
+    span = args.get('span', LEADERBOARD_DEFAULT_AROUND, type=int)
+    limit = args.get('limit', LEADERBOARD_DEFAULT_LIMIT, type=int)
+    if span < 0 or limit < 1:
+        raise ValueError('spanは0以上、limitは1以上を指定してください')
+    limit = min(limit, LEADERBOARD_MAX_LIMIT)
+
+    # 自己ベスト表の (course_id, car_id, time_ms) インデックスを順に読むだけで順位が決まる
+    ranked = db.select(
+        PersonalBest.user_id,
+        PersonalBest.lap_time_id,
+        PersonalBest.time_ms,
+        db.func.rank().over(order_by=PersonalBest.time_ms).label('rank'),
+        db.func.row_number().over(order_by=(PersonalBest.time_ms, PersonalBest.lap_time_id)).label('position'),
+        (PersonalBest.time_ms - db.func.min(PersonalBest.time_ms).over()).label('gap_ms'),
+        db.func.percent_rank().over(order_by=PersonalBest.time_ms).label('percent_rank'),
+        db.func.count().over().label('total')
+    ).where(
+        PersonalBest.course_id == course_id,
+        PersonalBest.car_id == car_id
+    ).cte('ranked')
+
+    query = db.select(ranked, User.username, LapTime.created_at) \
+        .join(User, ranked.c.user_id == User.id) \
+        .join(LapTime, ranked.c.lap_time_id == LapTime.id) \
+        .order_by(ranked.c.position)
+    if around == 'me':
+        # 自分の前後 span 人だけを返す（自己ベストが無ければ空）
+        my_position = db.select(ranked.c.position).where(ranked.c.user_id == user_id).scalar_subquery()
+        query = query.where(ranked.c.position.between(my_position - span, my_position + span))
+    else:
+        query = query.limit(limit)
+    return query, course_id, car_id, around
+
+def leaderboard_total_query(course_id, car_id):
+    """順位表に載っている人数（表示する行が無いときに使う）"""
+    return db.select(db.func.count()).select_from(PersonalBest).where(
+        PersonalBest.course_id == course_id, PersonalBest.car_id == car_id)
+
+def leaderboard_body(entries, total, course_id, car_id, user_id):
+    return {
+        'course_id': course_id,
+        'car_id': car_id,
+        'total': total,
+        'entries': [{
+            'rank': entry.rank,
+            'user_id': entry.user_id,
+            'username': entry.username,
+            'lap_time_id': entry.lap_time_id,
+            'time': format_lap_time(entry.time_ms),
+            'time_ms': entry.time_ms,
+            'gap_ms': entry.gap_ms,
+            # 自分より速くない他のドライバーの割合（%）。1位は100
+            'percentile': round(100 * (1 - float(entry.percent_rank)), 1),
+            'created_at': entry.created_at.isoformat(),
+            'is_me': entry.user_id == user_id
+        } for entry in entries]
+    }
+
+@app.route('/api/leaderboard', methods=['GET'])
+@login_required
+@conditional_response('lap_time')
+def get_leaderboard():
+    try:
+        query, course_id, car_id, around = leaderboard_query(request.args, current_user.id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    entries = db.session.execute(query).all()
+    total = entries[0].total if entries else db.session.execute(leaderboard_total_query(course_id, car_id)).scalar()
+    response = jsonify(leaderboard_body(entries, total, course_id, car_id, current_user.id))
+    if around == 'me':
+        # ユーザーごとに内容が変わるため、別ユーザーの保存済みレスポンスで再検証させない
+        response.vary.add('Cookie')
+    return response
+
+def lap_time_percentile(filters, count, fraction):
+    """time_ms の昇順で fraction 位置の値を線形補間で求める（インデックスを OFFSET で辿る）"""
+    position = fraction * (count - 1)
+    lower = math.floor(position)
+    values = [row.time_ms for row in db.session.query(LapTime.time_ms).filter(*filters)
+              .order_by(LapTime.time_ms).offset(lower).limit(2)]
+    if len(values) == 1 or position == lower:
+        return values[0]
+    return values[0] + (values[1] - values[0]) * (position - lower)
+
+@app.route('/api/stats', methods=['GET'])
+@login_required
+@conditional_response('lap_time')
+def get_stats():
+    try:
+        filters = lap_time_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': f'{e}の指定が正しくありません'}), 400
+    filters.append(LapTime.time_ms.isnot(None))
+
+    count, best, mean, mean_square = db.session.query(
+        db.func.count(LapTime.time_ms),
+        db.func.min(LapTime.time_ms),
+        db.func.avg(LapTime.time_ms),
+        db.func.avg(LapTime.time_ms * LapTime.time_ms)
+    ).filter(*filters).one()
+
+    if count == 0:
+        return jsonify({
+            'count': 0,
+            'best_ms': None,
+            'mean_ms': None,
+            'median_ms': None,
+            'p90_ms': None,
+            'stddev_ms': None
+        })
+
+    # SQLite には分散関数が無いため E[x^2] - E[x]^2 から母標準偏差を求める
+    variance = max(mean_square - mean * mean, 0)
+    return jsonify({
+        'count': count,
+        'best_ms': best,
+        'mean_ms': round(mean),
+        'median_ms': round(lap_time_percentile(filters, count, 0.5)),
+        'p90_ms': round(lap_time_percentile(filters, count, 0.9)),
+        'stddev_ms': round(math.sqrt(variance))
+    })
+
+LAP_SERIES_DEFAULT_POINTS = 200
+LAP_SERIES_MAX_POINTS = 2000
+
+def downsample_lttb(points, threshold):
+    """Largest-Triangle-Three-Buckets で (x, y) 列を threshold 点に間引き、残す点のインデックスを返す"""
+    n = len(points)
+    if threshold >= n:
+        return list(range(n))
+    if threshold < 3:
+        # 両端だけを残す
+        return [0, n - 1]
+
+    selected = [0]
+    bucket_size = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # 次のバケットの平均点を三角形の頂点として使う
+        next_start = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        next_points = points[next_start:next_end] or [points[-1]]
+        avg_x = sum(p[0] for p in next_points) / len(next_points)
+        avg_y = sum(p[1] for p in next_points) / len(next_points)
+
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        ax, ay = points[a]
+        max_area = -1
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (points[j][1] - ay) - (ax - points[j][0]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                a_next = j
+        selected.append(a_next)
+        a = a_next
+
+    selected.append(n - 1)
+    return selected
+
+def personal_best_indices(points):
+    """自己ベストを更新した点のインデックスを返す"""
+    indices = []
+    best = None
+    for i, (_, y) in enumerate(points):
+        if best is None or y < best:
+            best = y
+            indices.append(i)
+    return indices
+
+def thin_indices(indices, limit):
+    """インデックス列を先頭と末尾を含めて limit 個まで等間隔に間引く"""
+    if len(indices) <= limit:
+        return indices
+    step = (len(indices) - 1) / (limit - 1)
+    return [indices[round(k * step)] for k in range(limit)]
+
+@app.route('/api/lap-series', methods=['GET'])
+@login_required
+@conditional_response('lap_time')
+def get_lap_series():
+    try:
+        filters = lap_time_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': f'{e}の指定が正しくありません'}), 400
+    if not request.args.get('course_id') or not request.args.get('car_id'):
+        return jsonify({'error': 'コースIDと車種IDが必要です'}), 400
+
+    budget = request.args.get('points', LAP_SERIES_DEFAULT_POINTS, type=int)
+    if budget < 3:
+        return jsonify({'error': 'pointsは3以上を指定してください'}), 400
+    budget = min(budget, LAP_SERIES_MAX_POINTS)
+
+    rows = db.session.query(
+        LapTime.user_id,
+        User.username,
+        LapTime.time_ms,
+        LapTime.created_at
+    ).join(User, LapTime.user_id == User.id).filter(
+        *filters, LapTime.time_ms.isnot(None)
+    ).order_by(LapTime.user_id, LapTime.created_at, LapTime.id)
+
+    series = []
+    for (user_id, username), laps in groupby(rows, key=lambda row: (row.user_id, row.username)):
+        laps = list(laps)
+        # x は試行回数（1始まり）
+        points = [(i + 1, lap.time_ms) for i, lap in enumerate(laps)]
+        # 自己ベスト更新点は点数の半分まで残し（多ければ最初と最新を含めて等間隔に間引く）、
+        # 残りの点数で形状を保つように間引く。先頭の点はどちらにも含まれるので1点分を共有する
+        keep = thin_indices(personal_best_indices(points), max(budget // 2, 2))
+        sampled = downsample_lttb(points, budget - len(keep) + 1)
+        indices = sorted(set(sampled).union(keep))
+        series.append({
+            'user_id': user_id,
+            'username': username,
+            'total': len(laps),
+            'points': [[points[i][0], points[i][1], laps[i].created_at.isoformat()] for i in indices]
+        })
+
+    return jsonify(series)
+
+@app.route('/api/catalog-cache', methods=['GET'])
+@login_required
+def get_catalog_cache_stats():
+    return jsonify(catalog_cache.stats())
+
 @app.route('/api/game-titles', methods=['GET'])
 @login_required
 def get_game_titles():
-    game_titles = GameTitle.query.all()
-    return jsonify([{'id': gt.id, 'name': gt.name} for gt in game_titles])
+    def load():
+        return [{'id': gt.id, 'name': gt.name} for gt in GameTitle.query.all()]
+    return catalog_response('game_title', 'game_titles', None, load)
 
 @app.route('/api/game-titles', methods=['POST'])
 @login_required
@@ -244,7 +1434,9 @@ def add_game_title():
     
     game_title = GameTitle(name=name)
     db.session.add(game_title)
+    bump_table_version('game_title')
     db.session.commit()
+    catalog_cache.clear()
     
     return jsonify({'id': game_title.id, 'name': game_title.name}), 201
 
@@ -252,11 +1444,12 @@ def add_game_title():
 @login_required
 def get_cars():
     game_title_id = request.args.get('game_title_id')
-    query = Car.query
-    if game_title_id:
-        query = query.filter_by(game_title_id=game_title_id)
-    cars = query.all()
-    return jsonify([{'id': car.id, 'name': car.name, 'game_title_id': car.game_title_id} for car in cars])
+    def load():
+        query = Car.query
+        if game_title_id:
+            query = query.filter_by(game_title_id=game_title_id)
+        return [{'id': car.id, 'name': car.name, 'game_title_id': car.game_title_id} for car in query.all()]
+    return catalog_response('car', 'cars', game_title_id or None, load)
 
 @app.route('/api/cars', methods=['POST'])
 @login_required
@@ -276,7 +1469,9 @@ def add_car():
     
     car = Car(name=name, game_title_id=game_title_id)
     db.session.add(car)
+    bump_table_version('car')
     db.session.commit()
+    catalog_cache.clear()
     
     return jsonify({'id': car.id, 'name': car.name, 'game_title_id': car.game_title_id}), 201
 
@@ -284,11 +1479,12 @@ def add_car():
 @login_required
 def get_courses():
     game_title_id = request.args.get('game_title_id')
-    query = Course.query
-    if game_title_id:
-        query = query.filter_by(game_title_id=game_title_id)
-    courses = query.all()
-    return jsonify([{'id': course.id, 'name': course.name, 'game_title_id': course.game_title_id} for course in courses])
+    def load():
+        query = Course.query
+        if game_title_id:
+            query = query.filter_by(game_title_id=game_title_id)
+        return [{'id': course.id, 'name': course.name, 'game_title_id': course.game_title_id} for course in query.all()]
+    return catalog_response('course', 'courses', game_title_id or None, load)
 
 @app.route('/api/courses', methods=['POST'])
 @login_required
@@ -308,14 +1504,238 @@ def add_course():
     
     course = Course(name=name, game_title_id=game_title_id)
     db.session.add(course)
+    bump_table_version('course')
     db.session.commit()
+    catalog_cache.clear()
     
     return jsonify({'id': course.id, 'name': course.name, 'game_title_id': course.game_title_id}), 201
 
-# データベースの初期化
-with app.app_context():
-    db.create_all()
-    print("データベースの初期化が完了しました。")
+# ラップタイムの一括取り込み（flask import-laps）
+IMPORT_FORMATS = ('csv', 'ndjson')
+# 取り込みで作成したユーザーはパスワード未設定（どのパスワードとも一致しない）
+UNUSABLE_PASSWORD_HASH = '!'
+
+class ImportProgress(db.Model):
+    """ファイルごとの取り込み済み件数。チャンクと同じトランザクションで更新する"""
+    __tablename__ = 'import_progress'
+    source = db.Column(db.String(255), primary_key=True)
+    records = db.Column(db.Integer, nullable=False, default=0)
+
+def read_import_records(path, file_format):
+    """取り込みファイルを先頭から1件ずつ (件番号, 内容) で返す"""
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        if file_format == 'csv':
+            yield from enumerate(csv.DictReader(f), 1)
+            return
+        number = 0
+        for line in f:
+            if line.strip():
+                number += 1
+                yield number, line
+
+class LapImporter:
+    """カタログとユーザーは名前から ID への対応をメモリに持ち、無ければ作成する"""
+
+    def __init__(self, create_users):
+        self.create_users = create_users
+        self.game_titles = {name: id for id, name in db.session.query(GameTitle.id, GameTitle.name)}
+        # 車種・コース名はゲームタイトルをまたいで一意なので名前で引き、所属するタイトルも持っておく
+        self.cars, self.car_titles = {}, {}
+        for id, game_title_id, name in db.session.query(Car.id, Car.game_title_id, Car.name):
+            self.cars[name], self.car_titles[name] = id, game_title_id
+        self.courses, self.course_titles = {}, {}
+        for id, game_title_id, name in db.session.query(Course.id, Course.game_title_id, Course.name):
+            self.courses[name], self.course_titles[name] = id, game_title_id
+        self.users = {username: id for id, username in db.session.query(User.id, User.username)}
+        # email も一意なので、作成前に他のユーザーとの重複を調べる
+        self.emails = {email for email, in db.session.query(User.email)} if create_users else set()
+        self.created_tables = set()
+
+    def _get_or_create(self, mapping, key, model, **values):
+        if key not in mapping:
+            obj = model(**values)
+            db.session.add(obj)
+            db.session.flush()
+            mapping[key] = obj.id
+            self.created_tables.add(model.__tablename__)
+        return mapping[key]
+
+    def lap_values(self, raw):
+        """1件分の内容を検証して lap_time の列の値にする（不正なら ValueError）"""
+        try:
+            record = json.loads(raw) if isinstance(raw, str) else raw
+        except ValueError:
+            raise ValueError('JSONとして読み込めません')
+        if not isinstance(record, dict):
+            raise ValueError('1件分のデータがオブジェクトではありません')
+        missing = [key for key in ('game_title', 'car', 'course', 'username') if not record.get(key)]
+        if missing:
+            raise ValueError(f'{", ".join(missing)}がありません')
+
+        try:
+            if record.get('time_ms') not in (None, ''):
+                time_ms = int(record['time_ms'])
+                if time_ms <= 0:
+                    raise ValueError()
+                lap_time = format_lap_time(time_ms)
+            else:
+                lap_time = record.get('time') or ''
+                time_ms = parse_lap_time(lap_time)
+        except (TypeError, ValueError):
+            raise ValueError('ラップタイムの形式が正しくありません（分:秒.ミリ秒）')
+
+        created_at = record.get('created_at')
+        try:
+            created_at = datetime.fromisoformat(created_at) if created_at else datetime.utcnow()
+        except (TypeError, ValueError):
+            raise ValueError('created_atの形式が正しくありません')
+
+        # 同じ名前の車種・コースは別のゲームタイトルには作れない（作成前に調べる）
+        game_title_id = self.game_titles.get(record['game_title'])
+        for key, titles, label in (('car', self.car_titles, '車種'), ('course', self.course_titles, 'コース')):
+            if record[key] in titles and titles[record[key]] != game_title_id:
+                raise ValueError(f'{label} {record[key]} は別のゲームタイトルに登録されています')
+
+        username = record['username']
+        new_user = username not in self.users
+        if new_user and not (self.create_users and record.get('email')):
+            raise ValueError(f'ユーザー {username} が存在しません')
+        if new_user and record['email'] in self.emails:
+            raise ValueError(f'メールアドレス {record["email"]} は別のユーザーが使っています')
+
+        user_id = self._get_or_create(self.users, username, User, username=username,
+                                      email=record.get('email'), password_hash=UNUSABLE_PASSWORD_HASH)
+        if new_user:
+            self.emails.add(record['email'])
+        game_title_id = self._get_or_create(self.game_titles, record['game_title'], GameTitle,
+                                            name=record['game_title'])
+        car_id = self._get_or_create(self.cars, record['car'], Car, name=record['car'], game_title_id=game_title_id)
+        self.car_titles[record['car']] = game_title_id
+        course_id = self._get_or_create(self.courses, record['course'], Course,
+                                        name=record['course'], game_title_id=game_title_id)
+        self.course_titles[record['course']] = game_title_id
+        return {
+            'user_id': user_id,
+            'game_title_id': game_title_id,
+            'car_id': car_id,
+            'course_id': course_id,
+            'time': lap_time,
+            'time_ms': time_ms,
+            'memo': record.get('memo') or '',
+            'created_at': created_at
+        }
+
+    def insert_chunk(self, laps):
+        """まとめて INSERT し、自己ベスト・変更履歴・版数も更新する（コミットは呼び出し側）"""
+        if laps:
+            rows = db.session.execute(
+                db.insert(LapTime).returning(LapTime.id, LapTime.user_id, LapTime.course_id,
+                                             LapTime.car_id, LapTime.time_ms),
+                laps
+            ).all()
+            rows.sort(key=lambda row: row.id)
+            db.session.execute(db.insert(LapTimeChange), [{'lap_time_id': row.id, 'op': 'insert'} for row in rows])
+
+            # 組み合わせごとに最速（同タイムは先に登録した方）だけを自己ベストに反映する
+            best = {}
+            for row in rows:
+                key = (row.user_id, row.course_id, row.car_id)
+                if key not in best or row.time_ms < best[key].time_ms:
+                    best[key] = row
+            record_personal_bests(best.values())
+            bump_table_version('lap_time')
+
+        for name in self.created_tables & {'game_title', 'car', 'course'}:
+            bump_table_version(name)
+        self.created_tables.clear()
+
+@app.cli.command('import-laps')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(IMPORT_FORMATS), help='省略時は拡張子から判定します')
+@click.option('--chunk-size', default=1000, show_default=True, type=click.IntRange(min=1),
+              help='1トランザクションで登録する件数')
+@click.option('--create-users', is_flag=True, help='存在しないユーザーを email 列から作成します（パスワードは未設定）')
+@click.option('--skip-invalid', is_flag=True, help='不正な行を報告して読み飛ばします')
+@click.option('--restart', is_flag=True, help='前回の取り込み位置を無視して先頭から取り込みます')
+def import_laps_command(path, file_format, chunk_size, create_users, skip_invalid, restart):
+    """CSV / NDJSON ファイルからラップタイムを一括で取り込む
+
+    列は game_title, car, course, username, time（または time_ms）, memo, created_at, email。
+    /api/export/laps.csv / .ndjson の出力をそのまま取り込めます。途中で失敗した場合は
+    同じコマンドを再実行するとコミット済みのチャンクの続きから再開します。
+    """
+    file_format = file_format or os.path.splitext(path)[1].lstrip('.').lower()
+    if file_format not in IMPORT_FORMATS:
+        raise click.UsageError('--format で csv か ndjson を指定してください')
+
+    source = os.path.abspath(path)
+    progress = db.session.get(ImportProgress, source)
+    if progress is None:
+        progress = ImportProgress(source=source, records=0)
+        db.session.add(progress)
+    elif restart:
+        progress.records = 0
+    elif progress.records:
+        click.echo(f'{progress.records} 件目まで取り込み済みのため、続きから再開します')
+
+    importer = LapImporter(create_users)
+    committed = progress.records
+    pending = []
+    imported = skipped = 0
+    number = committed
+    started = time.monotonic()
+
+    def commit_chunk():
+        nonlocal committed, imported
+        importer.insert_chunk(pending)
+        progress.records = number
+        db.session.commit()
+        committed = number
+        imported += len(pending)
+        pending.clear()
+        rate = imported / max(time.monotonic() - started, 1e-9)
+        click.echo(f'{imported} 件取り込みました（{number} 件目まで, {rate:.0f} 件/秒）')
+
+    for number, raw in read_import_records(path, file_format):
+        if number <= committed:
+            continue
+        try:
+            pending.append(importer.lap_values(raw))
+        except ValueError as e:
+            if not skip_invalid:
+                db.session.rollback()
+                raise click.ClickException(
+                    f'{number} 件目: {e}（{committed} 件目までは取り込み済みです。修正して再実行すると続きから再開します）')
+            skipped += 1
+            click.echo(f'{number} 件目を読み飛ばしました: {e}', err=True)
+        if len(pending) >= chunk_size:
+            commit_chunk()
+
+    if pending or number > committed:
+        commit_chunk()
+    click.echo(f'完了: {imported} 件を取り込み、{skipped} 件を読み飛ばしました')
+
+# マイグレーション導入前の db.create_all() で作られたスキーマに相当する版
+INITIAL_REVISION = '6342b1e30b06'
+
+def upgrade_database():
+    """データベースをマイグレーションで最新のスキーマにする
+
+    create_all() ではなくマイグレーションを流すので、既存のデータからの埋め戻しも行われる。
+    マイグレーション導入前に作られたデータベースは初版として記録してから続きを適用する。
+    """
+    tables = db.inspect(db.engine).get_table_names()
+    if 'alembic_version' not in tables and 'lap_time' in tables:
+        stamp(revision=INITIAL_REVISION)
+    upgrade()
+
+@app.cli.command('init-db')
+def init_db():
+    """データベースを作成・更新する（flask --app app init-db）"""
+    upgrade_database()
+    click.echo('データベースの初期化が完了しました。')
 
 if __name__ == '__main__':
+    with app.app_context():
+        upgrade_database()
     app.run(host='0.0.0.0', port=5005, debug=True) 
\ No newline at end of file
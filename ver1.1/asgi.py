@@ -0,0 +1,255 @@
+"""ASGI のエントリポイント
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5004
+
+よく読まれる一覧API（/api/lap-times, /api/leaderboard）とライブ配信（/api/lap-times/stream）は
+イベントループ上で処理し、データベースは非同期ドライバー（aiosqlite）で読む。SSE の接続は
+イベントを待っている間コルーチン1つ分しか使わないので、接続が増えてもスレッドは増えない。
+
+それ以外のリクエストと、未ログイン・パラメータ不正などのエラーになるリクエストは、
+従来の Flask アプリにスレッドプール経由で渡す。同期のエンドポイントとエラー応答は今までどおり。
+"""
+import asyncio
+import os
+
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from werkzeug.datastructures import Headers
+from werkzeug.http import remove_entity_headers
+from werkzeug.sansio.request import Request
+
+from app import (app, db, User, UserSnapshot, user_cache, lap_events, LapStreamSubscription, set_sqlite_pragmas,
+                 table_versions_query, table_versions_etag, set_conditional_headers, compress_json,
+                 lap_times_query, lap_times_body, leaderboard_query, leaderboard_total_query, leaderboard_body,
+                 lap_time_filter_values, format_lap_event, LAP_STREAM_RETRY, LAP_STREAM_KEEPALIVE_COMMENT)
+
+# 同期のエンドポイントを処理するスレッド数
+app.config.setdefault('ASGI_WSGI_WORKERS', int(os.environ.get('ASGI_WSGI_WORKERS', 10)))
+# 非同期の読み込み経路が同時に使うデータベース接続の上限（aiosqlite は接続ごとにスレッドを1つ使う）
+app.config.setdefault('ASGI_DB_POOL_SIZE', int(os.environ.get('ASGI_DB_POOL_SIZE', 5)))
+
+class AsyncLapStreamSubscription(LapStreamSubscription):
+    """イベントループ上で待つ購読。待っている間はスレッドを使わない"""
+
+    def __init__(self, broker, filters, maxsize, loop):
+        super().__init__(broker, filters, maxsize)
+        self.loop = loop
+        self.ready = asyncio.Event()
+        self.cancelled = False
+
+    def push(self, item):
+        super().push(item)
+        # publish は書き込みを処理したスレッドから呼ばれるので、イベントループ側で起こす
+        try:
+            self.loop.call_soon_threadsafe(self.ready.set)
+        except RuntimeError:  # イベントループが既に止まっている
+            pass
+
+    def cancel(self):
+        """待っている get_async を None で戻す（イベントループ上で呼ぶ）"""
+        self.cancelled = True
+        self.ready.set()
+
+    async def get_async(self, timeout):
+        """次のイベントを返す。timeout 秒以内に届かないか cancel されたら None"""
+        deadline = self.loop.time() + timeout
+        while not self.cancelled:
+            with self.broker.condition:
+                if self.events:
+                    return self.events.popleft()
+                self.ready.clear()
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self.ready.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return None
+
+def asgi_headers(headers):
+    return [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers.items()]
+
+async def send_response(send, response):
+    """Flask のレスポンスオブジェクトをそのまま ASGI で送る"""
+    headers = Headers(response.headers)
+    if response.status_code == 304:
+        remove_entity_headers(headers)
+    await send({'type': 'http.response.start', 'status': response.status_code, 'headers': asgi_headers(headers)})
+    await send({'type': 'http.response.body', 'body': b'' if response.status_code == 304 else response.get_data()})
+
+class LapTimesASGI:
+    """読み込みAPIとライブ配信を非同期で処理し、残りを Flask アプリに渡す ASGI アプリ"""
+
+    def __init__(self, flask_app, database_url, wsgi_workers, pool_size):
+        self.app = flask_app
+        self.wsgi = WSGIMiddleware(flask_app, workers=wsgi_workers)
+        self.engine = None
+        self.routes = {}
+        if database_url.database in (None, '', ':memory:'):
+            # メモリ上のデータベースは別の接続から見えないので、すべて Flask 側で処理する
+            return
+        # 既定の NullPool ではリクエストごとに接続（とそのスレッド）を作り直すので、上限付きのプールで使い回す
+        self.engine = create_async_engine(database_url.set(drivername='sqlite+aiosqlite'),
+                                          poolclass=AsyncAdaptedQueuePool, pool_size=pool_size, max_overflow=0)
+        event.listen(self.engine.sync_engine, 'connect', set_sqlite_pragmas)
+        self.routes = {
+            '/api/lap-times': self.get_lap_times,
+            '/api/leaderboard': self.get_leaderboard,
+            '/api/lap-times/stream': self.stream_lap_times
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        handler = self.routes.get(scope['path']) if scope['type'] == 'http' and scope['method'] == 'GET' else None
+        # 処理できないリクエスト（False が返る）は Flask アプリに任せる
+        if handler is None or not await handler(self.make_request(scope), receive, send):
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.engine is not None:
+                    await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def make_request(self, scope):
+        headers = Headers([(key.decode('latin-1'), value.decode('latin-1')) for key, value in scope['headers']])
+        client = scope.get('client') or (None, None)
+        return Request(scope['method'], scope.get('scheme', 'http'), scope.get('server'), scope.get('root_path', ''),
+                       scope['path'], scope.get('query_string', b''), headers, client[0])
+
+    async def current_user(self, request):
+        """セッションクッキーのログインユーザーを返す。ログインしていなければ None"""
+        cookie = request.cookies.get(self.app.config['SESSION_COOKIE_NAME'])
+        serializer = self.app.session_interface.get_signing_serializer(self.app)
+        if not cookie or serializer is None:
+            return None
+        try:
+            session = serializer.loads(cookie, max_age=int(self.app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            return None
+        if '_user_id' not in session:
+            return None
+
+        # load_user と同じキャッシュを使う
+        user_id = int(session['_user_id'])
+        found, snapshot = user_cache.get(user_id)
+        if not found:
+            generation = user_cache.generation
+            async with self.engine.connect() as conn:
+                user = (await conn.execute(
+                    db.select(User.id, User.username, User.created_at).where(User.id == user_id))).first()
+            if user is None:
+                return None
+            snapshot = UserSnapshot(id=user.id, username=user.username, created_at=user.created_at)
+            user_cache.set(user_id, snapshot, generation)
+        return snapshot
+
+    async def respond_conditional(self, request, send, tables, render):
+        """conditional_response と同じ ETag で 304 を返し、変わっていれば render(conn) の結果を返す"""
+        async with self.engine.connect() as conn:
+            etag = table_versions_etag(tables, dict((await conn.execute(table_versions_query(tables))).all()))
+            if request.if_none_match.contains_weak(etag):
+                response = self.app.response_class(status=304)
+            else:
+                response = await render(conn)
+        # 送信前に接続を返すので、読むのが遅いクライアントが接続を持ち続けることはない
+        set_conditional_headers(response, etag)
+        # Flask ではログイン確認でセッションを読むと Vary: Cookie が付く
+        response.vary.add('Cookie')
+        await send_response(send, compress_json(response, request.accept_encodings))
+
+    async def get_lap_times(self, request, receive, send):
+        user = await self.current_user(request)
+        if user is None:
+            return False
+        try:
+            query, sort, limit, response_format = lap_times_query(request.args)
+        except ValueError:
+            return False
+
+        async def render(conn):
+            laps = (await conn.execute(query)).all()
+            return self.app.json.response(lap_times_body(laps, sort, limit, response_format))
+
+        await self.respond_conditional(request, send, ('lap_time',), render)
+        return True
+
+    async def get_leaderboard(self, request, receive, send):
+        user = await self.current_user(request)
+        if user is None:
+            return False
+        try:
+            query, course_id, car_id, around = leaderboard_query(request.args, user.id)
+        except ValueError:
+            return False
+
+        async def render(conn):
+            entries = (await conn.execute(query)).all()
+            if entries:
+                total = entries[0].total
+            else:
+                total = (await conn.execute(leaderboard_total_query(course_id, car_id))).scalar()
+            return self.app.json.response(leaderboard_body(entries, total, course_id, car_id, user.id))
+
+        await self.respond_conditional(request, send, ('lap_time',), render)
+        return True
+
+    async def stream_lap_times(self, request, receive, send):
+        if await self.current_user(request) is None:
+            return False
+        try:
+            filters = lap_time_filter_values(request.args)
+        except ValueError:
+            return False
+
+        loop = asyncio.get_running_loop()
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+        subscription = lap_events.subscribe(
+            filters, self.app.config['LAP_STREAM_CLIENT_BUFFER'], last_event_id,
+            factory=lambda broker, filters, maxsize: AsyncLapStreamSubscription(broker, filters, maxsize, loop))
+
+        async def wait_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            subscription.cancel()
+
+        watcher = asyncio.create_task(wait_disconnect())
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+                (b'vary', b'Cookie')
+            ]})
+            message = LAP_STREAM_RETRY
+            while not subscription.cancelled:
+                await send({'type': 'http.response.body', 'body': message.encode(), 'more_body': True})
+                item = await subscription.get_async(self.app.config['LAP_STREAM_KEEPALIVE'])
+                message = LAP_STREAM_KEEPALIVE_COMMENT if item is None else format_lap_event(item)
+        finally:
+            watcher.cancel()
+            subscription.close()
+        return True
+
+def create_application(database_url=None):
+    """ASGI アプリを作る。database_url を省略すると Flask アプリと同じデータベースを読む"""
+    if database_url is None:
+        with app.app_context():
+            database_url = db.engine.url
+    else:
+        database_url = make_url(database_url)
+    return LapTimesASGI(app, database_url, app.config['ASGI_WSGI_WORKERS'], app.config['ASGI_DB_POOL_SIZE'])
+
+application = create_application()
@@ -0,0 +1,241 @@
+"""ベンチマーク用の合成データを作る
+
+ユーザーの記録数とコース・車種の人気には偏り（Zipf 分布）を持たせ、
+ラップタイムは組み合わせごとの基準タイム・ユーザーの腕前・ばらつきから作る。
+同じ引数とシードからは常に同じデータができる。
+
+populate() はアプリが使っているデータベースに直接書き込む（DATABASE_URL を設定してから呼ぶ）。
+build_fixture() は app.py のスキーマで独立した SQLite ファイルを作り、引数とスキーマの
+ハッシュをファイル名にしてキャッシュする。2回目以降はファイルのパスを返すだけで終わる。
+
+    DATABASE_URL=sqlite:////tmp/bench.db python -m benchmarks.datagen --users 200 --combos 40 --laps 200000
+    python -m benchmarks.datagen --fixture --laps 10000000
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+# 生成したユーザーは全員このパスワードでログインできる
+BENCH_PASSWORD = 'bench-password'
+SEASON_START = datetime(2026, 1, 1)
+SEASON_DAYS = 180
+INSERT_CHUNK_ROWS = 10000
+# 生成手順を変えたら上げる（キャッシュ済みのフィクスチャを作り直させる）
+FIXTURE_VERSION = 1
+FIXTURE_DIR = os.environ.get(
+    'BENCH_FIXTURE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures'))
+# フィクスチャはその場限りのファイルなので、耐障害性より書き込み速度を優先する
+FIXTURE_PRAGMAS = {
+    'journal_mode': 'OFF',
+    'synchronous': 'OFF',
+    'cache_size': -262144,
+    'temp_store': 'MEMORY',
+}
+
+LAP_TIME_INSERT = ('INSERT INTO lap_time (user_id, game_title_id, car_id, course_id, time, time_ms, memo, created_at) '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?)')
+
+def zipf_cum_weights(n, s):
+    """順位 i の重みが 1 / i^s となる累積重み"""
+    total = 0.0
+    cum_weights = []
+    for rank in range(1, n + 1):
+        total += 1 / rank ** s
+        cum_weights.append(total)
+    return cum_weights
+
+def default_users(laps):
+    """ユーザー数の既定値。1人あたり2000周程度に収まるよう規模に合わせて増やす"""
+    return max(50, laps // 2000)
+
+def write_dataset(conn, users, combos, laps, seed, game_titles):
+    """SQLAlchemy の接続にカタログ・ユーザー・ラップタイムと派生データを書き込む（コミットは呼び出し側）"""
+    from werkzeug.security import generate_password_hash
+    from app import app, db, User, GameTitle, Car, Course, format_lap_time
+
+    rng = random.Random(seed)
+
+    # 組み合わせの数が combos 以上になるようにゲームごとの車種・コースを作る
+    cars_per_title = max(1, math.ceil(math.sqrt(combos / game_titles)))
+    courses_per_title = max(1, math.ceil(combos / game_titles / cars_per_title))
+    all_combos = []
+    for g in range(game_titles):
+        game_title_id, = conn.execute(db.insert(GameTitle).values(name=f'Bench Game {g + 1}')).inserted_primary_key
+        car_ids = [conn.execute(db.insert(Car).values(
+            name=f'Bench Car {g + 1}-{i + 1}', game_title_id=game_title_id)).inserted_primary_key[0]
+            for i in range(cars_per_title)]
+        course_ids = [conn.execute(db.insert(Course).values(
+            name=f'Bench Course {g + 1}-{i + 1}', game_title_id=game_title_id)).inserted_primary_key[0]
+            for i in range(courses_per_title)]
+        all_combos += [(game_title_id, car_id, course_id) for car_id in car_ids for course_id in course_ids]
+    rng.shuffle(all_combos)
+    all_combos = all_combos[:combos]
+
+    # ハッシュ計算は重いので全員で同じハッシュを使う
+    password_hash = generate_password_hash(BENCH_PASSWORD, app.config['PASSWORD_HASH_METHOD'])
+    conn.execute(db.insert(User), [{
+        'username': f'bench{i:05d}',
+        'email': f'bench{i:05d}@kamiyama.ac.jp',
+        'password_hash': password_hash,
+        'created_at': SEASON_START
+    } for i in range(users)])
+    user_ids = [id for id, in conn.execute(
+        db.select(User.id).where(User.username.like('bench%')).order_by(User.id))]
+    rng.shuffle(user_ids)
+
+    base_ms = [rng.randint(60000, 150000) for _ in all_combos]
+    skill = [max(0.0, rng.gauss(0.04, 0.02)) for _ in user_ids]
+    user_cum = zipf_cum_weights(len(user_ids), 1.1)
+    combo_cum = zipf_cum_weights(len(all_combos), 1.0)
+    season_seconds = SEASON_DAYS * 86400
+
+    for offset in range(0, laps, INSERT_CHUNK_ROWS):
+        n = min(INSERT_CHUNK_ROWS, laps - offset)
+        user_picks = rng.choices(range(len(user_ids)), cum_weights=user_cum, k=n)
+        combo_picks = rng.choices(range(len(all_combos)), cum_weights=combo_cum, k=n)
+        rows = []
+        for i, (u, c) in enumerate(zip(user_picks, combo_picks)):
+            game_title_id, car_id, course_id = all_combos[c]
+            # 腕前の差に加え、ミスで大きく遅れる周回が右に裾を引く
+            time_ms = int(base_ms[c] * (1 + skill[u] + rng.lognormvariate(-4.0, 0.6)))
+            # id の順と記録日時の順が一致するようにする
+            created_at = SEASON_START + timedelta(seconds=season_seconds * (offset + i) / laps)
+            rows.append((user_ids[u], game_title_id, car_id, course_id, format_lap_time(time_ms), time_ms, '',
+                         created_at.isoformat(' ', 'microseconds')))
+        # 件数が多いので ORM を通さず DB-API の executemany で入れる
+        conn.exec_driver_sql(LAP_TIME_INSERT, rows)
+
+    conn.execute(db.text("""
+        INSERT INTO personal_best (user_id, course_id, car_id, lap_time_id, time_ms)
+        SELECT user_id, course_id, car_id, id, time_ms
+        FROM (
+            SELECT id, user_id, course_id, car_id, time_ms,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY user_id, course_id, car_id
+                       ORDER BY time_ms, id
+                   ) AS rn
+            FROM lap_time
+        )
+        WHERE rn = 1
+    """))
+    conn.execute(db.text(
+        "INSERT INTO lap_time_change (lap_time_id, op) SELECT id, 'insert' FROM lap_time ORDER BY id"))
+    for name in ('lap_time', 'game_title', 'car', 'course'):
+        conn.execute(db.text(
+            'INSERT INTO table_version (name, version) VALUES (:name, 1) '
+            'ON CONFLICT (name) DO UPDATE SET version = version + 1'), {'name': name})
+    return len(all_combos)
+
+def populate(users=50, combos=20, laps=100000, seed=1, game_titles=2):
+    """アプリのデータベースに合成データを一括登録する"""
+    from app import app, db
+
+    started = time.perf_counter()
+    with app.app_context():
+        db.create_all()
+        combo_count = write_dataset(db.session.connection(), users, combos, laps, seed, game_titles)
+        db.session.commit()
+
+    return {
+        'users': users,
+        'combos': combo_count,
+        'laps': laps,
+        'seed': seed,
+        'seconds': round(time.perf_counter() - started, 2)
+    }
+
+def schema_fingerprint(metadata):
+    """テーブルとインデックスの DDL。モデルを変えるとキャッシュのキーも変わる"""
+    from sqlalchemy.dialects import sqlite
+    from sqlalchemy.schema import CreateIndex, CreateTable
+    dialect = sqlite.dialect()
+    ddl = []
+    for table in metadata.sorted_tables:
+        ddl.append(str(CreateTable(table).compile(dialect=dialect)).strip())
+        ddl += sorted(str(CreateIndex(index).compile(dialect=dialect)) for index in table.indexes)
+    return ddl
+
+def fixture_params(laps=10000, users=None, combos=20, seed=1, game_titles=2):
+    return {
+        'laps': laps,
+        'users': users or default_users(laps),
+        'combos': combos,
+        'seed': seed,
+        'game_titles': game_titles
+    }
+
+def fixture_path(params, cache_dir=None):
+    """引数・生成手順・スキーマのハッシュから決まるフィクスチャのパス"""
+    from app import db
+    key = hashlib.sha256(json.dumps({
+        'version': FIXTURE_VERSION,
+        'params': params,
+        'schema': schema_fingerprint(db.metadata)
+    }, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir or FIXTURE_DIR, f"laps{params['laps']}-seed{params['seed']}-{key}.db")
+
+def build_fixture(laps=10000, users=None, combos=20, seed=1, game_titles=2, cache_dir=None, rebuild=False):
+    """app.py のスキーマで合成データ入りの SQLite ファイルを作り、そのパスを返す
+
+    キャッシュにあればそれを返す。作成中のファイルは別名で書き、完成してから置き換えるので、
+    中断しても壊れたフィクスチャが残ることはない。
+    """
+    from sqlalchemy import create_engine, event
+    from app import db
+
+    params = fixture_params(laps, users, combos, seed, game_titles)
+    path = fixture_path(params, cache_dir)
+    if os.path.exists(path) and not rebuild:
+        return path
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f'{path}.{os.getpid()}.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+    engine = create_engine(f'sqlite:///{partial}')
+
+    @event.listens_for(engine, 'connect')
+    def set_fixture_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in FIXTURE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    try:
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            write_dataset(conn, params['users'], params['combos'], params['laps'], params['seed'],
+                          params['game_titles'])
+        engine.dispose()
+        os.replace(partial, path)
+    finally:
+        engine.dispose()
+        if os.path.exists(partial):
+            os.remove(partial)
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description='ベンチマーク用の合成データを作る')
+    parser.add_argument('--users', type=int, help='ユーザー数（省略時は周回数に応じて決める）')
+    parser.add_argument('--combos', type=int, default=20)
+    parser.add_argument('--laps', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--fixture', action='store_true', help='キャッシュ付きのフィクスチャファイルを作る')
+    parser.add_argument('--cache-dir', help=f'フィクスチャの保存先（既定: {FIXTURE_DIR}）')
+    parser.add_argument('--rebuild', action='store_true', help='キャッシュがあっても作り直す')
+    args = parser.parse_args()
+    if args.fixture:
+        started = time.perf_counter()
+        path = build_fixture(args.laps, args.users, args.combos, args.seed,
+                             cache_dir=args.cache_dir, rebuild=args.rebuild)
+        print(f'{path} ({time.perf_counter() - started:.1f}秒)')
+    else:
+        print(populate(args.users or default_users(args.laps), args.combos, args.laps, args.seed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""ラップタイムAPIのベンチマーク
+
+合成データを入れたデータベースに対し、Flask アプリをプロセス内（test_client）で
+シナリオごとに並列に叩き、エンドポイントごとのスループットと p50/p95/p99 を出す。
+結果は benchmarks/results/ に JSON で保存し、--compare でコミット間を比べられる。
+データは datagen.build_fixture() のキャッシュから作業用にコピーして使う。
+
+    python -m benchmarks.run --users 200 --combos 40 --laps 200000
+    python -m benchmarks.run --compare benchmarks/results/a.json benchmarks/results/b.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+def percentile(sorted_values, fraction):
+    """最近傍順位法のパーセンタイル"""
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+class Recorder:
+    """エンドポイントごとの応答時間とステータスを集める"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+
+    def request(self, client, name, method, url, **kwargs):
+        started = time.perf_counter()
+        response = client.open(url, method=method, **kwargs)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            sample = self.samples.setdefault(name, {'latencies': [], 'statuses': {}})
+            sample['latencies'].append(elapsed)
+            sample['statuses'][response.status_code] = sample['statuses'].get(response.status_code, 0) + 1
+        return response
+
+    def summary(self, wall_seconds):
+        results = {}
+        for name, sample in sorted(self.samples.items()):
+            latencies = sorted(sample['latencies'])
+            errors = sum(count for status, count in sample['statuses'].items() if status >= 400)
+            results[name] = {
+                'count': len(latencies),
+                'errors': errors,
+                'statuses': {str(status): count for status, count in sorted(sample['statuses'].items())},
+                'rps': round(len(latencies) / wall_seconds, 1) if wall_seconds else None,
+                'mean_ms': round(1000 * sum(latencies) / len(latencies), 2),
+                'p50_ms': round(1000 * percentile(latencies, 0.50), 2),
+                'p95_ms': round(1000 * percentile(latencies, 0.95), 2),
+                'p99_ms': round(1000 * percentile(latencies, 0.99), 2)
+            }
+        return results
+
+class Context:
+    """シナリオから参照するデータベースの中身（ユーザー名と組み合わせ）"""
+
+    def __init__(self, app, db, User, PersonalBest, Car):
+        with app.app_context():
+            self.usernames = [name for name, in db.session.query(User.username)
+                              .filter(User.username.like('bench%')).order_by(User.id)]
+            self.emails = {name: f'{name}@kamiyama.ac.jp' for name in self.usernames}
+            self.combos = [tuple(row) for row in db.session.query(
+                Car.game_title_id, PersonalBest.car_id, PersonalBest.course_id
+            ).join(Car, PersonalBest.car_id == Car.id).distinct().order_by(PersonalBest.car_id, PersonalBest.course_id)]
+
+# 各シナリオは1回分の操作を行う関数。rng は仮想ユーザーごとに固定のシードを持つ
+def scenario_history(client, rng, ctx, rec):
+    """ラップタイム履歴ページ: カタログと一覧の1〜2ページ目"""
+    rec.request(client, 'GET /api/game-titles', 'GET', '/api/game-titles')
+    query = 'limit=100'
+    if rng.random() < 0.5:
+        game_title_id, car_id, course_id = rng.choice(ctx.combos)
+        query += f'&course_id={course_id}&car_id={car_id}'
+    page = rec.request(client, 'GET /api/lap-times', 'GET', f'/api/lap-times?{query}').get_json()
+    if page and page.get('next_cursor'):
+        rec.request(client, 'GET /api/lap-times (cursor)', 'GET',
+                    f"/api/lap-times?{query}&cursor={page['next_cursor']}")
+
+def scenario_graph(client, rng, ctx, rec):
+    """グラフページ: 車種・コースの一覧、系列と統計"""
+    game_title_id, car_id, course_id = rng.choice(ctx.combos)
+    rec.request(client, 'GET /api/cars', 'GET', f'/api/cars?game_title_id={game_title_id}')
+    rec.request(client, 'GET /api/courses', 'GET', f'/api/courses?game_title_id={game_title_id}')
+    rec.request(client, 'GET /api/lap-series', 'GET', f'/api/lap-series?course_id={course_id}&car_id={car_id}')
+    rec.request(client, 'GET /api/stats', 'GET', f'/api/stats?course_id={course_id}&car_id={car_id}')
+
+def scenario_leaderboard(client, rng, ctx, rec):
+    game_title_id, car_id, course_id = rng.choice(ctx.combos)
+    query = f'course_id={course_id}&car_id={car_id}'
+    rec.request(client, 'GET /api/leaderboard', 'GET', f'/api/leaderboard?{query}')
+    rec.request(client, 'GET /api/leaderboard (around=me)', 'GET', f'/api/leaderboard?{query}&around=me')
+
+def scenario_insert_burst(client, rng, ctx, rec):
+    """走行直後にまとめて記録する: 同じ組み合わせに10周分"""
+    game_title_id, car_id, course_id = rng.choice(ctx.combos)
+    base_ms = rng.randint(60000, 150000)
+    for _ in range(10):
+        time_ms = base_ms + rng.randint(0, 3000)
+        rec.request(client, 'POST /api/lap-times', 'POST', '/api/lap-times', json={
+            'game_title_id': game_title_id,
+            'car_id': car_id,
+            'course_id': course_id,
+            'time': f'{time_ms // 60000}:{time_ms // 1000 % 60:02d}.{time_ms % 1000:03d}'
+        })
+
+def scenario_login_storm(client, rng, ctx, rec):
+    """イベント開始時に全員が一斉にログインする"""
+    from benchmarks.datagen import BENCH_PASSWORD
+    username = rng.choice(ctx.usernames)
+    rec.request(client, 'POST /api/login', 'POST', '/api/login',
+                json={'email': ctx.emails[username], 'password': BENCH_PASSWORD})
+
+SCENARIOS = {
+    'history': scenario_history,
+    'graph': scenario_graph,
+    'leaderboard': scenario_leaderboard,
+    'insert_burst': scenario_insert_burst,
+    'login_storm': scenario_login_storm,
+}
+
+def run_scenario(app, ctx, scenario, iterations, concurrency, seed):
+    """iterations 回の操作を concurrency 人の仮想ユーザーで分担して実行する"""
+    from benchmarks.datagen import BENCH_PASSWORD
+    rec = Recorder()
+
+    def virtual_user(worker):
+        rng = random.Random(f'{seed}-{worker}')
+        client = app.test_client()
+        username = ctx.usernames[worker % len(ctx.usernames)]
+        client.post('/api/login', json={'email': ctx.emails[username], 'password': BENCH_PASSWORD})
+        for _ in range(worker, iterations, concurrency):
+            scenario(client, rng, ctx, rec)
+
+    started = time.perf_counter()
+    if concurrency == 1:
+        virtual_user(0)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(virtual_user, worker) for worker in range(concurrency)]:
+                future.result()
+    wall_seconds = time.perf_counter() - started
+    return {'seconds': round(wall_seconds, 2), 'endpoints': rec.summary(wall_seconds)}
+
+def run_all(app, scenarios, iterations, concurrency, seed):
+    from app import db, User, PersonalBest, Car
+    ctx = Context(app, db, User, PersonalBest, Car)
+    return {name: run_scenario(app, ctx, SCENARIOS[name], iterations, concurrency, seed) for name in scenarios}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results):
+    print(f"{'scenario':<13} {'endpoint':<34} {'count':>6} {'err':>4} {'rps':>8} "
+          f"{'p50ms':>8} {'p95ms':>8} {'p99ms':>8}")
+    for scenario, result in results.items():
+        for endpoint, r in result['endpoints'].items():
+            print(f"{scenario:<13} {endpoint:<34} {r['count']:>6} {r['errors']:>4} {r['rps']:>8} "
+                  f"{r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8}")
+
+def compare(old_path, new_path):
+    """2つの結果ファイルの p50/p95 とスループットを比べる"""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old['meta'].get('commit')} -> {new['meta'].get('commit')}")
+    print(f"{'scenario':<13} {'endpoint':<34} {'p50ms':>17} {'p95ms':>17} {'rps':>17}")
+    for scenario, result in new['results'].items():
+        for endpoint, r in result['endpoints'].items():
+            before = old['results'].get(scenario, {}).get('endpoints', {}).get(endpoint)
+            cells = []
+            for key in ('p50_ms', 'p95_ms', 'rps'):
+                if before and before[key]:
+                    cells.append(f"{r[key]:>8} ({(r[key] - before[key]) / before[key]:+.0%})")
+                else:
+                    cells.append(f"{r[key]:>8} (new)")
+            print(f"{scenario:<13} {endpoint:<34} " + ' '.join(f'{c:>17}' for c in cells))
+
+def main():
+    parser = argparse.ArgumentParser(description='ラップタイムAPIのベンチマーク')
+    parser.add_argument('--db', help='使用するSQLiteファイル（省略時はキャッシュ済みのフィクスチャのコピー）')
+    parser.add_argument('--users', type=int, help='ユーザー数（省略時は周回数に応じて決める）')
+    parser.add_argument('--combos', type=int, default=20)
+    parser.add_argument('--laps', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=200, help='シナリオごとの操作回数')
+    parser.add_argument('--concurrency', type=int, default=4, help='並列に動かす仮想ユーザー数')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='実行するシナリオ（複数指定可。省略時はすべて）')
+    parser.add_argument('--output', help='結果のJSONの保存先')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='2つの結果を比較して終了')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    # 書き込みのシナリオがあるので、キャッシュ済みのフィクスチャは作業用にコピーして使う
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix='gtr-bench-'), 'bench.db')
+    # app は読み込み時に DATABASE_URL を見るため、先に設定してから読み込む
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(db_path)}'
+    from benchmarks.datagen import build_fixture, fixture_params
+    from app import app, db
+    app.config['TESTING'] = True
+
+    dataset = None
+    if not args.db:
+        dataset = fixture_params(args.laps, args.users, args.combos, args.seed)
+        started = time.perf_counter()
+        fixture = build_fixture(**dataset)
+        print(f'フィクスチャ: {fixture} ({time.perf_counter() - started:.1f}秒)')
+        # 開いている接続があれば閉じてから差し替える
+        with app.app_context():
+            db.engine.dispose()
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        shutil.copyfile(fixture, db_path)
+
+    scenarios = args.scenario or list(SCENARIOS)
+    results = run_all(app, scenarios, args.iterations, args.concurrency, args.seed)
+    print_results(results)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'db': os.path.abspath(db_path),
+            'dataset': dataset,
+            'iterations': args.iterations,
+            'concurrency': args.concurrency,
+            'seed': args.seed
+        },
+        'results': results
+    }
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{report['meta']['commit'] or 'nogit'}.json")
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f'結果を保存しました: {output}')
+
+if __name__ == '__main__':
+    main()
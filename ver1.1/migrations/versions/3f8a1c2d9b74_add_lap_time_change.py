@@ -0,0 +1,36 @@
+"""add lap_time_change
+
+Revision ID: 3f8a1c2d9b74
+Revises: ed15aa0e3c28
+Create Date: 2026-10-18 15:12:41.208337
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f8a1c2d9b74'
+down_revision = 'ed15aa0e3c28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('lap_time_change',
+    sa.Column('seq', sa.Integer(), nullable=False),
+    sa.Column('lap_time_id', sa.Integer(), nullable=False),
+    sa.Column('op', sa.String(length=6), nullable=False),
+    sa.PrimaryKeyConstraint('seq'),
+    sqlite_autoincrement=True
+    )
+
+    # 既存のラップタイムを追加の履歴として登録する（since=0 で全件を取得できるように）
+    op.execute("""
+        INSERT INTO lap_time_change (lap_time_id, op)
+        SELECT id, 'insert' FROM lap_time ORDER BY id
+    """)
+
+
+def downgrade():
+    op.drop_table('lap_time_change')
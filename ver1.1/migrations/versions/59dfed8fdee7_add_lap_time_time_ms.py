@@ -0,0 +1,66 @@
+"""add lap_time.time_ms
+
+Revision ID: 59dfed8fdee7
+Revises: 6342b1e30b06
+Create Date: 2026-10-18 10:14:37.205116
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '59dfed8fdee7'
+down_revision = '6342b1e30b06'
+branch_labels = None
+depends_on = None
+
+# マイグレーション時点の形式を固定するため app.parse_lap_time は使わない
+LAP_TIME_PATTERN = re.compile(r'^(\d{1,2}):(\d{2})\.(\d{3})$')
+
+
+def parse_lap_time(time_str):
+    match = LAP_TIME_PATTERN.match((time_str or '').strip())
+    if not match:
+        return None
+    minutes, seconds, millis = (int(g) for g in match.groups())
+    if seconds >= 60:
+        return None
+    return (minutes * 60 + seconds) * 1000 + millis
+
+
+def upgrade():
+    with op.batch_alter_table('lap_time', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('time_ms', sa.Integer(), nullable=True))
+
+    # 既存の MM:SS.mmm 文字列からミリ秒を埋める（解釈できない行は NULL のまま）
+    conn = op.get_bind()
+    lap_time = sa.table('lap_time',
+        sa.column('id', sa.Integer()),
+        sa.column('time', sa.String()),
+        sa.column('time_ms', sa.Integer()),
+    )
+    rows = conn.execute(sa.select(lap_time.c.id, lap_time.c.time)).fetchall()
+    params = [
+        {'lap_id': row.id, 'time_ms': time_ms}
+        for row in rows
+        if (time_ms := parse_lap_time(row.time)) is not None
+    ]
+    if params:
+        conn.execute(
+            lap_time.update()
+            .where(lap_time.c.id == sa.bindparam('lap_id'))
+            .values(time_ms=sa.bindparam('time_ms')),
+            params
+        )
+
+    with op.batch_alter_table('lap_time', schema=None) as batch_op:
+        batch_op.create_index('ix_lap_time_course_car_time_ms', ['course_id', 'car_id', 'time_ms'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('lap_time', schema=None) as batch_op:
+        batch_op.drop_index('ix_lap_time_course_car_time_ms')
+        batch_op.drop_column('time_ms')
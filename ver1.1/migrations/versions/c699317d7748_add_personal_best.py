@@ -0,0 +1,56 @@
+"""add personal_best
+
+Revision ID: c699317d7748
+Revises: 59dfed8fdee7
+Create Date: 2026-10-18 11:05:48.319572
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c699317d7748'
+down_revision = '59dfed8fdee7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('personal_best',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('course_id', sa.Integer(), nullable=False),
+    sa.Column('car_id', sa.Integer(), nullable=False),
+    sa.Column('lap_time_id', sa.Integer(), nullable=False),
+    sa.Column('time_ms', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['car_id'], ['car.id'], ),
+    sa.ForeignKeyConstraint(['course_id'], ['course.id'], ),
+    sa.ForeignKeyConstraint(['lap_time_id'], ['lap_time.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'course_id', 'car_id')
+    )
+    with op.batch_alter_table('personal_best', schema=None) as batch_op:
+        batch_op.create_index('ix_personal_best_course_car_time_ms', ['course_id', 'car_id', 'time_ms'], unique=False)
+
+    # 既存のラップタイムから自己ベストを作成する（同タイムは先に記録したラップを優先）
+    op.execute("""
+        INSERT INTO personal_best (user_id, course_id, car_id, lap_time_id, time_ms)
+        SELECT user_id, course_id, car_id, id, time_ms
+        FROM (
+            SELECT id, user_id, course_id, car_id, time_ms,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY user_id, course_id, car_id
+                       ORDER BY time_ms, id
+                   ) AS rn
+            FROM lap_time
+            WHERE time_ms IS NOT NULL
+        )
+        WHERE rn = 1
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('personal_best', schema=None) as batch_op:
+        batch_op.drop_index('ix_personal_best_course_car_time_ms')
+
+    op.drop_table('personal_best')
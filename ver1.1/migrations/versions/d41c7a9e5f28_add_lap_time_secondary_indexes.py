@@ -0,0 +1,47 @@
+"""add secondary indexes for lap_time, car and course
+
+Revision ID: d41c7a9e5f28
+Revises: 8b2e4f6a0c13
+Create Date: 2026-10-18 18:05:13.417260
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41c7a9e5f28'
+down_revision = '8b2e4f6a0c13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 一覧の絞り込み（組み合わせ・ユーザー・ゲーム）ごとに新しい順で読める索引と、全体のタイム順・新しい順の索引
+    with op.batch_alter_table('lap_time', schema=None) as batch_op:
+        batch_op.create_index('ix_lap_time_course_car_created_at', ['course_id', 'car_id', 'created_at'], unique=False)
+        batch_op.create_index('ix_lap_time_user_created_at', ['user_id', 'created_at'], unique=False)
+        batch_op.create_index('ix_lap_time_game_title_created_at', ['game_title_id', 'created_at'], unique=False)
+        batch_op.create_index('ix_lap_time_created_at', ['created_at'], unique=False)
+        batch_op.create_index('ix_lap_time_time_ms', ['time_ms'], unique=False)
+
+    with op.batch_alter_table('car', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_car_game_title_id'), ['game_title_id'], unique=False)
+
+    with op.batch_alter_table('course', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_course_game_title_id'), ['game_title_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('course', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_course_game_title_id'))
+
+    with op.batch_alter_table('car', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_car_game_title_id'))
+
+    with op.batch_alter_table('lap_time', schema=None) as batch_op:
+        batch_op.drop_index('ix_lap_time_time_ms')
+        batch_op.drop_index('ix_lap_time_created_at')
+        batch_op.drop_index('ix_lap_time_game_title_created_at')
+        batch_op.drop_index('ix_lap_time_user_created_at')
+        batch_op.drop_index('ix_lap_time_course_car_created_at')
@@ -29,7 +29,7 @@ pip install -r requirements.txt
 # データベースのリセット
 echo "データベースをリセット中..."
 rm -f instance/gtrsb.sqlite3
-python3 -c "from app import app, db; app.app_context().push(); db.create_all()"
+flask --app app init-db
 
 # アプリケーションの起動
 echo "アプリケーションを起動中..."
@@ -65,7 +65,7 @@ pip install -r requirements.txt
 
 # データベースのリセット
 rm -f ../instance/gtrsb.sqlite3
-python3 -c "from app import app, db; app.app_context().push(); db.create_all()"
+flask --app app init-db
 
 # アプリケーションの起動
 echo "アプリケーションを起動中..."
@@ -0,0 +1,1031 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+# テストではメモリ上のデータベースを使用する
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import unittest
+import json
+import gzip
+import csv
+import io
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from app import (app, db, User, GameTitle, Car, Course, LapTime, PersonalBest,
+                 parse_lap_time, format_lap_time, downsample_lttb, catalog_cache, TTLCache,
+                 user_cache, password_hasher, login_throttle, PasswordHasher, PasswordHasherBusy,
+                 lap_events, LapEventBroker, bump_table_version)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class TestLapTimes(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.register_user('kmc0001@kamiyama.ac.jp', '1234', 'driver1')
+        self.login_user('kmc0001@kamiyama.ac.jp', '1234')
+        self.create_test_data()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def register_user(self, email, password, username):
+        return self.client.post('/api/register', json={
+            'email': email,
+            'password': password,
+            'username': username
+        })
+
+    def login_user(self, email, password):
+        return self.client.post('/api/login', json={'email': email, 'password': password})
+
+    def create_test_data(self):
+        user = User.query.filter_by(username='driver1').first()
+        game_title = GameTitle(name='Test Game')
+        db.session.add(game_title)
+        db.session.flush()
+        self.car = Car(name='Test Car', game_title_id=game_title.id)
+        self.other_car = Car(name='Other Car', game_title_id=game_title.id)
+        self.course = Course(name='Test Course', game_title_id=game_title.id)
+        db.session.add_all([self.car, self.other_car, self.course])
+        db.session.flush()
+        base = datetime(2025, 1, 1)
+        # 同一時刻のラップを含めてキーセットの境界を確認できるようにする
+        for i in range(7):
+            time = f'01:{30 + (i * 3) % 7:02d}.000'
+            db.session.add(LapTime(
+                user_id=user.id,
+                game_title_id=game_title.id,
+                car_id=self.car.id if i % 2 == 0 else self.other_car.id,
+                course_id=self.course.id,
+                time=time,
+                time_ms=parse_lap_time(time),
+                created_at=base + timedelta(minutes=i // 2)
+            ))
+        db.session.commit()
+
+    def collect_pages(self, query):
+        ids = []
+        cursor = None
+        while True:
+            url = f'/api/lap-times?{query}' + (f'&cursor={cursor}' if cursor else '')
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(lap['id'] for lap in response.json['lap_times'])
+            cursor = response.json['next_cursor']
+            if not cursor:
+                return ids
+
+    def test_get_lap_times_first_page(self):
+        response = self.client.get('/api/lap-times?limit=3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json['lap_times']), 3)
+        self.assertIsNotNone(response.json['next_cursor'])
+
+    def test_get_lap_times_keyset_pages(self):
+        """ページを辿ると (created_at, id) の降順で重複なく全件取得できる"""
+        ids = self.collect_pages('limit=2')
+        expected = [lap.id for lap in LapTime.query.order_by(
+            LapTime.created_at.desc(), LapTime.id.desc())]
+        self.assertEqual(ids, expected)
+
+    def test_get_lap_times_ascending(self):
+        ids = self.collect_pages('limit=2&sort=created_at')
+        expected = [lap.id for lap in LapTime.query.order_by(
+            LapTime.created_at.asc(), LapTime.id.asc())]
+        self.assertEqual(ids, expected)
+
+    def test_get_lap_times_filter(self):
+        ids = self.collect_pages(f'limit=2&car_id={self.car.id}&course_id={self.course.id}')
+        self.assertEqual(len(ids), 4)
+        self.assertTrue(all(db.session.get(LapTime, i).car_id == self.car.id for i in ids))
+
+    def test_get_lap_times_sorted_by_time(self):
+        ids = self.collect_pages('limit=2&sort=time')
+        expected = [lap.id for lap in LapTime.query.order_by(
+            LapTime.time_ms.asc(), LapTime.id.asc())]
+        self.assertEqual(ids, expected)
+        ids = self.collect_pages('limit=2&sort=-time')
+        self.assertEqual(ids, expected[::-1])
+
+    def test_sort_by_time_skips_unparsed_legacy_laps(self):
+        """移行時に time_ms を埋められなかったラップがあってもタイム順のページを辿れる"""
+        lap = LapTime.query.first()
+        db.session.add(LapTime(user_id=lap.user_id, game_title_id=lap.game_title_id, car_id=lap.car_id,
+                               course_id=lap.course_id, time='1:29.5', time_ms=None, created_at=datetime(2025, 1, 2)))
+        db.session.commit()
+        expected = [lap.id for lap in LapTime.query.filter(LapTime.time_ms.isnot(None)).order_by(
+            LapTime.time_ms.asc(), LapTime.id.asc())]
+        self.assertEqual(self.collect_pages('limit=2&sort=time'), expected)
+        self.assertEqual(self.collect_pages('limit=2&sort=-time'), expected[::-1])
+        # 日時順では従来どおり含まれる
+        self.assertEqual(len(self.collect_pages('limit=2')), len(expected) + 1)
+
+    def test_parse_lap_time(self):
+        self.assertEqual(parse_lap_time('1:23.456'), 83456)
+        self.assertEqual(parse_lap_time('01:02.003'), 62003)
+        self.assertEqual(format_lap_time(83456), '1:23.456')
+        for invalid in ['1:60.000', '1:23', 'abc', None, 83.456]:
+            with self.assertRaises(ValueError):
+                parse_lap_time(invalid)
+
+    def test_add_lap_time_stores_time_ms(self):
+        response = self.client.post('/api/lap-times', json={
+            'game_title_id': self.car.game_title_id,
+            'car_id': self.car.id,
+            'course_id': self.course.id,
+            'time': '1:23.456'
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['time_ms'], 83456)
+        self.assertEqual(db.session.get(LapTime, response.json['id']).time_ms, 83456)
+
+    def test_add_lap_time_invalid_format(self):
+        response = self.client.post('/api/lap-times', json={
+            'game_title_id': self.car.game_title_id,
+            'car_id': self.car.id,
+            'course_id': self.course.id,
+            'time': '83.456'
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.json)
+
+    def test_get_stats(self):
+        response = self.client.get(f'/api/stats?course_id={self.course.id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {
+            'count': 7,
+            'best_ms': 90000,
+            'mean_ms': 93000,
+            'median_ms': 93000,
+            'p90_ms': 95400,
+            'stddev_ms': 2000
+        })
+
+    def test_get_stats_no_laps(self):
+        response = self.client.get('/api/stats?course_id=9999')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['count'], 0)
+        self.assertIsNone(response.json['best_ms'])
+
+    def test_get_lap_times_conditional(self):
+        """ETag が一致すれば 304、ラップ追加後は新しい ETag で 200 を返す"""
+        response = self.client.get('/api/lap-times?limit=3')
+        etag = response.headers['ETag']
+        self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
+        response = self.client.get('/api/lap-times?limit=3', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        self.client.post('/api/lap-times', json={
+            'game_title_id': self.car.game_title_id,
+            'car_id': self.car.id,
+            'course_id': self.course.id,
+            'time': '1:23.456'
+        })
+        response = self.client.get('/api/lap-times?limit=3', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_get_lap_times_invalid_params(self):
+        self.assertEqual(self.client.get('/api/lap-times?cursor=invalid').status_code, 400)
+        self.assertEqual(self.client.get('/api/lap-times?sort=memo').status_code, 400)
+        self.assertEqual(self.client.get('/api/lap-times?limit=0').status_code, 400)
+        self.assertEqual(self.client.get('/api/lap-times?car_id=abc').status_code, 400)
+
+    def test_get_lap_times_cursor_sort_mismatch(self):
+        cursor = self.client.get('/api/lap-times?limit=2').json['next_cursor']
+        response = self.client.get(f'/api/lap-times?limit=2&sort=created_at&cursor={cursor}')
+        self.assertEqual(response.status_code, 400)
+
+class TestLapTimesFormats(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        game_title = GameTitle(name='Test Game')
+        db.session.add(game_title)
+        db.session.flush()
+        cars = [Car(name=f'Car {i}', game_title_id=game_title.id) for i in range(2)]
+        course = Course(name='Test Course', game_title_id=game_title.id)
+        db.session.add_all(cars + [course])
+        db.session.commit()
+        for i in range(1, 3):
+            self.client.post('/api/register', json={
+                'email': f'kmc000{i}@kamiyama.ac.jp',
+                'password': '1234',
+                'username': f'driver{i}'
+            })
+            self.client.post('/api/login', json={'email': f'kmc000{i}@kamiyama.ac.jp', 'password': '1234'})
+            for j in range(30):
+                self.client.post('/api/lap-times', json={
+                    'game_title_id': game_title.id,
+                    'car_id': cars[j % 2].id,
+                    'course_id': course.id,
+                    'time': f'1:{j + 10:02d}.{i:03d}'
+                })
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_columnar_matches_objects(self):
+        objects = self.client.get('/api/lap-times?limit=50&sort=time').json
+        body = self.client.get('/api/lap-times?limit=50&sort=time&format=columnar').json
+        columns, dictionaries = body['lap_times'], body['dictionaries']
+        self.assertEqual(body['next_cursor'], objects['next_cursor'])
+        self.assertEqual(len(dictionaries['car_id']), 2)
+        self.assertEqual(dictionaries['username'], ['driver1', 'driver2'])
+
+        decoded = [{
+            'id': columns['id'][i],
+            'time_ms': columns['time_ms'][i],
+            'created_at': columns['created_at'][i],
+            'car_id': dictionaries['car_id'][columns['car'][i]],
+            'course_id': dictionaries['course_id'][columns['course'][i]],
+            'game_title_id': dictionaries['game_title_id'][columns['game_title'][i]],
+            'user_id': dictionaries['user_id'][columns['user'][i]],
+            'username': dictionaries['username'][columns['user'][i]]
+        } for i in range(len(columns['id']))]
+        self.assertEqual(decoded, [{key: lap[key] for key in decoded[0]} for lap in objects['lap_times']])
+
+    def test_invalid_format(self):
+        self.assertEqual(self.client.get('/api/lap-times?format=xml').status_code, 400)
+
+    def test_gzip_response(self):
+        plain = self.client.get('/api/lap-times?limit=60')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        response = self.client.get('/api/lap-times?limit=60', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertLess(len(response.data), len(plain.data) / 3)
+        self.assertEqual(json.loads(gzip.decompress(response.data)), plain.json)
+
+    @unittest.skipIf(brotli is None, 'brotli がインストールされていません')
+    def test_brotli_response(self):
+        plain = self.client.get('/api/lap-times?limit=60&format=columnar')
+        response = self.client.get('/api/lap-times?limit=60&format=columnar',
+                                   headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertEqual(json.loads(brotli.decompress(response.data)), plain.json)
+
+    def test_small_response_is_not_compressed(self):
+        response = self.client.get('/api/lap-times?limit=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+class TestLapExport(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        game_title = GameTitle(name='Test Game')
+        db.session.add(game_title)
+        db.session.flush()
+        cars = [Car(name=f'Car {i}', game_title_id=game_title.id) for i in range(2)]
+        course = Course(name='Test Course', game_title_id=game_title.id)
+        db.session.add_all(cars + [course])
+        db.session.flush()
+        user = User(username='driver1', email='kmc0001@kamiyama.ac.jp', password_hash='-')
+        db.session.add(user)
+        db.session.flush()
+        self.car_ids = [car.id for car in cars]
+        # チャンクをまたぐ件数を直接登録する
+        base = datetime(2026, 1, 1)
+        db.session.add_all([LapTime(
+            user_id=user.id,
+            game_title_id=game_title.id,
+            car_id=self.car_ids[i % 2],
+            course_id=course.id,
+            time=format_lap_time(60000 + i),
+            time_ms=60000 + i,
+            memo='メモ, "引用"' if i == 0 else '',
+            created_at=base + timedelta(seconds=i)
+        ) for i in range(2500)])
+        db.session.commit()
+        self.client.post('/api/register', json={
+            'email': 'kmc0002@kamiyama.ac.jp',
+            'password': '1234',
+            'username': 'driver2'
+        })
+        self.client.post('/api/login', json={'email': 'kmc0002@kamiyama.ac.jp', 'password': '1234'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_csv_export_streams_all_rows(self):
+        response = self.client.get('/api/export/laps.csv', buffered=False)
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertTrue(response.is_streamed)
+        self.assertIn('attachment', response.headers['Content-Disposition'])
+        chunks = list(response.response)
+        response.close()
+        # ヘッダーと EXPORT_CHUNK_ROWS 件ごとのチャンクに分かれて送られる
+        self.assertGreaterEqual(len(chunks), 4)
+        rows = list(csv.reader(io.StringIO(b''.join(chunks).decode('utf-8'))))
+        self.assertEqual(rows[0][:3], ['id', 'time', 'time_ms'])
+        self.assertEqual(len(rows), 2501)
+        self.assertEqual(rows[1][3], 'メモ, "引用"')
+        self.assertEqual(rows[1][6], 'Test Game')
+        self.assertEqual(rows[1][12], 'driver1')
+
+    def test_ndjson_export_applies_filters(self):
+        response = self.client.get(f'/api/export/laps.ndjson?car_id={self.car_ids[1]}')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        laps = [json.loads(line) for line in response.data.decode('utf-8').splitlines()]
+        self.assertEqual(len(laps), 1250)
+        self.assertTrue(all(lap['car_id'] == self.car_ids[1] for lap in laps))
+        self.assertEqual(laps[0]['time_ms'], 60001)
+        self.assertEqual(laps[0]['created_at'], '2026-01-01T00:00:01')
+
+    def test_export_rejects_bad_filter_and_format(self):
+        self.assertEqual(self.client.get('/api/export/laps.csv?car_id=x').status_code, 400)
+        self.assertEqual(self.client.get('/api/export/laps.xml').status_code, 404)
+
+class TestPersonalBests(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        game_title = GameTitle(name='Test Game')
+        db.session.add(game_title)
+        db.session.flush()
+        car = Car(name='Test Car', game_title_id=game_title.id)
+        course = Course(name='Test Course', game_title_id=game_title.id)
+        db.session.add_all([car, course])
+        db.session.commit()
+        self.combo = {'game_title_id': game_title.id, 'car_id': car.id, 'course_id': course.id}
+        for i in range(1, 3):
+            self.client.post('/api/register', json={
+                'email': f'kmc000{i}@kamiyama.ac.jp',
+                'password': '1234',
+                'username': f'driver{i}'
+            })
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login_as(self, i):
+        self.client.post('/api/login', json={'email': f'kmc000{i}@kamiyama.ac.jp', 'password': '1234'})
+
+    def add_lap(self, time):
+        response = self.client.post('/api/lap-times', json=dict(self.combo, time=time))
+        self.assertEqual(response.status_code, 200)
+        return response.json['id']
+
+    def leaderboard(self):
+        response = self.client.get(
+            f"/api/personal-bests?course_id={self.combo['course_id']}&car_id={self.combo['car_id']}")
+        self.assertEqual(response.status_code, 200)
+        return [(pb['username'], pb['time']) for pb in response.json]
+
+    def test_insert_updates_personal_best(self):
+        self.login_as(1)
+        self.add_lap('1:05.000')
+        self.add_lap('1:03.500')
+        self.add_lap('1:04.000')
+        self.login_as(2)
+        self.add_lap('1:04.250')
+        self.assertEqual(self.leaderboard(), [('driver1', '1:03.500'), ('driver2', '1:04.250')])
+
+    def test_delete_falls_back_to_next_best(self):
+        self.login_as(1)
+        self.add_lap('1:05.000')
+        best = self.add_lap('1:03.500')
+        self.add_lap('1:04.000')
+        self.client.delete(f'/api/lap-times/{best}')
+        self.assertEqual(self.leaderboard(), [('driver1', '1:04.000')])
+
+    def test_delete_last_lap_removes_personal_best(self):
+        self.login_as(1)
+        lap_id = self.add_lap('1:05.000')
+        self.client.delete(f'/api/lap-times/{lap_id}')
+        self.assertEqual(self.leaderboard(), [])
+        self.assertEqual(PersonalBest.query.count(), 0)
+
+    def test_delete_non_best_keeps_personal_best(self):
+        self.login_as(1)
+        self.add_lap('1:03.500')
+        slower = self.add_lap('1:05.000')
+        self.client.delete(f'/api/lap-times/{slower}')
+        self.assertEqual(self.leaderboard(), [('driver1', '1:03.500')])
+
+    def test_personal_bests_requires_combo(self):
+        self.login_as(1)
+        self.assertEqual(self.client.get('/api/personal-bests').status_code, 400)
+
+class TestLeaderboard(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        game_title = GameTitle(name='Test Game')
+        db.session.add(game_title)
+        db.session.flush()
+        car = Car(name='Test Car', game_title_id=game_title.id)
+        course = Course(name='Test Course', game_title_id=game_title.id)
+        db.session.add_all([car, course])
+        db.session.commit()
+        self.combo = {'game_title_id': game_title.id, 'car_id': car.id, 'course_id': course.id}
+        self.url = f"/api/leaderboard?course_id={course.id}&car_id={car.id}"
+        # driver3 と driver4 は同タイム
+        self.times = {1: ['1:05.000', '1:02.000'], 2: ['1:03.000'], 3: ['1:04.000'], 4: ['1:04.000'], 5: ['1:10.000']}
+        for i, times in self.times.items():
+            self.client.post('/api/register', json={
+                'email': f'kmc000{i}@kamiyama.ac.jp',
+                'password': '1234',
+                'username': f'driver{i}'
+            })
+            self.login_as(i)
+            for time in times:
+                self.client.post('/api/lap-times', json=dict(self.combo, time=time))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login_as(self, i):
+        self.client.post('/api/login', json={'email': f'kmc000{i}@kamiyama.ac.jp', 'password': '1234'})
+
+    def test_leaderboard_ranks_best_laps(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        body = response.json
+        self.assertEqual(body['total'], 5)
+        entries = body['entries']
+        self.assertEqual([(e['username'], e['rank'], e['gap_ms']) for e in entries], [
+            ('driver1', 1, 0),
+            ('driver2', 2, 1000),
+            ('driver3', 3, 2000),
+            ('driver4', 3, 2000),
+            ('driver5', 5, 8000),
+        ])
+        self.assertEqual(entries[0]['time'], '1:02.000')
+        self.assertEqual([e['percentile'] for e in entries], [100.0, 75.0, 50.0, 50.0, 0.0])
+        self.assertEqual(len(self.client.get(self.url + '&limit=2').json['entries']), 2)
+
+    def test_around_me(self):
+        self.login_as(4)
+        response = self.client.get(self.url + '&around=me&span=1')
+        self.assertIn('Cookie', response.headers['Vary'])
+        entries = response.json['entries']
+        self.assertEqual([e['username'] for e in entries], ['driver3', 'driver4', 'driver5'])
+        self.assertEqual([e['is_me'] for e in entries], [False, True, False])
+
+    def test_around_me_without_personal_best(self):
+        self.client.post('/api/register', json={
+            'email': 'kmc0009@kamiyama.ac.jp',
+            'password': '1234',
+            'username': 'driver9'
+        })
+        self.login_as(9)
+        body = self.client.get(self.url + '&around=me').json
+        self.assertEqual((body['total'], body['entries']), (5, []))
+
+    def test_leaderboard_validation(self):
+        self.assertEqual(self.client.get('/api/leaderboard').status_code, 400)
+        self.assertEqual(self.client.get(self.url + '&around=you').status_code, 400)
+
+class TestLapSeries(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client.post('/api/register', json={
+            'email': 'kmc0001@kamiyama.ac.jp',
+            'password': '1234',
+            'username': 'driver1'
+        })
+        self.client.post('/api/login', json={'email': 'kmc0001@kamiyama.ac.jp', 'password': '1234'})
+        user = User.query.filter_by(username='driver1').first()
+        game_title = GameTitle(name='Test Game')
+        db.session.add(game_title)
+        db.session.flush()
+        self.car = Car(name='Test Car', game_title_id=game_title.id)
+        self.course = Course(name='Test Course', game_title_id=game_title.id)
+        db.session.add_all([self.car, self.course])
+        db.session.flush()
+        base = datetime(2025, 1, 1)
+        # 徐々に速くなりつつばらつくタイム列
+        self.times = [90000 - i + (i * 7919) % 1500 for i in range(1000)]
+        db.session.add_all([LapTime(
+            user_id=user.id,
+            game_title_id=game_title.id,
+            car_id=self.car.id,
+            course_id=self.course.id,
+            time=format_lap_time(time_ms),
+            time_ms=time_ms,
+            created_at=base + timedelta(minutes=i)
+        ) for i, time_ms in enumerate(self.times)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_downsample_lttb(self):
+        points = [(i, (i * 37) % 101) for i in range(500)]
+        indices = downsample_lttb(points, 50)
+        self.assertEqual(len(indices), 50)
+        self.assertEqual(indices[0], 0)
+        self.assertEqual(indices[-1], 499)
+        self.assertEqual(indices, sorted(indices))
+        self.assertEqual(downsample_lttb(points[:10], 50), list(range(10)))
+
+    def test_lap_series_is_bounded_and_keeps_personal_bests(self):
+        response = self.client.get(
+            f'/api/lap-series?course_id={self.course.id}&car_id={self.car.id}&points=100')
+        self.assertEqual(response.status_code, 200)
+        series, = response.json
+        self.assertEqual(series['total'], 1000)
+        self.assertLessEqual(len(series['points']), 100)
+
+        attempts = [point[0] for point in series['points']]
+        self.assertEqual(attempts, sorted(attempts))
+        # 自己ベスト更新点はすべて含まれる
+        best = None
+        for attempt, time_ms in enumerate(self.times, 1):
+            if best is None or time_ms < best:
+                best = time_ms
+                self.assertIn([attempt, time_ms], [point[:2] for point in series['points']])
+
+    def test_lap_series_is_bounded_when_every_lap_is_personal_best(self):
+        # 毎回自己ベストを更新するタイム列
+        db.session.query(LapTime).update({LapTime.time_ms: 100000 - LapTime.id})
+        db.session.commit()
+        for points in (3, 4, 50):
+            with self.subTest(points=points):
+                response = self.client.get(
+                    f'/api/lap-series?course_id={self.course.id}&car_id={self.car.id}&points={points}')
+                series, = response.json
+                self.assertLessEqual(len(series['points']), points)
+                attempts = [point[0] for point in series['points']]
+                # 最初と最新の自己ベストは残る
+                self.assertEqual(attempts[0], 1)
+                self.assertEqual(attempts[-1], 1000)
+                self.assertEqual(attempts, sorted(set(attempts)))
+
+    def test_lap_series_requires_combo(self):
+        self.assertEqual(self.client.get(f'/api/lap-series?course_id={self.course.id}').status_code, 400)
+
+class TestCatalogCache(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        catalog_cache.clear()
+        self.client.post('/api/register', json={
+            'email': 'kmc0001@kamiyama.ac.jp',
+            'password': '1234',
+            'username': 'driver1'
+        })
+        self.client.post('/api/login', json={'email': 'kmc0001@kamiyama.ac.jp', 'password': '1234'})
+        self.game_title_id = self.client.post('/api/game-titles', json={'name': 'Test Game'}).json['id']
+
+    def tearDown(self):
+        catalog_cache.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_catalog_requests_are_cached(self):
+        before = self.client.get('/api/catalog-cache').json
+        self.client.get(f'/api/cars?game_title_id={self.game_title_id}')
+        self.client.get(f'/api/cars?game_title_id={self.game_title_id}')
+        self.client.get('/api/cars')
+        after = self.client.get('/api/catalog-cache').json
+        self.assertEqual(after['misses'] - before['misses'], 2)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+
+    def test_add_invalidates_cache(self):
+        self.assertEqual(self.client.get(f'/api/courses?game_title_id={self.game_title_id}').json, [])
+        self.client.post('/api/courses', json={'name': 'Test Course', 'game_title_id': self.game_title_id})
+        courses = self.client.get(f'/api/courses?game_title_id={self.game_title_id}').json
+        self.assertEqual([course['name'] for course in courses], ['Test Course'])
+        self.client.post('/api/game-titles', json={'name': 'Other Game'})
+        self.assertEqual(len(self.client.get('/api/game-titles').json), 2)
+
+    def test_catalog_conditional(self):
+        etag = self.client.get('/api/game-titles').headers['ETag']
+        response = self.client.get('/api/game-titles', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        # 別テーブルの更新ではゲームタイトルの ETag は変わらない
+        self.client.post('/api/cars', json={'name': 'Test Car', 'game_title_id': self.game_title_id})
+        response = self.client.get('/api/game-titles', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.client.post('/api/game-titles', json={'name': 'Other Game'})
+        response = self.client.get('/api/game-titles', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_catalog_etag_matches_cached_body(self):
+        """他のワーカーでの追加は、キャッシュが切れるまで古い一覧と古い ETag のまま返す"""
+        url = f'/api/cars?game_title_id={self.game_title_id}'
+        etag = self.client.get(url).headers['ETag']
+        # 別プロセスでの追加を再現する（このプロセスのキャッシュは消えない）
+        db.session.add(Car(name='Other Worker Car', game_title_id=self.game_title_id))
+        bump_table_version('car')
+        db.session.commit()
+        response = self.client.get(url)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.json, [])
+        # TTL が切れると新しい一覧と新しい ETag を返し、古い ETag での再検証は 200 になる
+        catalog_cache.clear()
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual([car['name'] for car in response.json], ['Other Worker Car'])
+
+    def test_cached_catalog_does_not_query_database(self):
+        etag = self.client.get('/api/game-titles').headers['ETag']
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            self.assertEqual(self.client.get('/api/game-titles').status_code, 200)
+            self.assertEqual(self.client.get('/api/game-titles', headers={'If-None-Match': etag}).status_code, 304)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(statements, [])
+
+    def test_ttl_cache_expiry_and_size(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), (False, None))
+        self.assertEqual(cache.get('c'), (True, 3))
+        expired = TTLCache(maxsize=2, ttl=-1)
+        expired.set('a', 1)
+        self.assertEqual(expired.get('a'), (False, None))
+        generation = cache.generation
+        cache.clear()
+        cache.set('d', 4, generation)
+        self.assertEqual(cache.get('d'), (False, None))
+
+class TestUserCache(unittest.TestCase):
+    # リクエストごとに別のアプリケーションコンテキスト（セッションと g）を使わせるため、
+    # テスト側ではコンテキストを push したままにしない
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        with app.app_context():
+            db.create_all()
+        user_cache.clear()
+        self.client.post('/api/register', json={
+            'email': 'kmc0001@kamiyama.ac.jp',
+            'password': '1234',
+            'username': 'driver1'
+        })
+        self.client.post('/api/login', json={'email': 'kmc0001@kamiyama.ac.jp', 'password': '1234'})
+
+    def tearDown(self):
+        user_cache.clear()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def user_queries(self, url):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if 'FROM users' in statement:
+                statements.append(statement)
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.client.get(url)
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        return response, len(statements)
+
+    def test_load_user_is_cached(self):
+        response, count = self.user_queries('/api/user')
+        self.assertEqual(response.json['username'], 'driver1')
+        self.assertEqual(count, 1)
+        response, count = self.user_queries('/api/user')
+        self.assertEqual(response.json['username'], 'driver1')
+        self.assertEqual(count, 0)
+
+    def test_user_update_invalidates_cache(self):
+        self.client.get('/api/user')
+        with app.app_context():
+            user = User.query.filter_by(username='driver1').first()
+            user.username = 'renamed'
+            db.session.commit()
+        response, count = self.user_queries('/api/user')
+        self.assertEqual(response.json['username'], 'renamed')
+        self.assertEqual(count, 1)
+
+class TestPasswordHashing(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        login_throttle._failures.clear()
+        self.original_method = app.config['PASSWORD_HASH_METHOD']
+        self.client.post('/api/register', json={
+            'email': 'kmc0001@kamiyama.ac.jp',
+            'password': '1234',
+            'username': 'driver1'
+        })
+
+    def tearDown(self):
+        app.config['PASSWORD_HASH_METHOD'] = self.original_method
+        login_throttle._failures.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, password, email='kmc0001@kamiyama.ac.jp'):
+        return self.client.post('/api/login', json={'email': email, 'password': password})
+
+    def test_login_rehashes_with_new_method(self):
+        user = User.query.filter_by(username='driver1').first()
+        self.assertTrue(user.password_hash.startswith(self.original_method + '$'))
+        app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        self.assertEqual(self.login('1234').status_code, 200)
+        db.session.refresh(user)
+        self.assertTrue(user.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertEqual(self.login('1234').status_code, 200)
+
+    def test_short_method_name_does_not_rehash(self):
+        user = User.query.filter_by(username='driver1').first()
+        password_hash = user.password_hash
+        # scrypt は scrypt:32768:8:1 に展開して保存されるので、同じ方式として扱う
+        app.config['PASSWORD_HASH_METHOD'] = 'scrypt'
+        self.assertEqual(self.login('1234').status_code, 200)
+        db.session.refresh(user)
+        self.assertEqual(user.password_hash, password_hash)
+
+    def test_repeated_failures_are_throttled(self):
+        limit = app.config['LOGIN_FAILURE_LIMIT_PER_EMAIL']
+        for _ in range(limit):
+            self.assertEqual(self.login('wrong').status_code, 401)
+        response = self.login('1234')
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response.headers['Retry-After']), 0)
+        # 別のメールアドレスは制限されない
+        self.assertEqual(self.login('wrong', email='other@kamiyama.ac.jp').status_code, 401)
+
+    def test_failures_of_other_emails_from_same_address_do_not_lock_out(self):
+        # プロキシの内側では全員が同じ IP になるので、他の人の失敗でログインできなくならない
+        limit = app.config['LOGIN_FAILURE_LIMIT_PER_EMAIL']
+        for i in range(4):
+            for _ in range(limit):
+                self.login('wrong', email=f'kmc{i + 2:04d}@kamiyama.ac.jp')
+        self.assertEqual(self.login('wrong', email='kmc0009@kamiyama.ac.jp').status_code, 401)
+        self.assertEqual(self.login('1234').status_code, 200)
+
+    def test_success_resets_email_failures(self):
+        limit = app.config['LOGIN_FAILURE_LIMIT_PER_EMAIL']
+        for _ in range(limit - 1):
+            self.login('wrong')
+        self.assertEqual(self.login('1234').status_code, 200)
+        self.assertEqual(self.login('wrong').status_code, 401)
+        self.assertEqual(self.login('1234').status_code, 200)
+
+    def test_full_queue_rejects_with_429(self):
+        hasher = PasswordHasher(workers=1, queue_depth=0)
+        self.assertTrue(hasher._slots.acquire(blocking=False))
+        with self.assertRaises(PasswordHasherBusy):
+            hasher.hash('1234')
+        hasher._slots.release()
+        self.assertTrue(hasher.verify(hasher.hash('1234'), '1234'))
+
+        # 全スロットが使用中ならログインは待たずに 429 を返す
+        acquired = 0
+        while password_hasher._slots.acquire(blocking=False):
+            acquired += 1
+        try:
+            response = self.login('1234')
+        finally:
+            for _ in range(acquired):
+                password_hasher._slots.release()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+
+class TestLapStream(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.original_keepalive = app.config['LAP_STREAM_KEEPALIVE']
+        app.config['LAP_STREAM_KEEPALIVE'] = 0.05
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        game_title = GameTitle(name='Test Game')
+        db.session.add(game_title)
+        db.session.flush()
+        cars = [Car(name=f'Car {i}', game_title_id=game_title.id) for i in range(2)]
+        course = Course(name='Test Course', game_title_id=game_title.id)
+        db.session.add_all(cars + [course])
+        db.session.commit()
+        self.combo = {'game_title_id': game_title.id, 'car_id': cars[0].id, 'course_id': course.id}
+        self.other_car_id = cars[1].id
+        self.client.post('/api/register', json={
+            'email': 'kmc0001@kamiyama.ac.jp',
+            'password': '1234',
+            'username': 'driver1'
+        })
+        self.client.post('/api/login', json={'email': 'kmc0001@kamiyama.ac.jp', 'password': '1234'})
+        self.streams = []
+
+    def tearDown(self):
+        for stream in self.streams:
+            stream.close()
+        app.config['LAP_STREAM_KEEPALIVE'] = self.original_keepalive
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def open_stream(self, query='', headers=None):
+        response = self.client.get(f'/api/lap-times/stream{query}', headers=headers, buffered=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.streams.append(response)
+        chunks = iter(response.response)
+        self.assertTrue(next(chunks).startswith(b'retry:'))
+        return chunks
+
+    def next_event(self, chunks):
+        """キープアライブを読み飛ばして次のイベントを返す"""
+        for _ in range(100):
+            chunk = next(chunks).decode('utf-8')
+            if chunk.startswith(':'):
+                continue
+            fields = dict(line.split(': ', 1) for line in chunk.strip().split('\n'))
+            return fields['id'], fields['event'], json.loads(fields['data'])
+        self.fail('イベントが届きませんでした')
+
+    def add_lap(self, time, **overrides):
+        response = self.client.post('/api/lap-times', json=dict(self.combo, time=time, **overrides))
+        self.assertEqual(response.status_code, 200)
+        return response.json['id']
+
+    def test_stream_pushes_added_and_deleted_laps(self):
+        chunks = self.open_stream()
+        lap_id = self.add_lap('1:05.000')
+        _, event, data = self.next_event(chunks)
+        self.assertEqual(event, 'lap_added')
+        self.assertEqual((data['id'], data['time_ms'], data['username']), (lap_id, 65000, 'driver1'))
+        self.client.delete(f'/api/lap-times/{lap_id}')
+        _, event, data = self.next_event(chunks)
+        self.assertEqual((event, data['id']), ('lap_deleted', lap_id))
+
+    def test_stream_filters_by_combo(self):
+        chunks = self.open_stream(f"?car_id={self.combo['car_id']}")
+        self.add_lap('1:04.000', car_id=self.other_car_id)
+        lap_id = self.add_lap('1:05.000')
+        _, _, data = self.next_event(chunks)
+        self.assertEqual(data['id'], lap_id)
+        self.assertEqual(self.client.get('/api/lap-times/stream?car_id=x').status_code, 400)
+
+    def test_reconnect_replays_from_last_event_id(self):
+        chunks = self.open_stream()
+        self.add_lap('1:05.000')
+        last_id, _, _ = self.next_event(chunks)
+        second = self.add_lap('1:04.000')
+        third = self.add_lap('1:03.000')
+        chunks = self.open_stream(headers={'Last-Event-ID': last_id})
+        self.assertEqual(self.next_event(chunks)[2]['id'], second)
+        self.assertEqual(self.next_event(chunks)[2]['id'], third)
+
+    def test_unknown_last_event_id_requests_reset(self):
+        chunks = self.open_stream('?last_event_id=0-1')
+        self.assertEqual(self.next_event(chunks)[1], 'reset')
+
+    def test_closing_stream_unsubscribes(self):
+        before = lap_events.subscriber_count()
+        self.open_stream()
+        self.assertEqual(lap_events.subscriber_count(), before + 1)
+        self.streams.pop().close()
+        self.assertEqual(lap_events.subscriber_count(), before)
+
+class TestLapTimeChanges(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        game_title = GameTitle(name='Test Game')
+        db.session.add(game_title)
+        db.session.flush()
+        car = Car(name='Test Car', game_title_id=game_title.id)
+        course = Course(name='Test Course', game_title_id=game_title.id)
+        db.session.add_all([car, course])
+        db.session.commit()
+        self.combo = {'game_title_id': game_title.id, 'car_id': car.id, 'course_id': course.id}
+        self.client.post('/api/register', json={
+            'email': 'kmc0001@kamiyama.ac.jp',
+            'password': '1234',
+            'username': 'driver1'
+        })
+        self.client.post('/api/login', json={'email': 'kmc0001@kamiyama.ac.jp', 'password': '1234'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_lap(self, time):
+        response = self.client.post('/api/lap-times', json=dict(self.combo, time=time))
+        self.assertEqual(response.status_code, 200)
+        return response.json['id']
+
+    def changes(self, since, **params):
+        query = '&'.join(f'{k}={v}' for k, v in dict(params, since=since).items())
+        response = self.client.get(f'/api/lap-times/changes?{query}')
+        self.assertEqual(response.status_code, 200)
+        return response.json
+
+    def test_changes_since_returns_upserts_and_tombstones(self):
+        first = self.add_lap('1:05.000')
+        since = self.changes(0)['since']
+        second = self.add_lap('1:04.000')
+        third = self.add_lap('1:03.000')
+        self.client.delete(f'/api/lap-times/{first}')
+        # 追加してすぐ削除したラップは削除としてだけ返る
+        self.client.delete(f'/api/lap-times/{third}')
+
+        body = self.changes(since)
+        columns = body['columns']
+        self.assertEqual([row[columns.index('id')] for row in body['upserts']], [second])
+        self.assertEqual(body['upserts'][0][columns.index('time_ms')], 64000)
+        self.assertEqual(sorted(body['deleted']), [first, third])
+        self.assertFalse(body['has_more'])
+
+        # 最新の seq から取得すれば変更はない
+        body = self.changes(body['since'])
+        self.assertEqual((body['upserts'], body['deleted']), ([], []))
+
+    def test_changes_are_paged_by_seq(self):
+        ids = [self.add_lap(f'1:0{i}.000') for i in range(5)]
+        seen, since = [], 0
+        while True:
+            body = self.changes(since, limit=2)
+            seen += [row[0] for row in body['upserts']]
+            since = body['since']
+            if not body['has_more']:
+                break
+        self.assertEqual(seen, ids)
+
+    def test_changes_rejects_unknown_seq(self):
+        self.add_lap('1:05.000')
+        response = self.client.get('/api/lap-times/changes?since=999')
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(response.json['latest'], 1)
+        self.assertEqual(self.client.get('/api/lap-times/changes?since=-1').status_code, 400)
+
+class TestLapEventBroker(unittest.TestCase):
+    def test_slow_client_buffer_is_bounded(self):
+        broker = LapEventBroker(replay_size=10)
+        subscription = broker.subscribe({}, maxsize=3)
+        for i in range(10):
+            last_id = broker.publish('lap_added', {'id': i})
+        # 溢れた時点で未送信分を捨て、再取得を促すイベント1件にまとめる
+        self.assertEqual(list(subscription.events), [(last_id, 'reset', {})])
+        broker.publish('lap_added', {'id': 10})
+        self.assertEqual(len(subscription.events), 1)
+        self.assertEqual(subscription.get(0)[1], 'reset')
+        self.assertIsNone(subscription.get(0))
+
+    def test_replay_gap_requests_reset(self):
+        broker = LapEventBroker(replay_size=2)
+        first = broker.publish('lap_added', {'id': 1})
+        for i in range(2, 5):
+            broker.publish('lap_added', {'id': i})
+        subscription = broker.subscribe({}, maxsize=10, last_event_id=first)
+        self.assertEqual(subscription.get(0)[1], 'reset')
+
+if __name__ == '__main__':
+    unittest.main()
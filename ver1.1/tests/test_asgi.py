@@ -0,0 +1,200 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+# テストではメモリ上のデータベースを使用する
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import unittest
+import asyncio
+import gzip
+import json
+import sqlite3
+import tempfile
+import threading
+from app import app, db, LapTime, catalog_cache, lap_events, user_cache
+from asgi import create_application
+from benchmarks.datagen import populate, BENCH_PASSWORD
+
+async def call(application, path, query='', headers=None, disconnect=None):
+    """ASGI アプリを直接呼び、(ステータス, ヘッダー, 本文の断片の一覧) を返す"""
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'root_path': '',
+        'headers': [(key.lower().encode(), value.encode()) for key, value in (headers or {}).items()],
+        'client': ('127.0.0.1', 50000),
+        'server': ('localhost', 80)
+    }
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # クライアントが切断するまで待つ
+        if disconnect is not None:
+            await disconnect.wait()
+        else:
+            await asyncio.Event().wait()
+        return {'type': 'http.disconnect'}
+
+    start, chunks = {}, []
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            start.update(message)
+        elif message.get('body'):
+            chunks.append(message['body'])
+
+    await application(scope, receive, send)
+    headers = {key.decode().lower(): value.decode() for key, value in start['headers']}
+    return start['status'], headers, chunks
+
+class TestASGI(unittest.TestCase):
+    """ASGI の非同期読み込み経路が Flask の同期経路と同じ応答を返すこと"""
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        populate(users=3, combos=2, laps=30, seed=1)
+        catalog_cache.clear()
+        self.client.post('/api/login', json={'email': 'bench00000@kamiyama.ac.jp', 'password': BENCH_PASSWORD})
+        self.cookie = f"session={self.client.get_cookie('session').value}"
+        self.lap = LapTime.query.first()
+
+        # aiosqlite からはメモリ上のデータベースが見えないため、同じ内容をファイルに写して読ませる
+        self.tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmpdir.name, 'asgi.db')
+        target = sqlite3.connect(path)
+        db.session.connection().connection.driver_connection.backup(target)
+        target.close()
+        self.database_url = f'sqlite:///{path}'
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.tmpdir.cleanup()
+
+    def run_asgi(self, test):
+        """新しい ASGI アプリを作って test(application) を実行する"""
+        async def main():
+            application = create_application(self.database_url)
+            try:
+                return await test(application)
+            finally:
+                await application.engine.dispose()
+        return asyncio.run(main())
+
+    def get(self, path, query='', headers=None):
+        status, headers, chunks = self.run_asgi(
+            lambda application: call(application, path, query, {'Cookie': self.cookie, **(headers or {})}))
+        return status, headers, b''.join(chunks)
+
+    def assert_same_as_flask(self, path, query=''):
+        status, headers, body = self.get(path, query)
+        expected = self.client.get(f'{path}?{query}')
+        self.assertEqual(status, expected.status_code)
+        self.assertEqual(json.loads(body), expected.json)
+        self.assertEqual(headers['etag'], expected.headers['ETag'])
+        self.assertEqual(headers['cache-control'], expected.headers['Cache-Control'])
+        return headers, json.loads(body)
+
+    def test_lap_times_match_flask(self):
+        for query in ('limit=5', 'limit=5&sort=time', 'format=columnar&limit=5',
+                      f'course_id={self.lap.course_id}&car_id={self.lap.car_id}'):
+            with self.subTest(query=query):
+                self.assert_same_as_flask('/api/lap-times', query)
+
+    def test_lap_times_cursor_pages_match_flask(self):
+        _, body = self.assert_same_as_flask('/api/lap-times', 'limit=4&sort=time')
+        self.assert_same_as_flask('/api/lap-times', f"limit=4&sort=time&cursor={body['next_cursor']}")
+
+    def test_leaderboard_matches_flask(self):
+        query = f'course_id={self.lap.course_id}&car_id={self.lap.car_id}'
+        for url_query in (query, f'{query}&around=me&span=1'):
+            with self.subTest(query=url_query):
+                headers, _ = self.assert_same_as_flask('/api/leaderboard', url_query)
+                self.assertIn('Cookie', headers['vary'])
+
+    def test_not_modified(self):
+        _, headers, _ = self.get('/api/lap-times')
+        status, _, body = self.get('/api/lap-times', headers={'If-None-Match': headers['etag']})
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b'')
+
+    def test_compression(self):
+        status, headers, body = self.get('/api/lap-times', 'limit=30', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(body)), self.client.get('/api/lap-times?limit=30').json)
+
+    def test_user_is_loaded_when_not_cached(self):
+        user_cache.clear()
+        self.assert_same_as_flask('/api/lap-times', 'limit=3')
+
+    def test_errors_fall_back_to_flask(self):
+        status, _, body = self.get('/api/lap-times', 'sort=name')
+        self.assertEqual(status, 400)
+        self.assertEqual(json.loads(body), {'error': 'sortの指定が正しくありません'})
+
+        status, _, _ = self.run_asgi(lambda application: call(application, '/api/lap-times'))
+        self.assertEqual(status, app.test_client().get('/api/lap-times').status_code)
+
+    def test_other_endpoints_fall_back_to_flask(self):
+        status, _, body = self.get('/api/game-titles')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), self.client.get('/api/game-titles').json)
+
+    def test_idle_streams_do_not_use_threads(self):
+        clients = 50
+        base = lap_events.subscriber_count()
+        lap = {
+            'game_title_id': self.lap.game_title_id,
+            'car_id': self.lap.car_id,
+            'course_id': self.lap.course_id,
+            'time': '1:23.456'
+        }
+
+        async def test(application):
+            disconnect = asyncio.Event()
+            # 認証で使う接続のスレッドを先に作っておく
+            await call(application, '/api/lap-times', 'limit=1', {'Cookie': self.cookie})
+            threads = threading.active_count()
+            streams = [asyncio.create_task(call(application, '/api/lap-times/stream', headers={'Cookie': self.cookie},
+                                                disconnect=disconnect))
+                       for _ in range(clients)]
+            while lap_events.subscriber_count() < base + clients:
+                await asyncio.sleep(0.01)
+            self.assertLessEqual(threading.active_count(), threads)
+
+            # 書き込みは同期のエンドポイントが別スレッドで処理し、待っている全員に届く
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(None, lambda: self.client.post('/api/lap-times', json=lap))
+            self.assertEqual(response.status_code, 200)
+            await asyncio.sleep(0.1)
+            disconnect.set()
+            return response.json['id'], await asyncio.gather(*streams)
+
+        lap_id, results = self.run_asgi(test)
+        self.assertEqual(lap_events.subscriber_count(), base)
+        for status, headers, chunks in results:
+            self.assertEqual(status, 200)
+            self.assertEqual(headers['content-type'], 'text/event-stream; charset=utf-8')
+            events = b''.join(chunks).decode()
+            self.assertTrue(events.startswith('retry: 3000\n\n'))
+            self.assertIn('event: lap_added\n', events)
+            self.assertIn(f'"id": {lap_id}', events)
+
+if __name__ == '__main__':
+    unittest.main()
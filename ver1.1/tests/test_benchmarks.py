@@ -0,0 +1,80 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+# テストではメモリ上のデータベースを使用する
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import unittest
+import shutil
+import sqlite3
+import tempfile
+from app import app, db, LapTime, PersonalBest, LapTimeChange
+from benchmarks.datagen import populate, build_fixture
+from benchmarks.run import run_all, percentile, SCENARIOS
+
+class TestBenchmarkHarness(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_populate_builds_skewed_dataset(self):
+        summary = populate(users=20, combos=6, laps=3000, seed=7)
+        self.assertEqual(summary['combos'], 6)
+        self.assertEqual(LapTime.query.count(), 3000)
+        self.assertEqual(LapTimeChange.query.count(), 3000)
+        # 自己ベストはユーザー×組み合わせごとに1件
+        combos = db.session.query(LapTime.user_id, LapTime.course_id, LapTime.car_id).distinct().count()
+        self.assertEqual(PersonalBest.query.count(), combos)
+        # 記録数の多いユーザーに偏っている
+        counts = sorted((n for _, n in db.session.query(LapTime.user_id, db.func.count())
+                         .group_by(LapTime.user_id)), reverse=True)
+        self.assertGreater(counts[0], 4 * counts[-1])
+
+    def test_scenarios_run_and_report_percentiles(self):
+        populate(users=5, combos=3, laps=300, seed=1)
+        results = run_all(app, list(SCENARIOS), iterations=3, concurrency=1, seed=1)
+        self.assertEqual(set(results), set(SCENARIOS))
+        for result in results.values():
+            for endpoint, summary in result['endpoints'].items():
+                self.assertEqual(summary['errors'], 0, endpoint)
+                self.assertLessEqual(summary['p50_ms'], summary['p95_ms'])
+                self.assertLessEqual(summary['p95_ms'], summary['p99_ms'])
+        self.assertEqual(results['insert_burst']['endpoints']['POST /api/lap-times']['count'], 30)
+
+    def test_fixture_is_deterministic_and_cached(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        first = build_fixture(laps=2000, combos=4, seed=3, cache_dir=os.path.join(tmpdir, 'a'))
+        second = build_fixture(laps=2000, combos=4, seed=3, cache_dir=os.path.join(tmpdir, 'b'))
+        mtime = os.path.getmtime(first)
+        # 同じ引数なら同じ名前で、キャッシュにあれば作り直さない
+        self.assertEqual(os.path.basename(first), os.path.basename(second))
+        self.assertEqual(build_fixture(laps=2000, combos=4, seed=3, cache_dir=os.path.join(tmpdir, 'a')), first)
+        self.assertEqual(os.path.getmtime(first), mtime)
+        self.assertNotEqual(build_fixture(laps=2000, combos=4, seed=4, cache_dir=os.path.join(tmpdir, 'a')), first)
+
+        def dump(path):
+            with sqlite3.connect(path) as conn:
+                return (conn.execute('SELECT * FROM lap_time ORDER BY id').fetchall(),
+                        conn.execute('SELECT * FROM personal_best ORDER BY user_id, course_id, car_id').fetchall())
+        laps, personal_bests = dump(first)
+        self.assertEqual(len(laps), 2000)
+        self.assertTrue(personal_bests)
+        self.assertEqual(dump(second), (laps, personal_bests))
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([3], 0.95), 3)
+        self.assertIsNone(percentile([], 0.5))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+# テストではメモリ上のデータベースを使用する
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import unittest
+import json
+import shutil
+import tempfile
+from app import (app, db, User, GameTitle, Car, Course, LapTime, LapTimeChange, PersonalBest,
+                 ImportProgress, TableVersion)
+
+CSV_HEADER = 'game_title,car,course,username,email,time,memo,created_at\n'
+
+class TestImportLaps(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.runner = app.test_cli_runner()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        return path
+
+    def import_laps(self, path, *options):
+        return self.runner.invoke(args=['import-laps', path, *options])
+
+    def test_csv_import_creates_catalog_users_and_derived_rows(self):
+        path = self.write('laps.csv', CSV_HEADER + (
+            'GT7,GT-R,Suzuka,driver1,d1@kamiyama.ac.jp,1:05.000,,2026-03-01T12:00:00\n'
+            'GT7,GT-R,Suzuka,driver1,d1@kamiyama.ac.jp,1:03.500,"雨, 夜",2026-03-01T12:05:00\n'
+            'GT7,NSX,Suzuka,driver2,d2@kamiyama.ac.jp,1:04.000,,\n'
+        ))
+        result = self.import_laps(path, '--create-users', '--chunk-size', '2')
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('3 件取り込みました', result.output)
+
+        self.assertEqual(GameTitle.query.count(), 1)
+        self.assertEqual(Car.query.count(), 2)
+        self.assertEqual(Course.query.count(), 1)
+        self.assertEqual(User.query.count(), 2)
+        self.assertEqual(LapTimeChange.query.count(), 3)
+        self.assertEqual(LapTime.query.filter_by(memo='雨, 夜').one().time_ms, 63500)
+        self.assertEqual(sorted(pb.time_ms for pb in PersonalBest.query), [63500, 64000])
+        self.assertEqual(db.session.get(TableVersion, 'car').version, 2)
+        # 取り込みで作成したユーザーはどのパスワードでもログインできない
+        self.assertFalse(User.query.filter_by(username='driver1').one().check_password(''))
+
+    def test_ndjson_import_uses_existing_catalog(self):
+        game_title = GameTitle(name='GT7')
+        db.session.add(game_title)
+        db.session.flush()
+        db.session.add_all([Car(name='GT-R', game_title_id=game_title.id),
+                            Course(name='Suzuka', game_title_id=game_title.id),
+                            User(username='driver1', email='d1@kamiyama.ac.jp', password_hash='-')])
+        db.session.commit()
+        laps = [{'game_title': 'GT7', 'car': 'GT-R', 'course': 'Suzuka', 'username': 'driver1', 'time_ms': 65000 + i}
+                for i in range(5)]
+        path = self.write('laps.ndjson', ''.join(json.dumps(lap) + '\n' for lap in laps))
+        result = self.import_laps(path)
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual((GameTitle.query.count(), Car.query.count()), (1, 1))
+        self.assertEqual([lap.time for lap in LapTime.query.order_by(LapTime.id)][:2], ['1:05.000', '1:05.001'])
+
+    def test_failure_resumes_after_last_committed_chunk(self):
+        rows = [f'GT7,GT-R,Suzuka,driver1,d1@kamiyama.ac.jp,1:0{i}.000,,\n' for i in range(5)]
+        rows[3] = 'GT7,GT-R,Suzuka,driver1,d1@kamiyama.ac.jp,1:5.0,,\n'
+        path = self.write('laps.csv', CSV_HEADER + ''.join(rows))
+        result = self.import_laps(path, '--create-users', '--chunk-size', '2')
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('4 件目', result.output)
+        # 失敗したチャンクは取り消され、コミット済みの2件だけが残る
+        self.assertEqual(LapTime.query.count(), 2)
+        self.assertEqual(db.session.get(ImportProgress, os.path.abspath(path)).records, 2)
+
+        rows[3] = 'GT7,GT-R,Suzuka,driver1,d1@kamiyama.ac.jp,1:03.000,,\n'
+        self.write('laps.csv', CSV_HEADER + ''.join(rows))
+        result = self.import_laps(path, '--create-users', '--chunk-size', '2')
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('続きから再開します', result.output)
+        self.assertEqual(sorted(lap.time_ms for lap in LapTime.query), [60000, 61000, 62000, 63000, 64000])
+
+        # 取り込み済みのファイルを再実行しても重複しない
+        self.import_laps(path, '--create-users')
+        self.assertEqual(LapTime.query.count(), 5)
+
+    def test_skip_invalid_reports_and_continues(self):
+        path = self.write('laps.csv', CSV_HEADER + (
+            'GT7,GT-R,Suzuka,driver1,d1@kamiyama.ac.jp,1:05.000,,\n'
+            'GT7,GT-R,Suzuka,unknown,,1:05.000,,\n'
+            'GT7,GT-R,,driver1,d1@kamiyama.ac.jp,1:05.000,,\n'
+        ))
+        result = self.import_laps(path, '--create-users', '--skip-invalid')
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('2 件目を読み飛ばしました: ユーザー unknown が存在しません', result.output)
+        self.assertIn('3 件目を読み飛ばしました: courseがありません', result.output)
+        self.assertEqual(LapTime.query.count(), 1)
+
+    def test_create_users_rejects_email_of_another_user(self):
+        db.session.add(User(username='driver1', email='d1@kamiyama.ac.jp', password_hash='-'))
+        db.session.commit()
+        path = self.write('laps.csv', CSV_HEADER + (
+            'GT7,GT-R,Suzuka,driver2,d2@kamiyama.ac.jp,1:05.000,,\n'
+            'GT7,GT-R,Suzuka,impostor,d1@kamiyama.ac.jp,1:05.000,,\n'
+            'GT7,GT-R,Suzuka,driver3,d2@kamiyama.ac.jp,1:05.000,,\n'
+        ))
+        result = self.import_laps(path, '--create-users')
+        # IntegrityError の traceback ではなく、行番号付きのエラーとして終了する
+        self.assertEqual(result.exit_code, 1)
+        self.assertIsInstance(result.exception, SystemExit)
+        self.assertIn('2 件目: メールアドレス d1@kamiyama.ac.jp は別のユーザーが使っています', result.output)
+        self.assertIn('続きから再開します', result.output)
+
+        result = self.import_laps(path, '--create-users', '--skip-invalid')
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('2 件目を読み飛ばしました', result.output)
+        # 同じファイル内で作成したユーザーの email も重複として扱う
+        self.assertIn('3 件目を読み飛ばしました: メールアドレス d2@kamiyama.ac.jp は別のユーザーが使っています',
+                      result.output)
+        self.assertEqual(sorted(user.username for user in User.query), ['driver1', 'driver2'])
+        self.assertEqual(LapTime.query.count(), 1)
+
+    def test_rejects_car_and_course_of_another_game_title(self):
+        laps = [
+            {'game_title': 'GT7', 'car': 'NSX', 'course': 'Suzuka', 'username': 'driver1', 'time': '1:05.000'},
+            {'game_title': 'GTS', 'car': 'NSX', 'course': 'Fuji', 'username': 'driver1', 'time': '1:05.000'},
+            {'game_title': 'GTS', 'car': 'Supra', 'course': 'Suzuka', 'username': 'driver1', 'time': '1:05.000'}
+        ]
+        path = self.write('laps.ndjson', ''.join(json.dumps(dict(lap, email='d1@kamiyama.ac.jp')) + '\n'
+                                                 for lap in laps))
+        result = self.import_laps(path, '--create-users')
+        # 車種名・コース名は全タイトルで一意なので、IntegrityError ではなく行番号付きのエラーになる
+        self.assertEqual(result.exit_code, 1)
+        self.assertIsInstance(result.exception, SystemExit)
+        self.assertIn('2 件目: 車種 NSX は別のゲームタイトルに登録されています', result.output)
+
+        result = self.import_laps(path, '--create-users', '--skip-invalid')
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('3 件目を読み飛ばしました: コース Suzuka は別のゲームタイトルに登録されています', result.output)
+        # 読み飛ばした行のゲームタイトルは作られない
+        self.assertEqual([title.name for title in GameTitle.query], ['GT7'])
+        self.assertEqual((Car.query.count(), Course.query.count()), (1, 1))
+        self.assertEqual(LapTime.query.count(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import unittest
+import sqlite3
+import subprocess
+import tempfile
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# マイグレーション導入前の db.create_all() で作られたスキーマに相当する版（app.INITIAL_REVISION）
+INITIAL_REVISION = '6342b1e30b06'
+
+class TestMigrations(unittest.TestCase):
+    """マイグレーションだけでデータベースを最新のスキーマにできること
+
+    アプリの読み込み時にテーブルが作られると後続の CREATE TABLE や埋め戻しが失敗・空振りするため、
+    別プロセスで flask コマンドを実行して確かめる。
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'gtr.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def flask(self, *args):
+        env = dict(os.environ, DATABASE_URL=f'sqlite:///{self.path}')
+        result = subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', *args],
+                                cwd=APP_DIR, env=env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        return result
+
+    def test_fresh_database(self):
+        self.flask('init-db')
+        self.flask('db', 'check')
+
+    def test_baseline_database_is_upgraded_with_backfill(self):
+        # 初版まで上げてから版の記録を消すと、導入前のアプリが作ったデータベースと同じになる
+        self.flask('db', 'upgrade', INITIAL_REVISION)
+        conn = sqlite3.connect(self.path)
+        conn.executescript("""
+            DROP TABLE alembic_version;
+            INSERT INTO users (id, username, email) VALUES (1, 'driver1', 'kmc0001@kamiyama.ac.jp');
+            INSERT INTO game_title (id, name) VALUES (1, 'Test Game');
+            INSERT INTO car (id, name, game_title_id) VALUES (1, 'Test Car', 1);
+            INSERT INTO course (id, name, game_title_id) VALUES (1, 'Test Course', 1);
+            INSERT INTO lap_time (id, user_id, game_title_id, car_id, course_id, time, created_at) VALUES
+                (1, 1, 1, 1, 1, '1:23.456', '2026-01-01 00:00:00'),
+                (2, 1, 1, 1, 1, '1:22.000', '2026-01-02 00:00:00'),
+                (3, 1, 1, 1, 1, '1:29.5', '2026-01-03 00:00:00');
+        """)
+        conn.commit()
+
+        self.flask('init-db')
+        self.flask('db', 'check')
+        self.assertEqual(conn.execute('SELECT id, time_ms FROM lap_time ORDER BY id').fetchall(),
+                         [(1, 83456), (2, 82000), (3, None)])
+        self.assertEqual(conn.execute('SELECT user_id, course_id, car_id, lap_time_id, time_ms FROM personal_best')
+                         .fetchall(), [(1, 1, 1, 2, 82000)])
+        self.assertEqual(conn.execute("SELECT lap_time_id FROM lap_time_change WHERE op = 'insert' ORDER BY seq")
+                         .fetchall(), [(1,), (2,), (3,)])
+        conn.close()
+
+        # 最新の状態で実行しても何も変わらない
+        self.flask('init-db')
+
+if __name__ == '__main__':
+    unittest.main()
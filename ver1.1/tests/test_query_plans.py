@@ -0,0 +1,135 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+# テストではメモリ上のデータベースを使用する
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import unittest
+import re
+import sqlite3
+from sqlalchemy import event
+from app import app, db, LapTime, catalog_cache
+from benchmarks.datagen import populate, build_fixture, BENCH_PASSWORD
+
+# 検証に使う合成データの規模（QUERY_PLAN_FIXTURE_LAPS=10000000 などで大きくできる）
+FIXTURE_LAPS = int(os.environ.get('QUERY_PLAN_FIXTURE_LAPS', 100000))
+# 件数が増え続けるテーブル。これらを全件走査するプランは不合格とする
+GROWING_TABLES = ('lap_time', 'personal_best')
+
+class TestQueryPlans(unittest.TestCase):
+    """主要なAPIが発行するSELECTの実行計画を大きなフィクスチャ上で確かめる
+
+    テスト用のデータベースで実際にAPIを呼んでSQLを記録し、同じスキーマのフィクスチャに対して
+    EXPLAIN QUERY PLAN を実行する。インデックスが使われなくなると全件走査（SCAN）になり失敗する。
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fixture = sqlite3.connect(build_fixture(laps=FIXTURE_LAPS))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fixture.close()
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        populate(users=3, combos=2, laps=30, seed=1)
+        catalog_cache.clear()
+        self.client.post('/api/login', json={'email': 'bench00000@kamiyama.ac.jp', 'password': BENCH_PASSWORD})
+        self.lap = LapTime.query.first()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def capture_selects(self, method, url, **kwargs):
+        """リクエスト中に発行されたSELECTと、そのパラメータを返す"""
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+                statements.append((statement, parameters))
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.client.open(url, method=method, **kwargs)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertLess(response.status_code, 400, response.get_data(as_text=True))
+        return statements
+
+    def explain(self, statement, parameters):
+        return [row[3] for row in self.fixture.execute(f'EXPLAIN QUERY PLAN {statement}', parameters)]
+
+    def assert_no_full_scan(self, url, touches, tables=GROWING_TABLES):
+        """touches のテーブルを読むクエリがあり、どのプランも tables を全件走査しないこと"""
+        statements = self.capture_selects('GET', url)
+        self.assertTrue(any(re.search(rf'\bFROM {touches}\b', statement) for statement, _ in statements),
+                        f'{url} で {touches} を読むクエリが発行されていません')
+        full_scan = re.compile(rf'^SCAN ({"|".join(tables)})(?: AS \w+)?$')
+        # 索引を端から読んでも、並べ替え直すなら全件を読むのと変わらない
+        index_scan = re.compile(rf'^SCAN ({"|".join(tables)})(?: AS \w+)? USING (COVERING )?INDEX')
+        for statement, parameters in statements:
+            plan = self.explain(statement, parameters)
+            scans = [line for line in plan if full_scan.match(line)
+                     or ('USE TEMP B-TREE FOR ORDER BY' in plan and index_scan.match(line))]
+            self.assertFalse(scans, f'{url} のクエリが全件走査になっています:\n{statement}\n' + '\n'.join(plan))
+
+    def test_login_looks_up_email_by_index(self):
+        statements = self.capture_selects('POST', '/api/login',
+                                          json={'email': 'bench00001@kamiyama.ac.jp', 'password': BENCH_PASSWORD})
+        lookup = next(s for s in statements if 'WHERE users.email = ?' in s[0])
+        plan = self.explain(*lookup)
+        self.assertTrue(any(line.startswith('SEARCH users USING') for line in plan), plan)
+
+    def test_lap_times_unfiltered(self):
+        for sort in ('-created_at', 'time'):
+            with self.subTest(sort=sort):
+                self.assert_no_full_scan(f'/api/lap-times?limit=50&sort={sort}', 'lap_time')
+
+    def test_lap_times_cursor_seeks_into_index(self):
+        cursor = self.client.get('/api/lap-times?limit=5').get_json()['next_cursor']
+        statements = self.capture_selects('GET', f'/api/lap-times?limit=5&cursor={cursor}')
+        plan = self.explain(*next(s for s in statements if 'FROM lap_time' in s[0]))
+        # 前のページの分を読み飛ばさず、カーソルの位置から索引を読み始める
+        self.assertTrue(any(re.match(r'^SEARCH lap_time USING (COVERING )?INDEX \w+ \(created_at<\?\)', line)
+                            for line in plan), plan)
+
+    def test_lap_times_by_game_title(self):
+        self.assert_no_full_scan(f'/api/lap-times?game_title_id={self.lap.game_title_id}', 'lap_time')
+
+    def test_lap_times_by_combo(self):
+        for sort in ('-created_at', 'time'):
+            with self.subTest(sort=sort):
+                self.assert_no_full_scan(
+                    f'/api/lap-times?course_id={self.lap.course_id}&car_id={self.lap.car_id}&sort={sort}', 'lap_time')
+
+    def test_lap_times_by_course(self):
+        self.assert_no_full_scan(f'/api/lap-times?course_id={self.lap.course_id}', 'lap_time')
+
+    def test_lap_times_by_user(self):
+        self.assert_no_full_scan(f'/api/lap-times?user_id={self.lap.user_id}', 'lap_time')
+
+    def test_cars_by_game_title(self):
+        self.assert_no_full_scan(f'/api/cars?game_title_id={self.lap.game_title_id}', 'car', ('car',))
+
+    def test_courses_by_game_title(self):
+        self.assert_no_full_scan(f'/api/courses?game_title_id={self.lap.game_title_id}', 'course', ('course',))
+
+    def test_leaderboard(self):
+        query = f'course_id={self.lap.course_id}&car_id={self.lap.car_id}'
+        for url in (f'/api/leaderboard?{query}', f'/api/leaderboard?{query}&around=me'):
+            with self.subTest(url=url):
+                self.assert_no_full_scan(url, 'personal_best')
+
+    def test_graph_queries(self):
+        query = f'course_id={self.lap.course_id}&car_id={self.lap.car_id}'
+        for url in (f'/api/lap-series?{query}', f'/api/stats?{query}'):
+            with self.subTest(url=url):
+                self.assert_no_full_scan(url, 'lap_time')
+
+if __name__ == '__main__':
+    unittest.main()